@@ -237,7 +237,7 @@ def plot_state_diagram(path: str, package: str, states: str, plot_name: str):
         from FeatureCloud.app.engine.app import app
 
 
-    app.register()
+    app.register(preload=False)
 
     graph = pydot.Dot('FeatureCloud State Diagram', graph_type='digraph', bgcolor='transparent')
 
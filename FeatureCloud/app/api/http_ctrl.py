@@ -1,9 +1,14 @@
 import json
-import time
+import mmap
+import tempfile
 
-from bottle import Bottle, request
+from bottle import Bottle, HTTPError, request, response
 
-from FeatureCloud.app.engine.app import app
+from FeatureCloud.app.engine.app import app, _FrameParts
+
+DATA_CHUNK_SIZE = 1024 * 1024  # Size (bytes) of the chunks data is streamed in on GET/POST /data
+DATA_SPOOL_SIZE = 256 * 1024 * 1024  # Incoming data larger than this (bytes) is spooled to a temporary file
+STATUS_MAX_WAIT = 60  # Maximum time (seconds) a long-polling GET /status blocks
 
 api_server = Bottle()
 
@@ -15,8 +20,7 @@ api_server = Bottle()
 
 @api_server.post('/setup')
 def ctrl_setup():
-    time.sleep(1)
-    print(f'[CTRL] POST /setup')
+    app.log_writer.request('[CTRL] POST /setup')
     payload = request.json
     app.handle_setup(payload.get('id'), payload.get('coordinator'), payload.get('clients'), payload.get('coordinatorID'))
     return ''
@@ -25,24 +29,103 @@ def ctrl_setup():
 @api_server.get('/status')
 def ctrl_status():
     # print(f'[CTRL] GET /status')
-    return app.handle_status()
+    # optional long-polling: with ?wait=<seconds>, the request blocks until
+    # data is available, or with a known version (?version=<v> or the ETag in
+    # If-None-Match) until the status changed, or until the time passed
+    etag = request.get_header('If-None-Match')
+    known = request.query.get('version') or (etag.strip('W/"') if etag else None)
+    try:
+        known = int(known) if known else None
+        wait = min(float(request.query.get('wait', 0)), STATUS_MAX_WAIT)
+    except ValueError:
+        raise HTTPError(400, 'wait and version must be numbers')
+    if wait > 0:
+        app.wait_status(wait, known)
+    version, status = app.handle_status_encoded()
+    response.content_type = 'application/json'
+    response.set_header('ETag', f'"{version}"')
+    if etag is not None and known == version:
+        response.status = 304
+        return b''
+    return status
 
 
 @api_server.route('/data', method='GET')
 def ctrl_data_out():
-    print(f'[CTRL] GET /data')
-    return app.handle_outgoing()
+    app.log_writer.request('[CTRL] GET /data')
+    data = app.handle_outgoing()
+    if data is None or (isinstance(data, (bytes, str)) and len(data) <= DATA_CHUNK_SIZE):
+        return data
+    # stream the data in chunks, so no further copy of the whole data is made
+    if isinstance(data, str):
+        if data.isascii():
+            response.content_length = len(data)
+    elif isinstance(data, _FrameParts):
+        response.content_length = data.nbytes
+    else:
+        response.content_length = memoryview(data).nbytes
+    return _iter_chunks(data)
 
 
 @api_server.route('/data', method='POST')
 def ctrl_data_in():
-    print(f'[CTRL] POST /data')
+    app.log_writer.request('[CTRL] POST /data')
     if "memo" in request.query:
         # The memo is URL-encoded, we compare later with the memo URL-encoded as well
         # we have to keep the URl-encoding here
         memo = request.query["memo"]
     else:
         memo = None
-    return app.handle_incoming(request.body.read(), request.query['client'], 
+    return app.handle_incoming(_read_body(), request.query['client'], 
                                memo=memo)
-    
+
+
+def _iter_chunks(data):
+    if isinstance(data, _FrameParts):
+        # the parts of a frame are streamed one after another, without joining them
+        for part in data.parts:
+            yield from _iter_chunks(part)
+    elif isinstance(data, str):
+        for start in range(0, len(data), DATA_CHUNK_SIZE):
+            yield data[start:start + DATA_CHUNK_SIZE].encode()
+    else:
+        view = memoryview(data).cast('B')
+        for start in range(0, view.nbytes, DATA_CHUNK_SIZE):
+            yield bytes(view[start:start + DATA_CHUNK_SIZE])
+
+
+def _read_body():
+    # read the body incrementally from the WSGI input into a writable buffer
+    # (so deserialized numpy arrays can be views on the received data), or for
+    # large data into a memory-mapped temporary file, so only one copy of the
+    # data is kept
+    length = request.content_length
+    if length < 0:
+        # e.g. chunked transfer encoding, which bottle decodes for us
+        return bytearray(request.body.read())
+    stream = request.environ['wsgi.input']
+    if length > DATA_SPOOL_SIZE:
+        with tempfile.TemporaryFile() as file:
+            for chunk in _iter_body(stream, length):
+                file.write(chunk)
+            file.flush()
+            # copy-on-write mapping, so the data stays writable without
+            # modifying the file; the mapping outlives the closed file
+            return mmap.mmap(file.fileno(), length, access=mmap.ACCESS_COPY)
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    for chunk in _iter_body(stream, length):
+        view[received:received + len(chunk)] = chunk
+        received += len(chunk)
+    return data
+
+
+def _iter_body(stream, length):
+    remaining = length
+    while remaining > 0:
+        chunk = stream.read(min(remaining, DATA_CHUNK_SIZE))
+        if not chunk:
+            raise HTTPError(400, 'Request body is shorter than its Content-Length')
+        remaining -= len(chunk)
+        yield chunk
@@ -1,4 +1,4 @@
-from bottle import Bottle
+from bottle import Bottle, response
 
 from FeatureCloud.app.engine.app import app
 
@@ -12,5 +12,11 @@ web_server = Bottle()
 
 @web_server.route('/')
 def index():
-    print(f'[WEB] GET /')
+    app.log_writer.request('[WEB] GET /')
     return f'State: {app.current_state.name}'
+
+
+@web_server.route('/metrics')
+def metrics():
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return app.render_metrics()
@@ -0,0 +1,273 @@
+"""
+Serving entry point for the controller API (api_server) and the web front-end
+(web_server). Requests are handled concurrently, so status polls and incoming
+data are answered while a large data piece is being transferred.
+"""
+import socket
+import threading
+
+from enum import Enum
+from socketserver import ThreadingMixIn
+from typing import Union
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from bottle import Bottle
+
+from FeatureCloud.app.api.http_ctrl import api_server
+from FeatureCloud.app.api.http_web import web_server
+from FeatureCloud.app.engine.app import app
+
+SERVER_THREADS = 16  # Number of worker threads of waitress and cheroot
+SERVER_KEEPALIVE = 75  # Time (seconds) an idle connection is kept open for further requests
+SERVER_MAX_HEADER_SIZE = 65536  # Maximum size (bytes) of the request line and of each header line
+
+
+class ServerBackend(Enum):
+    """
+    | The WSGI server used by serve
+    | ServerBackend.AUTO: waitress or cheroot if one of them is installed, otherwise ServerBackend.THREADED
+    | ServerBackend.THREADED: built-in server based on wsgiref, one thread per connection, with keep-alive
+    | ServerBackend.WAITRESS: the waitress server (pip install waitress)
+    | ServerBackend.CHEROOT: the cheroot server (pip install cheroot)
+    """
+    AUTO = 'auto'
+    THREADED = 'threaded'
+    WAITRESS = 'waitress'
+    CHEROOT = 'cheroot'
+
+
+def create_server() -> Bottle:
+    """
+    Creates the WSGI application with the controller API mounted at /api and
+    the web front-end at /web.
+
+    Returns
+    ----------
+    Bottle
+    """
+    server = Bottle()
+    server.mount('/api', api_server)
+    server.mount('/web', web_server)
+    return server
+
+
+def serve(host: str = 'localhost', port: int = 5000, threads: int = SERVER_THREADS,
+          keepalive: float = SERVER_KEEPALIVE, max_request_size: Union[int, None] = None,
+          backend: ServerBackend = ServerBackend.AUTO):
+    """
+    Serves the controller API and the web front-end until the process is
+    stopped.
+
+    Parameters
+    ----------
+    host : str, default='localhost'
+        the address to listen on
+    port : int, default=5000
+        the port to listen on
+    threads : int, default=SERVER_THREADS
+        number of worker threads handling requests concurrently (waitress
+        and cheroot), the built-in server uses one thread per connection
+    keepalive : float, default=SERVER_KEEPALIVE
+        seconds an idle connection is kept open, 0 closes every connection
+        after its first request (built-in server only, waitress and cheroot
+        keep connections open for at least one second)
+    max_request_size : int or None, default=None
+        maximum size (bytes) of a request body, larger requests are answered
+        with 413. None does not limit the size
+    backend : ServerBackend, default=ServerBackend.AUTO
+        the WSGI server to use
+    """
+    server = create_server()
+    if backend == ServerBackend.AUTO:
+        backend = _installed_backend()
+    app.log(f'serving on {host}:{port} ({backend.value})')
+    if backend == ServerBackend.WAITRESS:
+        import waitress
+        waitress.serve(server, host=host, port=port, threads=threads, channel_timeout=max(keepalive, 1),
+                       max_request_body_size=max_request_size if max_request_size is not None else 2 ** 63 - 1,
+                       max_request_header_size=SERVER_MAX_HEADER_SIZE, _quiet=True)
+        return
+    if backend == ServerBackend.CHEROOT:
+        from cheroot import wsgi
+        httpd = wsgi.Server((host, port), server, numthreads=threads, timeout=max(keepalive, 1))
+        # 0 does not limit the size
+        httpd.max_request_body_size = max_request_size or 0
+        httpd.max_request_header_size = SERVER_MAX_HEADER_SIZE
+        try:
+            httpd.start()
+        finally:
+            httpd.stop()
+        return
+    httpd = ThreadedWSGIServer((host, port), keepalive=keepalive, max_request_size=max_request_size)
+    httpd.set_app(server)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+
+
+def _installed_backend():
+    for backend in (ServerBackend.WAITRESS, ServerBackend.CHEROOT):
+        try:
+            __import__(backend.value)
+            return backend
+        except ImportError:
+            pass
+    return ServerBackend.THREADED
+
+
+class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    """ wsgiref server handling each connection in its own thread, for when
+        neither waitress nor cheroot is installed. Connections are kept open
+        for further requests (HTTP/1.1 keep-alive) while responses have a
+        known length.
+
+    Attributes
+    ----------
+    keepalive: float
+        seconds an idle connection is kept open
+    max_request_size: int or None
+        maximum size (bytes) of a request body
+    """
+    allow_reuse_address = True
+    request_queue_size = 64
+    # idle keep-alive connections never delay the exit
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, server_address, keepalive: float = SERVER_KEEPALIVE,
+                 max_request_size: Union[int, None] = None, handler_class=None):
+        self.keepalive = keepalive
+        self.max_request_size = max_request_size
+        self._connections = set()
+        self._lock = threading.Lock()
+        super().__init__(server_address, handler_class or _RequestHandler)
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self._connections.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self._lock:
+            self._connections.discard(request)
+        super().shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        with self._lock:
+            connections = list(self._connections)
+        # wakes up the threads waiting for a further request on idle connections
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class _ServerHandler(ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        if 'Content-Length' not in self.headers:
+            # the end of the response is only marked by closing the connection
+            self.request_handler.close_connection = True
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class _RequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # rate limited and written in the background, in the format of wsgiref
+        key = f'{format} {getattr(self, "command", "")} {getattr(self, "path", "").split("?")[0]}'
+        app.log_writer.request(f'{self.address_string()} - - [{self.log_date_time_string()}] {format % args}', key)
+
+    def setup(self):
+        # idle connections are closed after this timeout
+        self.timeout = self.server.keepalive or None
+        super().setup()
+        # headers and body are written separately, do not hold back the body
+        # until the headers are acknowledged (up to 40 ms with delayed ACKs)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        # the request loop of BaseHTTPRequestHandler, wsgiref handles only one
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(SERVER_MAX_HEADER_SIZE + 1)
+        except OSError:  # idle timeout or connection reset
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > SERVER_MAX_HEADER_SIZE:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():  # an error code has been sent, just exit
+            return
+        if not self.server.keepalive:
+            self.close_connection = True
+        length = int(self.headers.get('Content-Length') or 0)
+        max_size = self.server.max_request_size
+        if max_size is not None and length > max_size:
+            self.close_connection = True
+            self.send_error(413, f'Request body exceeds {max_size} bytes')
+            return
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            # the length of the body is unknown, so the request cannot be limited
+            # and a partially read body cannot be skipped
+            self.close_connection = True
+            if max_size is not None:
+                self.send_error(411)
+                return
+            body = self.rfile
+        else:
+            body = _BodyReader(self.rfile, length)
+        handler = _ServerHandler(body, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+        if getattr(body, 'remaining', 0):
+            # the application did not read the whole body, the next request
+            # would start in the middle of it
+            self.close_connection = True
+
+
+class _BodyReader:
+    # limits wsgi.input to the body of the current request, so requests on a
+    # kept-alive connection cannot read into the next one
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._stream.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._stream.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
@@ -2,23 +2,69 @@
 Test module documentation string for app.py
 """
 import abc
+import collections
+import concurrent.futures
+import copy
 import datetime
+import hashlib
 import json
+import mmap
 import numpy as np
+import os
 import pickle
-import sys
+import struct
+import tempfile
 import threading
 import traceback
 import urllib.parse
 
 from enum import Enum
-from time import sleep
-from typing import Dict, List, Tuple, Union, TypedDict, Literal
-
-DATA_POLL_INTERVAL = 0.1  # Interval (seconds) to check for new data pieces, adapt if necessary
-TERMINAL_WAIT = 10  # Time (seconds) to wait before final shutdown, to allow the controller to pick up the newest
-# progress etc.
-TRANSITION_WAIT = 1  # Time (seconds) to wait between state transitions
+from time import monotonic, perf_counter, sleep
+from typing import Callable, Dict, List, Tuple, Union, TypedDict, Literal
+
+from FeatureCloud.app.engine.compression import Compression, CompressionSelector, DEFAULT_BANDWIDTH, \
+    DEFAULT_TRIALS, compress, decompress, is_compressed
+from FeatureCloud.app.engine.encoding import QUANTIZATION_BLOCK_SIZE, QUANTIZATION_MIN_SIZE, SPARSE_MIN_SIZE, \
+    ArrayPatch, Delta, Quantization, QuantizedArray, SparseEncoder, apply_patches, decode, decoding, diff_arrays, \
+    is_encoded, is_sparse, keep_encoded, to_sparse_array
+from FeatureCloud.app.engine.logbuffer import LogWriter, REQUEST_LOG_BURST, REQUEST_LOG_INTERVAL
+from FeatureCloud.app.engine.metrics import Metrics
+from FeatureCloud.app.engine.tracing import Tracer
+
+try:
+    # optional, encodes numpy arrays to JSON natively for the SMPC/DP path
+    import orjson
+except ImportError:
+    orjson = None
+
+DATA_POLL_INTERVAL = 0.1  # [deprecated] await_data no longer polls, it is woken up by handle_incoming
+TERMINAL_WAIT = 10  # [deprecated] Time (seconds) that was waited before final shutdown, the app now waits until
+# the controller fetched the final status, see configure_shutdown for an optional extra wait
+TRANSITION_WAIT = 1  # [deprecated] Time (seconds) that was waited between state transitions, see configure_shutdown
+SHUTDOWN_TIMEOUT = 60  # Maximum time (seconds) the controller has to fetch the final status, see configure_shutdown
+
+FRAME_MAGIC = b'FCPB'  # Marks data serialized with the framed pickle format, see _serialize_outgoing
+FRAME_VERSION = 1  # Version of the framed pickle format
+FRAME_ALIGNMENT = 64  # Out-of-band buffers start at multiples of this offset inside a frame
+FRAME_OOB_MIN_SIZE = 4096  # Buffers (e.g. numpy arrays) of at least this size (bytes) are sent out-of-band
+_FRAME_HEADER = struct.Struct('<4sHHII')  # magic, version, flags, metadata length, number of buffers
+_FRAME_LENGTH = struct.Struct('<Q')
+
+CHECKPOINT_DIR = '/mnt/output/checkpoint'  # Default directory of the checkpoints, see AppState.configure_checkpoint
+CHECKPOINT_FILE = 'checkpoint.fcpb'  # Name of the checkpoint file inside the checkpoint directory
+CHECKPOINT_VERSION = 1  # Version of the checkpoint contents
+CHECKPOINT_FETCHED_FILE = 'checkpoint.fetched'  # Queued data pieces of the checkpoint fetched since it was written
+
+METRICS_FILE = '/mnt/output/metrics.prom'  # Default file the metrics are written to at the end, see configure_metrics
+TRACE_FILE = '/mnt/output/trace.json'  # Default file the trace is written to at the end, see configure_tracing
+
+INCOMING_SPILL_MIN_SIZE = 64 * 1024  # Received data pieces smaller than this (bytes) are never spilled to disk
+INCOMING_EVICTIONS_KEPT = 100  # Number of evicted memos kept in App.incoming_evictions
+
+TREE_FAN_IN = 4  # Default number of children of each client in the tree of aggregate_tree
+
+AGGREGATE_STACK_SIZE = 16 * 1024 * 1024  # Leaves whose stacked data pieces are smaller (bytes) are aggregated in
+# one vectorized call by _aggregate instead of one in-place operation per data piece
 
 
 class Role(Enum):
@@ -86,6 +132,21 @@ class DPSerialization(Enum):
     JSON = 'json'
 
 
+_LOG_LEVEL_ORDER = {LogLevel.DEBUG: 0, LogLevel.ERROR: 1, LogLevel.FATAL: 2}
+
+
+class LoopbackMode(Enum):
+    """
+    | Describes how data a client sends to itself is delivered
+    | LoopbackMode.REFERENCE: the object itself is delivered, without any copy
+    | LoopbackMode.COPY: a deep copy of the object, taken when it is sent, is delivered
+    | LoopbackMode.SERIALIZE: the object is serialized and deserialized, as any data sent via the controller
+    """
+    REFERENCE = 'reference'
+    COPY = 'copy'
+    SERIALIZE = 'serialize'
+
+
 class SMPCType(TypedDict):
     operation: Literal['add', 'multiply']
     serialization: Literal['json']
@@ -100,6 +161,271 @@ class DPType(TypedDict):
     sensitivity: Union[float, None]
     clippingVal: Union[float, None]
 
+
+class OutgoingQueue:
+    """ Thread-safe FIFO queue of the data pieces to be sent out, together
+        with the status each data piece has to be announced with.
+
+        The state thread enqueues data pieces with `append`, while the thread
+        answering the controller announces the status of the next data piece
+        with `peek_status` and removes it with `pop_matching`. All operations
+        are O(1).
+
+    Attributes
+    ----------
+    bytes: int
+        number of bytes of all data pieces currently in the queue
+    enqueued: int
+        total number of data pieces ever added
+    dequeued: int
+        total number of data pieces ever removed
+    bytes_dequeued: int
+        total number of bytes ever removed
+
+    Parameters
+    ----------
+    on_change: callable or None
+        called without arguments after each change of the queue
+
+    Methods
+    -------
+    append(data, status)
+    extend(items)
+    appendleft(data, status)
+    peek_status()
+    pop_matching(status)
+    items()
+    stats()
+    """
+
+    def __init__(self, on_change: Union[Callable[[], None], None] = None):
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._on_change = on_change
+            # called after each change of the queue, outside of the lock
+        self.bytes = 0
+        self.enqueued = 0
+        self.dequeued = 0
+        self.bytes_dequeued = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def append(self, data, status):
+        """ Adds a data piece to the end of the queue.
+
+        Parameters
+        ----------
+        data: bytes, str or None
+            serialized data, None if only the status should be sent
+        status: dict or str
+            status (as dict or JSON string) to announce the data piece with
+
+        """
+        with self._lock:
+            self._items.append((data, status))
+            self.bytes += _payload_size(data)
+            self.enqueued += 1
+        if self._on_change is not None:
+            self._on_change()
+
+    def extend(self, items):
+        """ Adds several data pieces to the end of the queue at once, with a
+            single notification of the change.
+
+        Parameters
+        ----------
+        items: list of tuple (data, status)
+
+        """
+        items = list(items)
+        if not items:
+            return
+        with self._lock:
+            self._items.extend(items)
+            self.bytes += sum(_payload_size(data) for data, _ in items)
+            self.enqueued += len(items)
+        if self._on_change is not None:
+            self._on_change()
+
+    def appendleft(self, data, status):
+        """ Adds a data piece to the front of the queue, so it is the next
+            one sent out.
+
+        Parameters
+        ----------
+        data: bytes, str or None
+        status: dict or str
+
+        """
+        with self._lock:
+            self._items.appendleft((data, status))
+            self.bytes += _payload_size(data)
+            self.enqueued += 1
+        if self._on_change is not None:
+            self._on_change()
+
+    def peek_status(self):
+        """ Returns the status of the next data piece, None if the queue is
+            empty.
+
+        """
+        with self._lock:
+            if not self._items:
+                return None
+            return self._items[0][1]
+
+    def pop_matching(self, status):
+        """ Returns the next data piece and its status. The data piece is
+            only removed from the queue if it was queued with the given
+            status, so the data sent out always matches the status the
+            controller was told about before.
+
+        Parameters
+        ----------
+        status: dict or str
+            the status that was announced last
+
+        Returns
+        -------
+        tuple (data, queued_status) or None if the queue is empty
+        """
+        with self._lock:
+            if not self._items:
+                return None
+            data, queued_status = self._items[0]
+            popped = queued_status == status
+            if popped:
+                self._items.popleft()
+                size = _payload_size(data)
+                self.bytes -= size
+                self.bytes_dequeued += size
+                self.dequeued += 1
+        if popped and self._on_change is not None:
+            self._on_change()
+        return data, queued_status
+
+    def items(self):
+        """ Returns a list of all queued (data, status) tuples, in the order
+            they are sent out.
+
+        """
+        with self._lock:
+            return list(self._items)
+
+    def stats(self):
+        """ Returns the counters of the queue as a dict.
+
+        """
+        with self._lock:
+            return {'depth': len(self._items), 'bytes': self.bytes,
+                    'enqueued': self.enqueued, 'dequeued': self.dequeued,
+                    'bytes_dequeued': self.bytes_dequeued}
+
+
+class _Loopback:
+    """ Wraps data a client sent to itself, which is stored in data_incoming
+        as object instead of its serialization. If encoded is True, the data
+        contains SparseArrays or QuantizedArrays, which are decoded on
+        receipt like unpickled ones.
+    """
+    __slots__ = ('value', 'encoded')
+
+    def __init__(self, value, encoded=False):
+        self.value = value
+        self.encoded = encoded
+
+    def get(self):
+        if self.encoded and decoding():
+            return _map_leaves(self.value, decode)
+        return self.value
+
+
+class _FrameParts:
+    """ A frame (see _dumps_frame) kept as the list of its parts, so it is
+        queued and sent out without joining the parts, which would copy
+        every out-of-band buffer (see configure_serialization). The buffers
+        are views on the arrays of the sent data.
+    """
+    __slots__ = ('parts', 'nbytes')
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.nbytes = sum(memoryview(part).nbytes for part in parts)
+
+    def __reduce__(self):
+        return _FrameParts, (self.parts,)
+
+    def join(self) -> bytes:
+        return b''.join(self.parts)
+
+
+class LazyData:
+    """ Handle to a received data piece that is only deserialized when its
+        value is accessed for the first time. Passing a handle that was not
+        accessed yet to a send method forwards the received bytes as they are,
+        without deserializing and serializing them again.
+
+    Attributes
+    ----------
+    client: str
+        ID of the client that sent the data piece
+    is_json: bool
+        whether the data piece is serialized as JSON
+    loaded: bool
+        whether the data piece was deserialized already
+
+    Properties
+    ----------
+    value: object
+        the deserialized data piece
+    nbytes: int
+        size of the serialized data piece
+
+    Methods
+    -------
+    get()
+    """
+
+    def __init__(self, data, client=None, is_json=False, resolve=None):
+        self._data = data
+        self._value = None
+        self.client = client
+        self.is_json = is_json
+        self.loaded = False
+        self._resolve = resolve
+            # called with the deserialized data and the frame metadata, see
+            # App.resolve_incoming
+        self._lock = threading.Lock()
+
+    def get(self):
+        """ Deserializes the data piece on the first call and returns it.
+
+        """
+        with self._lock:
+            if not self.loaded:
+                value, metadata = _deserialize_incoming(self._data, is_json=self.is_json, with_metadata=True)
+                self._value = self._resolve(value, metadata, self.client) if self._resolve is not None else value
+                self._data = None
+                self.loaded = True
+        return self._value
+
+    @property
+    def value(self):
+        return self.get()
+
+    @property
+    def raw(self):
+        """ The serialized data piece, None once it was deserialized.
+
+        """
+        return self._data
+
+    @property
+    def nbytes(self):
+        return _payload_size(self._data)
+
+
 class App:
     """ Implementing the workflow for the FeatureCloud platform.
 
@@ -110,6 +436,7 @@ class App:
     clients: list
     send_counter: int
     receive_counter: int
+    collective_counter: int
     status_available: bool 
     status_finished: bool
     status_message: str
@@ -122,28 +449,82 @@ class App:
 
     default_smpc: dict
     default_dp: dict
+    default_compression: Compression
+    compression_level: int
+    deserialization_workers: int
+    deserialization_processes: bool
+    lazy_deserialization: bool
+    zero_copy_send: bool
+    loopback_mode: LoopbackMode
+    sparse_encoder: SparseEncoder
+    default_quantization: Quantization
+    quantization_block_size: int
+    quantization_stochastic: bool
+    quantization_min_size: int
+    delta_sent: dict
+    delta_received: dict
+    delta_acks: dict
+    terminal_wait: float
+    transition_wait: float
+    shutdown_timeout: float
+
+    incoming_budget: int
+    incoming_ttl: float
+    incoming_spill_dir: str
+    incoming_evictions: collections.deque
+
+    metrics: Metrics
+    metrics_file: str
+    tracer: Tracer
+    trace_file: str
+    log_level: LogLevel
+    log_writer: LogWriter
+    checkpoint_dir: str
+    checkpoint_every: int
+    checkpoint_interval: float
+    checkpoint_resume: bool
+    checkpoint_exclude: set
 
     data_incoming: dict[str]: [(data, sendingClientID: str),...]
-    data_outgoing: list[(data, statusJSON: str)]
+    data_outgoing: OutgoingQueue[(data, status: dict)]
     thread: threading.Thread
 
     states: Dict[str, AppState]
+    preload_hooks: List[Callable[[App], None]]
     transitions: Dict[str, Tuple[AppState, AppState, bool, bool]]
     transition_log: List[Tuple[datetime.datetime, str]]
     internal: dict
 
     current_state: AppState
-    last_send_status: str (JSON)
+    last_send_status: dict
+    status_version: int
 
     Methods
     -------
     handle_setup(client_id, coordinator, clients)
     handle_incoming(data)
+    evict_stale_incoming(ttl)
+    incoming_stats()
+    serialize_outgoing(data, is_json)
+    deserialize_incoming(data, is_json, client)
+    deserialize_pieces(pieces, is_json, lazy)
+    resolve_incoming(data, metadata, client)
+    encode_delta(key, data, clients)
+    render_metrics()
+    dump_trace(path)
     handle_outgoing()
+    handle_status()
+    handle_status_encoded()
+    wait_status(timeout, version)
     get_current_status(**kwargs)
     guarded_run()
     run()
-    register()
+    register(preload)
+    checkpoint()
+    resume()
+    remove_checkpoint()
+    start_preload()
+    wait_preload(timeout)
     _register_state(name, state, participant, coordinator, **kwargs)
     register_transition(name, source, participant, coordinator)
     transition()
@@ -151,6 +532,11 @@ class App:
     """
 
     def __init__(self):
+        self._status_condition = threading.Condition()
+        self._status_version = 0
+        self._status_cache: Union[Tuple[int, dict, bytes, bool], None] = None
+            # (version, status, encoded status, whether it is queued) of the
+            # status served last, see handle_status_encoded
         self.id = None
         self.coordinator = None
         self.coordinatorID = None
@@ -166,6 +552,9 @@ class App:
             # This should work in 99% of all cases, except when
             # somebody uses send_data_to_participant from each client and then
             # uses await_data on all these #clients -1 data pieces.
+        self.collective_counter: int = 0
+            # increased by every call of aggregate_tree and all_reduce, which
+            # all clients make, to derive the same automated memo on all of them
         self.data_incoming = {}
             # dictionary mapping memo: [(data, client),...]
             # data is the data serialized with JSON when SMPC or DP is used, 
@@ -173,17 +562,101 @@ class App:
             # client is the id of the client that sent the data
             # memo is the memo send alongside the data to identify to which
             # comunication round the data belongs to
-        self.data_outgoing = [] 
-            # list of all data objects and the corresponding status to use with them
-            # format: list of tuples, each tuple contains dataObject, status as JSON string
+        self._incoming_lock = threading.Lock()
+        self._incoming_conditions = {}
+            # dictionary mapping memo: threading.Condition, all sharing
+            # _incoming_lock. await_data waits on the condition of its memo
+            # and handle_incoming notifies it when a data piece arrives
+        self.incoming_budget: Union[int, None] = None
+        self.incoming_ttl: Union[float, None] = None
+        self.incoming_spill_dir: Union[str, None] = None
+            # see configure_incoming
+        self._incoming_bytes = 0
+            # size of the data pieces in data_incoming that are kept in memory
+        self._incoming_times = {}
+            # dictionary mapping memo: time the last data piece arrived
+        self._spill_lock = threading.Lock()
+        self.incoming_spilled: int = 0
+        self.incoming_spilled_bytes: int = 0
+        self.incoming_evictions = collections.deque(maxlen=INCOMING_EVICTIONS_KEPT)
+            # diagnostics of memos evicted by evict_stale_incoming
+        self.data_outgoing = OutgoingQueue(on_change=self._invalidate_status)
+            # queue of all data objects and the corresponding status to use with them
+            # format: tuples, each tuple contains dataObject, status dict
 
         self.default_smpc: SMPCType = {'operation': 'add', 'serialization': 'json', 'shards': 0, 'exponent': 8}
         self.default_dp: DPType = {'serialization': 'json', 'noisetype': 'laplace',
                                    'epsilon': 1.0, 'delta': 0.0,
                                    'sensitivity': None, 'clippingVal': 10.0}
+        self.default_compression: Compression = Compression.NONE
+        self.compression_level: Union[int, None] = None
+        self.compression_selector: Union[CompressionSelector, None] = None
+            # selects the codec for Compression.AUTO, see configure_compression
+        self.deserialization_workers: int = 1
+        self.deserialization_processes: bool = False
+        self.lazy_deserialization: bool = False
+        self.zero_copy_send: bool = False
+            # see configure_serialization
+        self.loopback_mode: LoopbackMode = LoopbackMode.COPY
+            # how data sent to this client itself is delivered, see configure_loopback
+        self.sparse_encoder: Union[SparseEncoder, None] = None
+            # see configure_sparse, the encoder keeps the error feedback residuals
+        self.delta_sent = {}
+            # dictionary mapping key: [version, copies of its arrays] of the
+            # delta broadcasts sent, see broadcast_data
+        self.delta_received = {}
+            # dictionary mapping key: [version, copies of its arrays] of the
+            # delta broadcasts received
+        self.delta_acks = {}
+            # dictionary mapping client: {key: version} held by the client
+        self._delta_lock = threading.Lock()
+        self.default_quantization: Quantization = Quantization.NONE
+        self.quantization_block_size: int = QUANTIZATION_BLOCK_SIZE
+        self.quantization_stochastic: bool = False
+        self.quantization_min_size: int = QUANTIZATION_MIN_SIZE
+            # see configure_quantization
+        self._deserialization_pool: Union[concurrent.futures.Executor, None] = None
+            # created on first use, see configure_deserialization
+        self.terminal_wait: float = 0
+        self.transition_wait: float = 0
+        self.shutdown_timeout: Union[float, None] = SHUTDOWN_TIMEOUT
+            # see configure_shutdown
+        self.log_level: LogLevel = LogLevel.DEBUG
+        self.log_writer = LogWriter()
+            # writes the log messages in a background thread, see configure_logging
+        self.metrics = Metrics()
+        self.metrics_file: Union[str, None] = None
+            # the metrics are written to this file at the end, see configure_metrics
+        self._incoming_first = {}
+            # dictionary mapping memo: time the first data piece arrived
+        self.tracer = Tracer()
+        self.trace_file: Union[str, None] = None
+            # the trace is written to this file at the end, see configure_tracing
+        self.checkpoint_dir: Union[str, None] = None
+        self.checkpoint_every: Union[int, None] = 1
+        self.checkpoint_interval: Union[float, None] = None
+        self.checkpoint_resume: bool = False
+        self.checkpoint_exclude: set = set()
+            # see AppState.configure_checkpoint, disabled while checkpoint_dir is None
+        self._transitions_since_checkpoint = 0
+        self._last_checkpoint = monotonic()
+        self._checkpointed_outgoing = (None, {})
+            # generation of the checkpoint and dictionary mapping the id of
+            # the status of each data piece queued in it: its position
+        self._fetched_lock = threading.Lock()
+        self._final_status: Union[dict, None] = None
+        self._shutdown_event = threading.Event()
+            # set by handle_status once the controller fetched the final
+            # status, i.e. after all data pieces before it were sent out
 
         self.current_state: Union[AppState, None] = None
         self.states: Dict[str, AppState] = {}
+        self.preload_hooks: List[Callable[[App], None]] = []
+            # functions run in the background at container start, before
+            # /setup arrives, see app_preload
+        self._preload_thread: Union[threading.Thread, None] = None
+        self._preload_done = threading.Event()
+        self._preload_error: Union[BaseException, None] = None
         #self.transitions: Dict[
         #    str, Tuple[AppState, AppState, bool, bool]] = {}  # name => (source, target, participant, coordinator)
         self.transitions: Dict[
@@ -235,6 +708,7 @@ class App:
         self.log(f'id: {self.id}')
         self.log(f'coordinator: {self.coordinator}')
         self.log(f'clients: {self.clients}')
+        self.tracer.set_client(self.id, self.coordinator, self.clients, self.coordinatorID)
 
         self.current_state = self.states.get('initial')
 
@@ -255,60 +729,353 @@ class App:
             self.status_message = e.__class__.__name__
             self.status_state = State.ERROR.value
             self.status_finished = True
-            self.data_outgoing.insert(0, (None, self.get_current_status(
+            self.data_outgoing.appendleft(None, self.get_current_status(
                 finished=True, state=State.ERROR.value, 
-                message=e.__class__.__name__)))
+                message=e.__class__.__name__))
               # remove ANY data in the pipeline and crash the workflow 
               # on the next poll
 
     def run(self):
         """    Runs the workflow, logs the current state, executes it,
                and handles the transition to the next desired state.
-               Once the app transits to the terminal state, the workflow will be terminated.
+               Once the app transits to the terminal state, the final status
+               is queued behind all remaining data pieces and the workflow is
+               terminated as soon as the controller fetched it.
+               The workflow starts once all preload hooks are done.
         """
+        self.start_preload()
+        self.wait_preload()
+        if self._preload_error is not None:
+            raise self._preload_error
+        if self.checkpoint_dir is not None and self.checkpoint_resume:
+            self.resume()
         while True:
             self.log(f'state: {self.current_state.name}')
-            transition = self.current_state.run()
+            state_name = self.current_state.name
+            trace_start = self.tracer.now()
+            with self.metrics.timer('fc_state_seconds_total', state=state_name):
+                transition = self.current_state.run()
+            self.tracer.span('states', state_name, trace_start, self.tracer.now())
+            self.metrics.inc('fc_state_runs_total', state=state_name)
             self.log(f'transition: {transition}')
             self.transition(f'{self.current_state.name}_{transition}')
+            if self.checkpoint_dir is not None:
+                self._transitions_since_checkpoint += 1
+                if (self.checkpoint_every and self._transitions_since_checkpoint >= self.checkpoint_every) or \
+                        (self.checkpoint_interval is not None and
+                         monotonic() - self._last_checkpoint >= self.checkpoint_interval):
+                    self.checkpoint()
             if self.current_state.name == 'terminal':
-                sleep(TERMINAL_WAIT) 
-                terminal_status_added = False
-                while True:
-                    if not terminal_status_added:
-                        # add finished status answer to the outgoing data queue
-                        status = self.get_current_status(progress=1.0, 
-                                                         message="terminal", 
-                                                         finished=True)
-                        self.data_outgoing.append((None, status)) 
-                            # only append to ensure that all data in the pipe is still
-                            # sent out
-                        terminal_status_added = True
-                        sleep(TERMINAL_WAIT) 
-                            # potentially this wait time clears the queue already
-                    if len(self.data_outgoing) > 1:
-                        # there is still data to be sent out
-                        self.log(f'done, waiting for the last {len(self.data_outgoing)-1} data pieces to be send')
-                    elif len(self.data_outgoing) == 1:
-                        sleep(TERMINAL_WAIT) 
-                            # the last status that was added before is never
-                            # removed, so we finnish when only one status is 
-                            # left
-                            # To ensure that this last status has been pulled,
-                            # we just wait 
-                        self.log('done')
-                        return 
-                    sleep(TRANSITION_WAIT)
-            sleep(TRANSITION_WAIT)
-
-    def register(self):
+                # add finished status answer to the outgoing data queue,
+                # only append to ensure that all data in the pipe is still
+                # sent out
+                status = self.get_current_status(progress=1.0,
+                                                 message="terminal",
+                                                 finished=True)
+                self._final_status = status
+                self.data_outgoing.append(None, status)
+                if len(self.data_outgoing) > 1:
+                    # there is still data to be sent out
+                    self.log(f'done, waiting for the last {len(self.data_outgoing)-1} data pieces to be send')
+                if not self._shutdown_event.wait(self.shutdown_timeout):
+                    self.log(f'the final status was not fetched within {self.shutdown_timeout} seconds, '
+                             f'{len(self.data_outgoing)} entries are left in the outgoing queue',
+                             level=LogLevel.ERROR)
+                if self.terminal_wait:
+                    sleep(self.terminal_wait)
+                if self.metrics_file is not None:
+                    self.dump_metrics(self.metrics_file)
+                if self.trace_file is not None:
+                    self.dump_trace(self.trace_file)
+                if self.checkpoint_dir is not None:
+                    self.remove_checkpoint()
+                self.log('done')
+                self.log_writer.flush()
+                return
+            if self.transition_wait:
+                sleep(self.transition_wait)
+
+    def register(self, preload: bool = True):
         """ Registers all of the states transitions
             it should be called once all of the states are registered.
+            Afterwards, the preload hooks are started in the background.
+
+        Parameters
+        ----------
+        preload: bool, default=True
+            whether to start the preload hooks, see start_preload
 
         """
         for s in self.states:
             state = self.states[s]
             state.register()
+        if preload:
+            self.start_preload()
+
+    def checkpoint(self) -> bool:
+        """ Writes a checkpoint to checkpoint_dir. Large arrays in
+            app.internal and the queued data pieces are written directly from
+            memory and memory-mapped when resuming. The previous checkpoint is replaced atomically, so
+            a crash while writing leaves it intact.
+
+        Returns
+        -------
+        bool
+            whether the checkpoint was written
+
+        """
+        start = perf_counter()
+        with self._incoming_lock:
+            incoming = {memo: [(_checkpoint_payload(data), client) for data, client in pieces]
+                        for memo, pieces in self.data_incoming.items()}
+        items = self.data_outgoing.items()
+        outgoing = [(_checkpoint_payload(data), status) for data, status in items]
+        generation = os.urandom(8).hex()
+        previous = self._checkpointed_outgoing
+        # from now on, fetched data pieces are recorded for the new checkpoint
+        self._checkpointed_outgoing = (generation, {id(status): i for i, (_, status) in enumerate(items)})
+        snapshot = {'version': CHECKPOINT_VERSION,
+                    'id': self.id,
+                    'generation': generation,
+                    'state': self.current_state.name,
+                    'send_counter': self.send_counter,
+                    'receive_counter': self.receive_counter,
+                    'collective_counter': self.collective_counter,
+                    'transition_log': self.transition_log,
+                    'delta_received': self.delta_received,
+                    'data_outgoing': outgoing,
+                    'data_incoming': incoming,
+                    'internal': {key: value for key, value in self.internal.items()
+                                 if key not in self.checkpoint_exclude}}
+        path = os.path.join(self.checkpoint_dir, CHECKPOINT_FILE)
+        try:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            size = 0
+            with open(path + '.tmp', 'wb') as file:
+                for part in _frame_parts(snapshot):
+                    file.write(part)
+                    size += memoryview(part).nbytes
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(path + '.tmp', path)
+        except Exception:  # a failed checkpoint must not stop the workflow  # noqa
+            self._checkpointed_outgoing = previous
+            self.log(f'checkpoint failed:\n{traceback.format_exc()}', level=LogLevel.ERROR)
+            return False
+        try:
+            self._prune_fetched(generation)
+        except OSError:
+            # records of previous checkpoints are ignored when resuming anyway
+            pass
+        self._transitions_since_checkpoint = 0
+        self._last_checkpoint = monotonic()
+        self.log(f'checkpoint before state {snapshot["state"]}: {size} bytes in {perf_counter() - start:.3f}s')
+        return True
+
+    def resume(self) -> bool:
+        """ Restores the workflow from the checkpoint in checkpoint_dir, if
+            there is one that was written by this client. Arrays and large
+            data pieces are memory-mapped from the checkpoint file, so they
+            are only read when used.
+
+        Returns
+        -------
+        bool
+            whether the workflow was restored
+
+        """
+        path = os.path.join(self.checkpoint_dir, CHECKPOINT_FILE)
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return False
+        with open(path, 'rb') as file:
+            # copy-on-write, so restored arrays are writable without modifying the file
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        snapshot = _loads_frame(mapping)
+        if snapshot.get('version', 0) > CHECKPOINT_VERSION:
+            self.log(f'checkpoint {path} was written by a newer version, starting from the beginning',
+                     level=LogLevel.ERROR)
+            return False
+        if snapshot['id'] != self.id:
+            self.log(f'checkpoint {path} belongs to client {snapshot["id"]}, starting from the beginning',
+                     level=LogLevel.ERROR)
+            return False
+        state = self.states.get(snapshot['state'])
+        if state is None:
+            self.log(f'state {snapshot["state"]} of checkpoint {path} not found', level=LogLevel.FATAL)
+        self.internal.update(snapshot['internal'])
+        self.send_counter = snapshot['send_counter']
+        self.receive_counter = snapshot['receive_counter']
+        self.collective_counter = snapshot.get('collective_counter', 0)
+        self.transition_log = snapshot['transition_log']
+        self.delta_received = snapshot.get('delta_received', {})
+        # data pieces not fetched before the checkpoint, queued in front of
+        # anything sent since the start; pieces fetched after the checkpoint
+        # was written are not sent again, receivers would count them twice
+        generation = snapshot.get('generation')
+        fetched = self._read_fetched(generation)
+        outgoing = [(i, data, status) for i, (data, status) in enumerate(snapshot.get('data_outgoing', []))
+                    if i not in fetched]
+        for _, data, status in reversed(outgoing):
+            self.data_outgoing.appendleft(data, status)
+        self._checkpointed_outgoing = (generation, {id(status): i for i, _, status in outgoing})
+        for memo, pieces in snapshot.get('data_incoming', {}).items():
+            for data, client in pieces:
+                self.handle_incoming(data, client, memo=memo)
+        self.current_state = state
+        self.status_message = state.name
+        self.log(f'resumed in state {state.name} after {len(self.transition_log)} transitions')
+        return True
+
+    def remove_checkpoint(self):
+        """ Removes the checkpoint, and checkpoint_dir if it is empty
+            afterwards, e.g. once the workflow finished.
+
+        """
+        path = os.path.join(self.checkpoint_dir, CHECKPOINT_FILE)
+        for file in (path, path + '.tmp', os.path.join(self.checkpoint_dir, CHECKPOINT_FETCHED_FILE)):
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(self.checkpoint_dir)
+        except OSError:
+            # not empty or already removed
+            pass
+
+    def _record_fetched(self, status):
+        # appends the position of a data piece of the last checkpoint to
+        # CHECKPOINT_FETCHED_FILE once the controller fetched it
+        generation, positions = self._checkpointed_outgoing
+        position = positions.pop(id(status), None)
+        if position is None or self.checkpoint_dir is None:
+            return
+        try:
+            with self._fetched_lock, open(os.path.join(self.checkpoint_dir, CHECKPOINT_FETCHED_FILE), 'a') as file:
+                file.write(f'{generation} {position}\n')
+                file.flush()
+                os.fsync(file.fileno())
+        except OSError:
+            self.log(f'recording a fetched data piece failed:\n{traceback.format_exc()}', level=LogLevel.ERROR)
+
+    def _read_fetched(self, generation):
+        # positions of the data pieces of the checkpoint with the given
+        # generation that were fetched after it was written
+        try:
+            with open(os.path.join(self.checkpoint_dir, CHECKPOINT_FETCHED_FILE)) as file:
+                lines = [line.split() for line in file]
+        except FileNotFoundError:
+            return set()
+        return {int(line[1]) for line in lines if len(line) == 2 and line[0] == generation}
+
+    def _prune_fetched(self, generation):
+        # drops the records of previous checkpoints
+        path = os.path.join(self.checkpoint_dir, CHECKPOINT_FETCHED_FILE)
+        with self._fetched_lock:
+            fetched = self._read_fetched(generation)
+            if not fetched:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                return
+            with open(path + '.tmp', 'w') as file:
+                file.writelines(f'{generation} {position}\n' for position in sorted(fetched))
+            os.replace(path + '.tmp', path)
+
+    def render_metrics(self) -> str:
+        """ Returns all metrics, including the current state of the data
+            queues, in the Prometheus text format.
+
+        """
+        queue = self.data_outgoing.stats()
+        incoming = self.incoming_stats()
+        return self.metrics.render({
+            ('fc_outgoing_queue_depth', ()): queue['depth'],
+            ('fc_outgoing_queue_bytes', ()): queue['bytes'],
+            ('fc_incoming_pieces', ()): incoming['pieces'],
+            ('fc_incoming_memory_bytes', ()): incoming['bytes_in_memory'],
+            ('fc_incoming_spilled_bytes_total', ()): incoming['spilled_bytes'],
+        })
+
+    def dump_metrics(self, path: str):
+        """ Writes all metrics in the Prometheus text format to a file.
+
+        Parameters
+        ----------
+        path: str
+
+        """
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as file:
+                file.write(self.render_metrics())
+        except OSError as e:
+            self.log(f'could not write metrics to {path}: {e}', level=LogLevel.ERROR)
+
+    def dump_trace(self, path: str):
+        """ Writes the recorded trace in the Chrome trace event format, see
+            configure_tracing.
+
+        Parameters
+        ----------
+        path: str
+
+        """
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.tracer.dump(path)
+        except OSError as e:
+            self.log(f'could not write the trace to {path}: {e}', level=LogLevel.ERROR)
+
+    def start_preload(self):
+        """ Runs all preload hooks, one after another in the order they were
+            registered, in a background thread. Subsequent calls do nothing.
+
+        """
+        if self._preload_thread is not None:
+            return
+        self._preload_thread = threading.Thread(target=self._run_preload, daemon=True)
+        self._preload_thread.start()
+
+    def _run_preload(self):
+        try:
+            for hook in self.preload_hooks:
+                start = perf_counter()
+                hook(self)
+                self.log(f'preload {hook.__name__}: {perf_counter() - start:.3f}s')
+        except Exception as e:  # reported once the workflow starts  # noqa
+            self.log(traceback.format_exc(), level=LogLevel.ERROR)
+            self._preload_error = e
+        finally:
+            self._preload_done.set()
+
+    def wait_preload(self, timeout: Union[float, None] = None) -> bool:
+        """ Waits until all preload hooks are done.
+
+        Parameters
+        ----------
+        timeout: float or None, default=None
+            maximum seconds to wait, None waits until they are done
+
+        Returns
+        -------
+        bool
+            whether all preload hooks are done
+
+        """
+        return self._preload_done.wait(timeout)
+
+    @property
+    def ready(self) -> bool:
+        """ Whether all preload hooks are done, i.e. the app is warmed up.
+
+        """
+        return self._preload_done.is_set()
 
     def get_current_status(self, **kwargs):
         status = dict()
@@ -338,29 +1105,467 @@ class App:
             Id of the client that Sent the data
 
         """
-        if memo not in self.data_incoming:
-            self.data_incoming[memo] = [(data, client)]
-        else:
-            self.data_incoming[memo].append((data, client))
+        with self._incoming_lock:
+            if memo not in self.data_incoming:
+                self.data_incoming[memo] = [(data, client)]
+            else:
+                self.data_incoming[memo].append((data, client))
+            now = monotonic()
+            self._incoming_first.setdefault(memo, now)
+            self._incoming_times[memo] = now
+            self._incoming_bytes += _memory_size(data)
+            over_budget = self.incoming_budget is not None and self._incoming_bytes > self.incoming_budget
+            condition = self._incoming_conditions.get(memo)
+            if condition is not None:
+                # wake up the state waiting for this memo
+                condition.notify_all()
+        self.metrics.inc('fc_received_bytes_total', _payload_size(data), memo=_memo_label(memo), client=client)
+        self.tracer.incoming_received(_memo_label(memo), client, _payload_size(data))
+        self.metrics.inc('fc_received_messages_total', memo=_memo_label(memo), client=client)
+        if self.incoming_ttl is not None:
+            self.evict_stale_incoming()
+        if over_budget:
+            self._spill_incoming()
+
+    def _take_incoming(self, memo, n):
+        """ Removes and returns up to n data pieces with the given memo from
+            data_incoming. Must be called while holding `_incoming_lock`.
+
+        Parameters
+        ----------
+        memo: str
+            the (URL-encoded) memo of the data pieces
+        n: int
+            maximum number of data pieces
+
+        Returns
+        -------
+        list of tuples (data, client)
+        """
+        pieces = self.data_incoming[memo][:n]
+        self.data_incoming[memo] = self.data_incoming[memo][n:]
+        if len(self.data_incoming[memo]) == 0:
+            # clean up the dict regularly
+            del self.data_incoming[memo]
+            first = self._incoming_first.pop(memo, None)
+            last = self._incoming_times.pop(memo, None)
+            if first is not None and last is not None:
+                self.metrics.set('fc_round_spread_seconds', last - first, memo=_memo_label(memo))
+        for data, _ in pieces:
+            self._incoming_bytes -= _memory_size(data)
+        self.tracer.incoming_consumed(_memo_label(memo), len(pieces))
+        return pieces
+
+    def _spill_incoming(self):
+        """ Moves received data pieces into memory-mapped temporary files
+            until the data kept in memory fits into incoming_budget. Data
+            pieces of memos nobody waits for yet are spilled first, the oldest
+            first.
+
+        """
+        with self._spill_lock:
+            with self._incoming_lock:
+                excess = self._incoming_bytes - self.incoming_budget
+                memos = sorted(self.data_incoming, key=lambda m: (m in self._incoming_conditions,
+                                                                  self._incoming_times.get(m, 0)))
+                victims = []
+                for memo in memos:
+                    for piece in self.data_incoming[memo]:
+                        if excess <= 0:
+                            break
+                        if isinstance(piece[0], (bytes, bytearray)) and len(piece[0]) >= INCOMING_SPILL_MIN_SIZE:
+                            victims.append((memo, piece))
+                            excess -= len(piece[0])
+            for memo, piece in victims:
+                # written outside the lock, so states can take other data meanwhile
+                spilled = _spill(piece[0], self.incoming_spill_dir)
+                with self._incoming_lock:
+                    pieces = self.data_incoming.get(memo, [])
+                    for i, other in enumerate(pieces):
+                        if other is piece:
+                            pieces[i] = (spilled, piece[1])
+                            self._incoming_bytes -= len(piece[0])
+                            self.incoming_spilled += 1
+                            self.incoming_spilled_bytes += len(piece[0])
+                            break
+                    else:
+                        # taken by a state while it was written
+                        spilled.close()
+
+    def evict_stale_incoming(self, ttl: Union[float, None] = None):
+        """ Removes the data pieces of memos that no state waits for and that
+            did not receive data for ttl seconds, e.g. data sent with a
+            mistyped memo or for a round that never comes. Each eviction is
+            logged and recorded in incoming_evictions.
+
+        Parameters
+        ----------
+        ttl: float or None, default=None
+            seconds after the last data piece of a memo arrived, incoming_ttl
+            if None
+
+        Returns
+        -------
+        list of dicts describing the evicted memos
+        """
+        ttl = self.incoming_ttl if ttl is None else ttl
+        if ttl is None:
+            return []
+        now = monotonic()
+        evicted = []
+        with self._incoming_lock:
+            for memo in list(self.data_incoming):
+                age = now - self._incoming_times.get(memo, now)
+                if memo in self._incoming_conditions or age <= ttl:
+                    continue
+                pieces = self._take_incoming(memo, len(self.data_incoming[memo]))
+                evicted.append({'memo': memo, 'pieces': len(pieces),
+                                'clients': [client for _, client in pieces],
+                                'bytes': sum(_payload_size(data) for data, _ in pieces),
+                                'age': age, 'time': datetime.datetime.now()})
+            self.incoming_evictions.extend(evicted)
+        for eviction in evicted:
+            self.log(f'evicted {eviction["pieces"]} data pieces ({eviction["bytes"]} bytes) with memo '
+                     f'<{eviction["memo"]}> from {eviction["clients"]}, nobody waited for them for '
+                     f'{eviction["age"]:.0f} seconds', level=LogLevel.ERROR)
+        return evicted
+
+    def incoming_stats(self):
+        """ Returns counters describing the received data that was not
+            taken by a state yet.
+
+        Returns
+        -------
+        dict
+        """
+        with self._incoming_lock:
+            return {'memos': len(self.data_incoming),
+                    'pieces': sum(len(pieces) for pieces in self.data_incoming.values()),
+                    'bytes_in_memory': self._incoming_bytes,
+                    'spilled': self.incoming_spilled,
+                    'spilled_bytes': self.incoming_spilled_bytes,
+                    'evicted': len(self.incoming_evictions)}
+
+    def _incoming_condition(self, memo):
+        """ Returns the condition variable used to wait for data pieces with
+            the given memo. Must be called while holding `_incoming_lock`.
+
+        Parameters
+        ----------
+        memo: str
+            the (URL-encoded) memo of the data pieces
+
+        """
+        condition = self._incoming_conditions.get(memo)
+        if condition is None:
+            condition = threading.Condition(self._incoming_lock)
+            self._incoming_conditions[memo] = condition
+        return condition
+
+    def compress_outgoing(self, data, compression: Union[Compression, None] = None):
+        """ Compresses serialized data before it is added to the outgoing
+            queue.
+
+        Parameters
+        ----------
+        data: bytes or _FrameParts
+            serialized data, parts of a frame are joined to be compressed
+        compression: Compression or None, default=None
+            the codec to use, if None, default_compression is used
+
+        Returns
+        -------
+        compressed data (with a header describing the codec) or the data itself
+
+        """
+        if compression is None:
+            compression = self.default_compression
+        if compression != Compression.NONE and isinstance(data, _FrameParts):
+            data = data.join()
+        if compression == Compression.AUTO:
+            if self.compression_selector is None:
+                self.compression_selector = CompressionSelector(level=self.compression_level)
+            compression = self.compression_selector.select(data)
+        return compress(data, compression, self.compression_level)
+
+    def serialize_outgoing(self, data, is_json=False, joined=True):
+        """ Serializes data to be sent out and records the time it took.
+
+        Parameters
+        ----------
+        data: object
+        is_json: bool, default=False
+        joined: bool, default=True
+            if False, a frame is returned as _FrameParts without joining its
+            parts (see configure_serialization)
+
+        Returns
+        -------
+        serialized data
+
+        """
+        with self.metrics.timer('fc_serialize_seconds_total'):
+            data = _serialize_outgoing(data, is_json=is_json, metadata=self._delta_metadata(), joined=joined)
+        self.metrics.inc('fc_serialize_bytes_total', _payload_size(data))
+        return data
+
+    def deserialize_incoming(self, data, is_json=False, client=None):
+        """ Deserializes a received data piece and records the time it took.
+
+        Parameters
+        ----------
+        data: bytes-like or str
+        is_json: bool, default=False
+        client: str or None, default=None
+            ID of the client that sent the data piece, see resolve_incoming
+
+        Returns
+        -------
+        deserialized data
+
+        """
+        size = _payload_size(data)
+        with self.metrics.timer('fc_deserialize_seconds_total'):
+            data, metadata = _deserialize_incoming(data, is_json=is_json, with_metadata=True)
+        self.metrics.inc('fc_deserialize_bytes_total', size)
+        return self.resolve_incoming(data, metadata, client)
+
+    def deserialize_pieces(self, pieces, is_json=False, lazy: Union[bool, None] = None):
+        """ Deserializes received data pieces, in parallel if more than one
+            deserialization worker is configured, or returns LazyData handles.
+
+        Parameters
+        ----------
+        pieces: list
+            tuples (serialized data, client ID)
+        is_json: bool, default=False
+        lazy: bool or None, default=None
+            if True, LazyData handles are returned. If None, 
+            lazy_deserialization is used
+
+        Returns
+        -------
+        list of deserialized data pieces or LazyData handles
+
+        """
+        if lazy is None:
+            lazy = self.lazy_deserialization
+        if lazy:
+            return [LazyData(data, client, is_json=is_json, resolve=self.resolve_incoming) for data, client in pieces]
+        if self.deserialization_workers <= 1 or len(pieces) <= 1:
+            return [self.deserialize_incoming(data, is_json=is_json, client=client) for data, client in pieces]
+        size = sum(_payload_size(data) for data, _ in pieces)
+        with self.metrics.timer('fc_deserialize_seconds_total'):
+            results = self._deserialize_parallel(pieces, is_json)
+        self.metrics.inc('fc_deserialize_bytes_total', size)
+        return results
+
+    def _deserialize_parallel(self, pieces, is_json):
+        if self._deserialization_pool is None:
+            if self.deserialization_processes:
+                self._deserialization_pool = concurrent.futures.ProcessPoolExecutor(self.deserialization_workers)
+            else:
+                self._deserialization_pool = concurrent.futures.ThreadPoolExecutor(
+                    self.deserialization_workers, thread_name_prefix='deserialize')
+        data = [d for d, _ in pieces]
+        if self.deserialization_processes:
+            # memory maps (spooled data) cannot be sent to other processes
+            data = [d if isinstance(d, (bytes, bytearray, str, _Loopback)) else bytes(d) for d in data]
+        results = [d.get() if isinstance(d, _Loopback) else None for d in data]
+        serialized = [i for i, d in enumerate(data) if not isinstance(d, _Loopback)]
+        values = self._deserialization_pool.map(_deserialize_incoming, [data[i] for i in serialized],
+                                                [is_json] * len(serialized), [True] * len(serialized))
+        for i, (value, metadata) in zip(serialized, values):
+            results[i] = self.resolve_incoming(value, metadata, pieces[i][1])
+        return results
+
+    def resolve_incoming(self, data, metadata: bytes = b'', client=None):
+        """ Processes a deserialized data piece: records the versions of
+            delta broadcasts the sender holds (sent in the frame metadata)
+            and reconstructs delta broadcasts into the full data.
+
+        Parameters
+        ----------
+        data: object
+            the deserialized data piece
+        metadata: bytes, default=b''
+            metadata of the frame the data piece was sent in
+        client: str or None, default=None
+            ID of the client that sent the data piece. The versions are only
+            recorded if the sender wrote the metadata itself, data forwarded
+            without deserializing it carries the metadata of another client
+
+        Returns
+        -------
+        the data piece, or the full data of a delta broadcast
+
+        """
+        if metadata and client is not None:
+            info = json.loads(metadata)
+            if info.get('versions') is not None and info.get('client') == client:
+                with self._delta_lock:
+                    self.delta_acks[client] = info['versions']
+        if not isinstance(data, Delta):
+            return data
+        with self._delta_lock:
+            if data.base is None:
+                arrays = []
+                _map_leaves(data.value, lambda leaf: isinstance(leaf, np.ndarray) and arrays.append(leaf) or leaf)
+                # the receiving state gets the arrays, a copy is kept as base
+                self.delta_received[data.key] = [data.version, [np.array(a, copy=True, order='C') for a in arrays]]
+                return data.value
+            received = self.delta_received.get(data.key)
+            if received is None or received[0] != data.base:
+                self.log(f'delta broadcast {data.key} version {data.version} needs version {data.base}, '
+                         f'but version {received[0] if received else None} is held', level=LogLevel.FATAL)
+            patches = []
+            _map_leaves(data.value, lambda leaf: isinstance(leaf, ArrayPatch) and patches.append(leaf) or leaf)
+            apply_patches(received[1], patches)
+            received[0] = data.version
+            arrays = iter(received[1])
+            return _map_leaves(data.value,
+                               lambda leaf: np.array(next(arrays), copy=True) if isinstance(leaf, ArrayPatch) else leaf)
+
+    def encode_delta(self, key: str, data, clients):
+        """ Encodes data as the next version of the versioned data key: as
+            patches against the previous version if all given clients hold
+            it, otherwise as a full snapshot.
+
+        Parameters
+        ----------
+        key: str
+            name of the versioned data
+        data: object
+            the full data
+        clients: list of str
+            the clients receiving the data
+
+        Returns
+        -------
+        Delta
+
+        """
+        arrays = []
+        _map_leaves(data, lambda leaf: isinstance(leaf, np.ndarray) and arrays.append(leaf) or leaf)
+        # the whole read-modify-write of the sent version, so concurrent
+        # broadcasts of the same key get consecutive versions
+        with self._delta_lock:
+            sent = self.delta_sent.get(key)
+            version = sent[0] + 1 if sent is not None else 1
+            in_sync = sent is not None and len(sent[1]) == len(arrays) \
+                and all(self.delta_acks.get(client, {}).get(key) == sent[0] for client in clients)
+            if not in_sync:
+                self.delta_sent[key] = [version, [np.array(a, copy=True, order='C') for a in arrays]]
+            else:
+                patches = iter(diff_arrays(sent[1], arrays))
+                base = sent[0]
+                sent[0] = version
+        if not in_sync:
+            self.metrics.inc('fc_delta_broadcasts_total', key=key, kind='snapshot')
+            return Delta(key, version, None, data)
+        self.metrics.inc('fc_delta_broadcasts_total', key=key, kind='delta')
+        return Delta(key, version, base, _map_leaves(data, lambda leaf: next(patches)
+                                                     if isinstance(leaf, np.ndarray) else leaf))
+
+    def _delta_metadata(self):
+        # the versions of delta broadcasts this client holds, sent along with
+        # all data (see resolve_incoming)
+        if not self.delta_received:
+            return b''
+        with self._delta_lock:
+            versions = {key: received[0] for key, received in self.delta_received.items()}
+        return json.dumps({'client': self.id, 'versions': versions}).encode()
+
+    def __setattr__(self, name, value):
+        # any change of a status_* attribute invalidates the cached status
+        changed = name.startswith('status_') and getattr(self, name, value) != value
+        object.__setattr__(self, name, value)
+        if changed:
+            self._invalidate_status()
+
+    def _invalidate_status(self):
+        with self._status_condition:
+            self._status_version += 1
+            self._status_condition.notify_all()
+
+    @property
+    def status_version(self) -> int:
+        """ Number increased whenever the status served to the controller
+            may have changed, i.e. a status_* attribute or the outgoing queue
+            changed.
+
+        """
+        return self._status_version
 
     def handle_status(self):
         """ This informs if there is any data to be sent as well as the way
             data should be send
         """
-        self.status_message = self.status_message if self.status_message else (self.current_state.name if self.current_state else None)
-        # ensure that some message is set 
-        if len(self.data_outgoing) == 0:
-            # no data to send, just return the default status with available=false
-            return self.get_current_status(available=False)
-        
-        # else take the status from the data to be sent out next. The whole 
-        # data, status combination gets popped in the next handle_outgoing 
-        # function call by the next GET request from the controller, so here 
-        # the status and data itself must still be kept in the list
+        return self._serve_status()[1]
 
-        _, status = self.data_outgoing[0]
-        self.last_send_status = status
-        return status
+    def handle_status_encoded(self):
+        """ Like handle_status, but returns the status encoded as JSON. The
+            encoding is cached until the status changes.
+
+        Returns
+        -------
+        tuple (status_version: int, status: bytes)
+        """
+        version, _, encoded = self._serve_status()
+        return version, encoded
+
+    def _serve_status(self):
+        if not self.status_message:
+            # ensure that some message is set
+            self.status_message = self.current_state.name if self.current_state else None
+        with self._status_condition:
+            version = self._status_version
+            cached = self._status_cache
+        if cached is None or cached[0] != version:
+            status = self.data_outgoing.peek_status()
+            queued = status is not None
+            if not queued:
+                # no data to send, just return the default status with available=false
+                status = self.get_current_status(available=False)
+            cached = (version, status, _encode_status(status), queued)
+            with self._status_condition:
+                if self._status_version == version:
+                    self._status_cache = cached
+        _, status, encoded, queued = cached
+        if queued:
+            # else take the status from the data to be sent out next. The whole
+            # data, status combination gets popped in the next handle_outgoing
+            # function call by the next GET request from the controller, so here
+            # the status and data itself must still be kept in the queue
+            self.last_send_status = status
+            self.tracer.outgoing_advertised(status)
+            if status is self._final_status:
+                # the final status is only queued behind all other data, so
+                # everything was sent out once the controller fetches it
+                self._shutdown_event.set()
+        return version, status, encoded
+
+    def wait_status(self, timeout: float, version: Union[int, None] = None) -> bool:
+        """ Blocks until data is available to be sent out or, if a status
+            version is given, until the status changed from that version.
+            Used for long-polling the status.
+
+        Parameters
+        ----------
+        timeout: float
+            maximum seconds to wait
+        version: int or None, default=None
+            the status version the caller knows
+
+        Returns
+        -------
+        bool
+            False if the timeout passed without a change
+        """
+        with self._status_condition:
+            if version is None:
+                return self._status_condition.wait_for(lambda: len(self.data_outgoing) > 0, timeout)
+            return self._status_condition.wait_for(lambda: self._status_version != version, timeout)
         
     def handle_outgoing(self):
         """ When it is requested to send some data to other client/s
@@ -369,21 +1574,30 @@ class App:
             self.data_outgoing
 
         """
-        if len(self.data_outgoing) == 0:
+        # extract current data to be sent, it is only removed if the last 
+        # status request was answered with the same status as the data is 
+        # supposed to be sent with
+        # we just compare the status dicts
+        item = self.data_outgoing.pop_matching(self.last_send_status)
+        if item is None:
             # no data to send
             return None
-        
-        # extract current data to be sent
-        data, status = self.data_outgoing.pop(0)
+        data, status = item
 
-        # check if the last status request was answered with the same status
-        # as the data is supposed to be sent with
-        # we just compare the JSON strings
         if status != self.last_send_status:
             raise Exception("Race condition error, the controller got sent a" +
                 "different GET/status object that the one intended with this data object."+
                 "Needed status object: {}, actual status object: {}".format(
                 status, self.last_send_status))
+        destination = status.get('destination') if isinstance(status, dict) else None
+        if destination is None:
+            destination = 'all' if self.coordinator else 'coordinator'
+        memo = _memo_label(status.get('memo') if isinstance(status, dict) else None)
+        self.metrics.inc('fc_sent_bytes_total', _payload_size(data), memo=memo, destination=destination)
+        self.metrics.inc('fc_sent_messages_total', memo=memo, destination=destination)
+        self.tracer.outgoing_fetched(status, memo, _payload_size(data))
+        if self._checkpointed_outgoing[1]:
+            self._record_fetched(status)
 
         # status is fine, send data out
         return data
@@ -474,6 +1688,9 @@ class App:
             self.log(f'cannot perform transition {name} as coordinator', level=LogLevel.FATAL)
 
         self.transition_log.append((datetime.datetime.now(), name))
+        if self.tracer.enabled:
+            # data pieces removed from the queue without being fetched are not traced
+            self.tracer.outgoing_retain([status for _, status in self.data_outgoing.items()])
         self.current_state = transition[1]
         self.status_message = self.current_state.name
 
@@ -489,14 +1706,13 @@ class App:
             determines the channel (stdout, stderr) or whether to trigger an exception
         """
 
-        msg = f'[Time: {datetime.datetime.now().strftime("%d.%m.%y %H:%M:%S")}] [Level: {level.value}] {msg}'
-
         if level == LogLevel.FATAL:
-            raise RuntimeError(msg)
-        if level == LogLevel.ERROR:
-            print(msg, flush=True, file=sys.stderr)
-        else:
-            print(msg, flush=True)
+            raise RuntimeError(f'[Time: {datetime.datetime.now().strftime("%d.%m.%y %H:%M:%S")}] '
+                               f'[Level: {level.value}] {msg}')
+        if _LOG_LEVEL_ORDER[level] < _LOG_LEVEL_ORDER[self.log_level]:
+            return
+        # formatted and written by the background thread of the log writer
+        self.log_writer.write(msg, level.value, error=level == LogLevel.ERROR)
 
 class AppState(abc.ABC):
     """ Defining custom states
@@ -591,13 +1807,16 @@ class AppState(abc.ABC):
         self._app.register_transition(f'{self.name}_{name}', self.name, target, participant, coordinator, label)
 
     def aggregate_data(self, operation: SMPCOperation = SMPCOperation.ADD, use_smpc=False,
-                       use_dp=False, memo=None):
+                       use_dp=False, memo=None, weights: Union[Dict[str, float], None] = None,
+                       mean=False, as_numpy=False):
         """
         Waits for all participants (including the coordinator instance) 
         to send data and returns the aggregated value. Will try to convert
         each data piece to a np.array and aggregate those arrays.
         Therefore, this method only works for numerical data and all datapieces
-        should be addable.
+        should be addable. Data pieces may also be nested dicts, lists or 
+        tuples of arrays (e.g. the layers of a model), which are aggregated
+        leaf by leaf.
 
         Parameters
         ----------
@@ -616,34 +1835,261 @@ class AppState(abc.ABC):
             over the same communication round and that a different string is 
             used for each communication round. This ensures that no race 
             condition problems occur
+        weights : dict or None, default=None
+            maps each client ID to the weight of its data piece, e.g. the 
+            number of samples, to compute a weighted sum (only with 
+            SMPCOperation.ADD and without SMPC)
+        mean : bool, default=False
+            if True, the (weighted) mean is returned instead of the sum (only
+            with SMPCOperation.ADD)
+        as_numpy : bool, default=False
+            if True, the numerical lists of an SMPC aggregate are returned as
+            numpy arrays, as without SMPC (always the case with mean)
         Returns
         -------
         aggregated value
         """
+        if weights is not None and (use_smpc or operation != SMPCOperation.ADD):
+            self._app.log('weights can only be used with SMPCOperation.ADD and without SMPC',
+                          level=LogLevel.FATAL)
+        if mean and operation != SMPCOperation.ADD:
+            self._app.log('mean can only be used with SMPCOperation.ADD', level=LogLevel.FATAL)
         if not memo:
             self._app.receive_counter += 1
             memo = f"GATHERROUND{self._app.receive_counter}"
         # we need to use the urlencoded memo as this is what we reiceive
         memo = urllib.parse.quote(memo)
         if use_smpc:
-            return self.await_data(n=1, unwrap=True, is_json=True, memo=memo)  
+            data = self.await_data(n=1, unwrap=True, is_json=True, memo=memo)
               # Data is aggregated already
+            if mean:
+                leaves, treedef = _flatten(data)
+                data = _unflatten(treedef, [leaf / len(self._app.clients) for leaf in leaves])
+            elif as_numpy:
+                data = _numeric_to_numpy(data)
+            return data
         else:
-            data = self.gather_data(is_json=use_dp, memo=memo)
-            return _aggregate(data, operation)  
-              # Data needs to be aggregated according to operation
-
-    def gather_data(self, is_json=False, use_smpc=False, use_dp=False, memo=None):
+            if not self._app.coordinator:
+                self._app.log('must be coordinator to use aggregate_data', level=LogLevel.FATAL)
+            if weights is not None:
+                missing = [client for client in self._app.clients if client not in weights]
+                if missing:
+                    self._app.log(f'no weights given for clients {missing}', level=LogLevel.FATAL)
+            # the memo is quoted once more each by gather_data and await_data,
+            # keep it that way to stay compatible with the data of the senders
+            memo = urllib.parse.quote(urllib.parse.quote(memo))
+            # Data needs to be aggregated according to operation, each data
+            # piece is added as soon as it arrives and freed afterwards
+            aggregator = _Aggregator(operation, mean=mean)
+            for data, client in self._iter_pieces(len(self._app.clients), memo):
+                weight = weights[client] if weights is not None else None
+                # sparse and quantized arrays are added without decoding them first
+                with keep_encoded():
+                    data = self._app.deserialize_incoming(data, is_json=use_dp, client=client)
+                aggregator.add(data, weight)
+                del data
+            return aggregator.result()
+
+    def aggregate_tree(self, data, operation: SMPCOperation = SMPCOperation.ADD, memo=None,
+                       weight: Union[float, None] = None, mean=False, fan_in: int = TREE_FAN_IN):
         """
-        Waits for all participants (including the coordinator instance) to send data and returns a list containing the received data pieces. Only valid for the coordinator instance.
+        Aggregates the data of all clients along a tree instead of sending
+        all data pieces to the coordinator. Must be called by all clients 
+        (including the coordinator) with their own data piece. Each client
+        waits for the partial aggregates of its children, adds its own data
+        piece and sends the result to its parent (with 
+        send_data_to_participant), so the coordinator at the root only
+        receives fan_in pre-aggregated data pieces. The tree is built from
+        the order of the client IDs, the same on all clients.
+        Data pieces can be anything aggregate_data accepts. SMPC and DP are
+        not supported, the partial aggregates are never encoded sparsely or
+        quantized, and the coordinatorID must be known (see handle_setup).
 
         Parameters
         ----------
-        is_json : bool, default=False
-            [deprecated] when data was sent via DP or SMPC, the data is sent in
-            JSON serialization. This was used to indicate this but is now 
-            DEPRICATED, use use_smpc/use_dp accordingly instead, they will take
-            care of serialization automatically.
+        data : object
+            the data piece of this client
+        operation : SMPCOperation, default=SMPCOperation.ADD
+            specifies the aggregation type
+        memo : str or None, default=None
+            the string identifying this aggregation, the same on all clients.
+            If None, an automated memo is used, which requires all clients to
+            make the same aggregate_tree calls
+        weight : float or None, default=None
+            weight of the data piece of this client, e.g. the number of 
+            samples, for a weighted sum (only with SMPCOperation.ADD)
+        mean : bool, default=False
+            if True, the (weighted) mean is returned instead of the sum (only
+            with SMPCOperation.ADD)
+        fan_in : int, default=TREE_FAN_IN
+            maximum number of children of each client. With 
+            fan_in >= len(clients) - 1, all participants send to the 
+            coordinator directly
+        Returns
+        -------
+        aggregated value on the coordinator, None on the participants
+        """
+        if operation != SMPCOperation.ADD and (weight is not None or mean):
+            self._app.log('weight and mean can only be used with SMPCOperation.ADD', level=LogLevel.FATAL)
+        if fan_in < 1:
+            self._app.log('fan_in must be at least 1', level=LogLevel.FATAL)
+        if self._app.coordinatorID not in self._app.clients:
+            # the participants cannot tell the root of the tree otherwise
+            self._app.log('aggregate_tree needs the ID of the coordinator (coordinatorID of /setup)',
+                          level=LogLevel.FATAL)
+        if not memo:
+            self._app.collective_counter += 1
+            memo = f"TREEROUND{self._app.collective_counter}"
+        memo = str(memo)
+        # the coordinator is the root, the participants follow in the order
+        # of their IDs; client i has the children fan_in * i + 1, ..., fan_in * i + fan_in
+        order = [self._app.coordinatorID] + sorted(c for c in self._app.clients if c != self._app.coordinatorID)
+        position = order.index(self._app.id)
+        children = order[fan_in * position + 1:fan_in * position + fan_in + 1]
+
+        aggregator = _Aggregator(operation)
+        aggregator.add(data, weight)
+        total_weight = 1.0 if weight is None else weight
+        for piece, client in self._iter_pieces(len(children), urllib.parse.quote(memo)):
+            with keep_encoded():
+                partial, partial_weight = self._app.deserialize_incoming(piece, client=client)
+            del piece
+            # the partial aggregates are weighted already
+            aggregator.add(partial)
+            total_weight += partial_weight
+            del partial
+        result = aggregator.result()
+        if position > 0:
+            parent = order[(position - 1) // fan_in]
+            # partial aggregates are sent as they are, re-sparsifying or
+            # re-quantizing them on every level would lose more of the update
+            # each time; only the data piece of a leaf is quantized, once
+            quantization = None if not children else Quantization.NONE
+            self.send_data_to_participant((result, total_weight), destination=parent, memo=memo, sparse=False,
+                                          quantization=quantization)
+            return None
+        if mean:
+            leaves, treedef = _flatten(result)
+            result = _unflatten(treedef, [_divide(leaf, total_weight) for leaf in leaves])
+        return result
+
+    def all_reduce(self, data, operation: SMPCOperation = SMPCOperation.ADD, memo=None,
+                   weight: Union[float, None] = None, mean=False):
+        """
+        Aggregates the data of all clients and returns the aggregate on every
+        client, using a ring all-reduce: the data is split into one chunk per
+        client, which are summed up while being passed around the ring of
+        clients (reduce-scatter) and then passed around once more to
+        distribute the sums (all-gather). Each client sends and receives
+        about 2 * (n - 1) / n times the size of the data, independent of the
+        number n of clients, instead of the coordinator receiving and
+        broadcasting n times the data. Must be called by all clients
+        (including the coordinator) with their own data piece.
+        Data pieces can be nested structures of numerical values and arrays
+        like with aggregate_data. SMPC and DP are not supported, and the
+        data is never encoded sparsely or quantized, as each chunk is
+        passed on again after every step.
+
+        Parameters
+        ----------
+        data : object
+            the data piece of this client
+        operation : SMPCOperation, default=SMPCOperation.ADD
+            specifies the aggregation type
+        memo : str or None, default=None
+            the string identifying this aggregation, the same on all clients.
+            If None, an automated memo is used, which requires all clients to
+            make the same all_reduce calls
+        weight : float or None, default=None
+            weight of the data piece of this client, e.g. the number of
+            samples, for a weighted sum (only with SMPCOperation.ADD)
+        mean : bool, default=False
+            if True, the (weighted) mean is returned instead of the sum (only
+            with SMPCOperation.ADD)
+        Returns
+        -------
+        aggregated value, on all clients
+        """
+        if operation != SMPCOperation.ADD and (weight is not None or mean):
+            self._app.log('weight and mean can only be used with SMPCOperation.ADD', level=LogLevel.FATAL)
+        if not memo:
+            self._app.collective_counter += 1
+            memo = f"ALLREDUCE{self._app.collective_counter}"
+        memo = str(memo)
+        leaves, treedef = _flatten(data)
+        # the leaves of each dtype in one vector, which is split into one
+        # chunk per client; the weight is reduced along in its own vector
+        dtypes = [leaf.dtype if weight is None else np.result_type(leaf, weight) for leaf in leaves]
+        groups = {dtype: [i for i, leaf_dtype in enumerate(dtypes) if leaf_dtype == dtype] for dtype in dtypes}
+        buffers = [np.concatenate([leaves[i].reshape(-1) for i in indices]).astype(dtype, copy=False)
+                   for dtype, indices in groups.items()]
+        if weight is not None:
+            for buffer in buffers:
+                np.multiply(buffer, weight, out=buffer)
+        buffers.append(np.array([1.0 if weight is None else weight]))
+
+        ring = sorted(self._app.clients)
+        n = len(ring)
+        rank = ring.index(self._app.id)
+        right = ring[(rank + 1) % n]
+        chunks = []
+        for buffer in buffers:
+            bounds = np.linspace(0, buffer.size, n + 1).astype(int)
+            chunks.append([buffer[bounds[i]:bounds[i + 1]] for i in range(n)])
+        reduce = np.multiply if operation == SMPCOperation.MULTIPLY else np.add
+        for step in range(n - 1):
+            # reduce-scatter: afterwards, this client holds the aggregate of chunk rank + 1
+            self.send_data_to_participant([parts[(rank - step) % n] for parts in chunks], destination=right,
+                                          memo=f'{memo}/reduce{step}', sparse=False,
+                                          quantization=Quantization.NONE)
+            received = self._receive_one(f'{memo}/reduce{step}')
+            for parts, values in zip(chunks, received):
+                chunk = parts[(rank - step - 1) % n]
+                reduce(chunk, values, out=chunk)
+        for step in range(n - 1):
+            # all-gather: pass the aggregated chunks on around the ring
+            self.send_data_to_participant([parts[(rank + 1 - step) % n] for parts in chunks], destination=right,
+                                          memo=f'{memo}/gather{step}', sparse=False,
+                                          quantization=Quantization.NONE)
+            received = self._receive_one(f'{memo}/gather{step}')
+            for parts, values in zip(chunks, received):
+                parts[(rank - step) % n][:] = values
+
+        total_weight = buffers.pop()[0]
+        result = [None] * len(leaves)
+        for buffer, indices in zip(buffers, groups.values()):
+            offset = 0
+            for i in indices:
+                value = buffer[offset:offset + leaves[i].size].reshape(leaves[i].shape)
+                offset += leaves[i].size
+                result[i] = _divide(value, total_weight) if mean else value
+        return _unflatten(treedef, result)
+
+    def _receive_one(self, memo):
+        """
+        Waits for the single data piece with the given memo and returns it
+        deserialized.
+
+        Parameters
+        ----------
+        memo : str
+            the memo, not URL-encoded
+        """
+        piece, client = self._await_pieces(1, urllib.parse.quote(memo))[0]
+        return self._app.deserialize_incoming(piece, client=client)
+
+    def gather_data(self, is_json=False, use_smpc=False, use_dp=False, memo=None,
+                    lazy: Union[bool, None] = None):
+        """
+        Waits for all participants (including the coordinator instance) to send data and returns a list containing the received data pieces. Only valid for the coordinator instance.
+
+        Parameters
+        ----------
+        is_json : bool, default=False
+            [deprecated] when data was sent via DP or SMPC, the data is sent in
+            JSON serialization. This was used to indicate this but is now 
+            DEPRICATED, use use_smpc/use_dp accordingly instead, they will take
+            care of serialization automatically.
         use_smpc: bool, default=False
             Indicated whether the data that is gather was sent using SMPC.
             If this is not set to True when data was sent using SMPC, this 
@@ -659,6 +2105,10 @@ class AppState(abc.ABC):
             over the same communication round and that a different string is 
             used for each communication round. This ensures that no race 
             condition problems occur
+        lazy : bool or None, default=None
+            if True, LazyData handles are returned that deserialize each data
+            piece on first access. If None, the setting of 
+            configure_deserialization is used
         Returns
         -------
         list of n data pieces, where n is the number of participants
@@ -676,10 +2126,10 @@ class AppState(abc.ABC):
         # we need to use the urlencoded memo as this is what we reiceive
         memo = urllib.parse.quote(memo)
         return self.await_data(n, unwrap=False, is_json=is_json, use_dp=use_dp,
-                               use_smpc=use_smpc, memo=memo)
+                               use_smpc=use_smpc, memo=memo, lazy=lazy)
 
     def await_data(self, n: int = 1, unwrap=True, is_json=False, 
-                   use_dp=False, use_smpc=False, memo=None):
+                   use_dp=False, use_smpc=False, memo=None, lazy: Union[bool, None] = None):
         """
         Waits for n data pieces and returns them. It is highly recommended to 
         use the memo variable when using this method
@@ -715,6 +2165,10 @@ class AppState(abc.ABC):
             over the same communication round and that a different string is 
             used for each communication round. This ensures that no race 
             condition problems occur.
+        lazy : bool or None, default=None
+            if True, LazyData handles are returned that deserialize each data
+            piece on first access (e.g. for states that only forward or count
+            data). If None, the setting of configure_deserialization is used
         Returns
         -------
         list of data pieces (if n > 1 or unwrap = False) or a single data piece (if n = 1 and unwrap = True)
@@ -724,6 +2178,34 @@ class AppState(abc.ABC):
             is_json = True
         if use_dp:
             is_json = True
+        memo = self._receive_memo(n, use_smpc, memo)
+
+        data = self._await_pieces(n, memo)
+
+        # deserialize outside of the lock, so incoming requests are not blocked
+        data = self._app.deserialize_pieces(data, is_json=is_json, lazy=lazy)
+        if n == 1 and unwrap:
+            return data[0]
+        else:
+            return data
+
+    def _receive_memo(self, n, use_smpc, memo):
+        """
+        Returns the URL-encoded memo to wait for. If no memo is given and this
+        is a gather/aggregate call of the coordinator, the automated memo is
+        used.
+
+        Parameters
+        ----------
+        n : int
+            number of data pieces to wait for
+        use_smpc : bool
+        memo : str or None
+
+        Returns
+        -------
+        URL-encoded memo
+        """
         if not memo and self._app.coordinator:
             # only increment for the coordinator to really avoid any p2p 
             # problems
@@ -747,36 +2229,208 @@ class AppState(abc.ABC):
         # we need to use the urlencoded memo as this is what we reiceive
         if memo:
             memo = urllib.parse.quote(memo)
+        return memo
 
-        while True:
-            num_data_pieces = 0
-            if memo in self._app.data_incoming:
-                num_data_pieces = len(self._app.data_incoming[memo])
-            if num_data_pieces >= n:
-                # warn if too many data pieces came in
-                if num_data_pieces > n:
-                    self._app.log(
-                        f"await was used to wait for {n} data pieces, " + 
-                        f"but more data pieces ({num_data_pieces}) were found. " +
-                        f"Used memo is <{memo}>",
-                        LogLevel.ERROR)
-                    
-                # extract and deseralize the data
-                data = self._app.data_incoming[memo][:n]
-                self._app.data_incoming[memo] = self._app.data_incoming[memo][n:]
-                if len(self._app.data_incoming[memo]) == 0:
-                    # clean up the dict regularly
-                    del self._app.data_incoming[memo]
-
-                if n == 1 and unwrap:
-                    return _deserialize_incoming(data[0][0], is_json=is_json)
-                else:
-                    return [_deserialize_incoming(d[0], is_json=is_json) for d in data]
-
-            sleep(DATA_POLL_INTERVAL)
+    def iter_data(self, n: int = 1, is_json=False, use_dp=False, memo=None,
+                  with_client=False):
+        """
+        Waits for n data pieces and yields each of them as soon as it arrives,
+        in the order of arrival. This allows processing data pieces (e.g. 
+        aggregating them) while waiting for slower clients, and the received
+        bytes of each data piece can be freed right after it was processed.
+
+        Parameters
+        ----------
+        n : int, default=1
+            number of data pieces to wait for
+        is_json : bool, default=False
+            [deprecated] use use_dp instead
+        use_dp : bool, default=False
+            if True, will assume that data was sent and modified with the
+            controllers differential privacy capacities
+        memo : str or None, default=None
+            RECOMMENDED TO BE SET FOR THIS METHOD!
+            the string identifying a specific communication round, see
+            await_data
+        with_client : bool, default=False
+            if True, tuples (data, client ID of the sender) are yielded
+
+        Yields
+        ------
+        each data piece (or tuple (data, client ID) if with_client = True)
+        """
+        if use_dp:
+            is_json = True
+        memo = self._receive_memo(n, False, memo)
+        for data, client in self._iter_pieces(n, memo):
+            data = self._app.deserialize_incoming(data, is_json=is_json, client=client)
+            yield (data, client) if with_client else data
+
+    def _iter_pieces(self, n, memo):
+        """
+        Yields n data pieces with the given memo one after another as soon as
+        they arrive, removing them from the incoming data.
+
+        Parameters
+        ----------
+        n : int
+            number of data pieces to wait for
+        memo : str or None
+            the URL-encoded memo
+
+        Yields
+        ------
+        tuples (serialized data, client ID)
+        """
+        remaining = n
+        waited = 0.0
+        while remaining > 0:
+            with self._app._incoming_lock:
+                condition = self._app._incoming_condition(memo)
+                start = perf_counter()
+                condition.wait_for(lambda: len(self._app.data_incoming.get(memo, [])) > 0)
+                waited += perf_counter() - start
+                pieces = self._app._take_incoming(memo, remaining)
+                remaining -= len(pieces)
+                if remaining == 0 and self._app._incoming_conditions.get(memo) is condition:
+                    del self._app._incoming_conditions[memo]
+            if remaining == 0:
+                # only the time blocked, not the time spent on the pieces in between
+                self._record_wait(memo, waited)
+            # hand out the pieces one by one, so each can be freed after use
+            pieces.reverse()
+            while pieces:
+                yield pieces.pop()
+
+    def _await_pieces(self, n, memo):
+        """
+        Blocks until n data pieces with the given memo have arrived and 
+        removes them from the incoming data.
+
+        Parameters
+        ----------
+        n : int
+            number of data pieces to wait for
+        memo : str or None
+            the URL-encoded memo
+
+        Returns
+        -------
+        list of n tuples (serialized data, client ID)
+        """
+        with self._app._incoming_lock:
+            condition = self._app._incoming_condition(memo)
+            start = perf_counter()
+            condition.wait_for(lambda: len(self._app.data_incoming.get(memo, [])) >= n)
+            waited = perf_counter() - start
+            if self._app._incoming_conditions.get(memo) is condition:
+                del self._app._incoming_conditions[memo]
+
+            num_data_pieces = len(self._app.data_incoming[memo])
+            # warn if too many data pieces came in
+            if num_data_pieces > n:
+                self._app.log(
+                    f"await was used to wait for {n} data pieces, " + 
+                    f"but more data pieces ({num_data_pieces}) were found. " +
+                    f"Used memo is <{memo}>",
+                    LogLevel.ERROR)
+
+            # extract the data
+            data = self._app._take_incoming(memo, n)
+        self._record_wait(memo, waited)
+        return data
+
+    def _record_wait(self, memo, seconds):
+        self._app.metrics.inc('fc_await_seconds_total', seconds, state=self.name)
+        self._app.metrics.set('fc_round_wait_seconds', seconds, memo=_memo_label(memo))
+        end = self._app.tracer.now()
+        self._app.tracer.span('states', f'await {_memo_label(memo)}', end - seconds * 1e6, end)
+
+    def _encode_arrays(self, data, destination, sparse, quantization, stream=None):
+        """
+        Encodes the arrays in the data sparsely if sparse is True, or if it
+        is None and configure_sparse was used, and quantizes the remaining
+        dense arrays (see configure_quantization). Error feedback residuals
+        are kept per destination, stream and structure of the data.
+
+        Parameters
+        ----------
+        data : object
+            data to be sent
+        destination : str or None
+            the client the data is sent to
+        sparse : bool or None
+        quantization : Quantization or None
+            if None, the quantization set with configure_quantization is used
+        stream : str or None, default=None
+            name of the stream of updates the data belongs to
+
+        Returns
+        -------
+        the data, with arrays replaced by SparseArray or QuantizedArray
+        where it pays off, or the data itself if nothing was encoded
+        """
+        encoder = self._app.sparse_encoder
+        if sparse is None:
+            sparse = encoder is not None
+        if quantization is None:
+            quantization = self._app.default_quantization
+        if not sparse and quantization == Quantization.NONE:
+            return data
+        if isinstance(data, LazyData):
+            data = data.get()
+        arrays = []
+        _map_leaves(data, lambda leaf: isinstance(leaf, np.ndarray) and arrays.append(leaf) or leaf)
+        if not arrays:
+            return data
+        if sparse:
+            # without configure_sparse, only zeros are left out
+            # the shapes of the arrays are part of the key of each residual
+            structure = repr(_map_leaves(data, lambda leaf: 0))
+            arrays = (encoder or SparseEncoder()).encode(arrays, key=(destination, stream, structure))
+        if quantization != Quantization.NONE:
+            arrays = [QuantizedArray.quantize(array, quantization, self._app.quantization_block_size,
+                                              self._app.quantization_stochastic)
+                      if isinstance(array, np.ndarray) and array.size >= self._app.quantization_min_size else array
+                      for array in arrays]
+        encoded = iter(arrays)
+        return _map_leaves(data, lambda leaf: next(encoded) if isinstance(leaf, np.ndarray) else leaf)
+
+    def _send_to_self(self, data, memo, encoded=False):
+        """
+        Delivers data this client sends to itself, according to the 
+        configured loopback mode (see configure_loopback). Unless 
+        LoopbackMode.SERIALIZE is used, the data is not serialized.
+
+        Parameters
+        ----------
+        data : object
+            data to deliver
+        memo : str
+            the memo of the data
+        encoded : bool, default=False
+            whether the data contains arrays encoded by _encode_arrays
+        """
+        mode = self._app.loopback_mode
+        if isinstance(data, LazyData):
+            if not data.loaded and not data.is_json:
+                # still serialized, just pass the received bytes on
+                self._app.handle_incoming(data.raw, client=self._app.id, memo=memo)
+                return
+            data = data.get()
+        if mode == LoopbackMode.SERIALIZE:
+            data = self._app.serialize_outgoing(data)
+        elif mode == LoopbackMode.COPY:
+            data = _Loopback(copy.deepcopy(data), encoded)
+        else:
+            data = _Loopback(data, encoded)
+        self._app.handle_incoming(data, client=self._app.id, memo=memo)
 
     def send_data_to_participant(self, data, destination, use_dp=False, 
-                                 memo=None):
+                                 memo=None, compression: Union[Compression, None] = None,
+                                 sparse: Union[bool, None] = None,
+                                 quantization: Union[Quantization, None] = None,
+                                 stream: Union[str, None] = None):
         """
         Sends data to a particular participant identified by its ID. Should be
         used for any specific communication to individual clients. 
@@ -801,6 +2455,25 @@ class AppState(abc.ABC):
             correct data piece can be identified by the recipient of the 
             data piece sent with this function call. The recipient of this data
             must use the same memo to identify the data.
+        compression : Compression or None, default=None
+            compression to apply before sending the data (not applied with 
+            use_dp). If None, the compression set with configure_compression
+            is used. The recipient decompresses the data automatically.
+        sparse : bool or None, default=None
+            whether to encode the arrays in the data sparsely (not applied 
+            with use_dp), see configure_sparse. If None, the data is encoded
+            if configure_sparse was used.
+        quantization : Quantization or None, default=None
+            precision to send floating point arrays with (not applied with
+            use_dp). If None, the quantization set with 
+            configure_quantization is used. The recipient dequantizes the
+            data automatically.
+        stream : str or None, default=None
+            name of the stream of updates the data belongs to, e.g.
+            'gradients'. With sparse encoding, the error feedback residuals
+            are kept per destination and stream, so different streams of
+            data with the same structure do not mix. If None, the data is
+            only told apart by its structure
 
         """
         try:
@@ -810,11 +2483,19 @@ class AppState(abc.ABC):
                 f"given memo cannot be translated to a string, ERROR: {e}", 
                 LogLevel.Error)
             
-        data = _serialize_outgoing(data, is_json=use_dp)
+        original = data
+        if not use_dp:
+            data = self._encode_arrays(data, destination, sparse, quantization, stream)
+        elif sparse or quantization not in (None, Quantization.NONE):
+            self._app.log('sparse encoding and quantization cannot be used with DP', level=LogLevel.FATAL)
         if destination == self._app.id and not use_dp:
             # In no DP case, the data does not have to be sent via the controller
-            self._app.handle_incoming(data, client=self._app.id, memo=memo)
+            self._send_to_self(data, memo, encoded=data is not original)
         else:
+            trace_start = self._app.tracer.now()
+            data = self._app.serialize_outgoing(data, is_json=use_dp, joined=not self._app.zero_copy_send)
+            if not use_dp:
+                data = self._app.compress_outgoing(data, compression)
             # update the status variables and get the status object
             message = self._app.status_message if self._app.status_message else (self._app.current_state.name if self._app.current_state else None)
             dp = self._app.default_dp if use_dp else None
@@ -822,10 +2503,97 @@ class AppState(abc.ABC):
             status = self._app.get_current_status(message=message, 
                         destination=destination, dp=dp, memo=memo,
                         available=True)
-            self._app.data_outgoing.append((data, json.dumps(status, sort_keys=True)))
+            self._app.data_outgoing.append(data, status)
+            self._app.tracer.outgoing_enqueued(status, trace_start)
+
+    def scatter(self, mapping: dict, memo=None, compression: Union[Compression, None] = None,
+                sparse: Union[bool, None] = None, quantization: Union[Quantization, None] = None,
+                workers: int = 1, hash_content=False, stream: Union[str, None] = None):
+        """
+        Sends a data piece to each of several participants, like calling
+        send_data_to_participant for each of them, e.g. to send personalized
+        or partitioned data. Destinations given the same object (or, with
+        hash_content, equal data) share one serialization, and all data
+        pieces are queued at once. DP is not supported.
+
+        Parameters
+        ----------
+        mapping : dict
+            maps the destination client IDs to the data to send to them
+        memo : str or None, default=None
+            the string identifying this communication round, the recipients
+            must use the same memo
+        compression : Compression or None, default=None
+            see send_data_to_participant
+        sparse : bool or None, default=None
+            see send_data_to_participant. As error feedback is kept per
+            destination, sparsely encoded data is serialized for each
+            destination
+        quantization : Quantization or None, default=None
+            see send_data_to_participant
+        workers : int, default=1
+            number of threads serializing and compressing the distinct data
+            pieces in parallel
+        hash_content : bool, default=False
+            if True, data pieces consisting of arrays, numbers and strings
+            (in dicts, lists and tuples) are also shared by equal content,
+            not only by identity
+        stream : str or None, default=None
+            name of the stream of updates the data belongs to, see
+            send_data_to_participant
+
+        """
+        memo = str(memo)
+        encoder = self._app.sparse_encoder
+        per_destination = sparse or (sparse is None and encoder is not None)
+        groups = {}
+            # dictionary mapping the key of a distinct data piece: [data, destinations]
+        for destination, data in mapping.items():
+            if per_destination:
+                key = ('destination', destination)
+            else:
+                key = _content_key(data) if hash_content else None
+                key = key if key is not None else ('id', id(data))
+            groups.setdefault(key, [data, []])[1].append(destination)
+
+        trace_start = self._app.tracer.now()
+        pieces = []
+        for data, destinations in groups.values():
+            original = data
+            data = self._encode_arrays(data, destinations[0] if per_destination else None, sparse, quantization,
+                                       stream)
+            if self._app.id in destinations:
+                self._send_to_self(data, memo, encoded=data is not original)
+                destinations.remove(self._app.id)
+            if destinations:
+                pieces.append((data, destinations))
+
+        def serialize(data):
+            data = self._app.serialize_outgoing(data, joined=not self._app.zero_copy_send)
+            return self._app.compress_outgoing(data, compression)
+
+        if workers > 1 and len(pieces) > 1:
+            with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='serialize') as pool:
+                serialized = list(pool.map(serialize, [data for data, _ in pieces]))
+        else:
+            serialized = [serialize(data) for data, _ in pieces]
+
+        message = self._app.status_message if self._app.status_message else (
+            self._app.current_state.name if self._app.current_state else None)
+        self._app.status_message = message
+        template = self._app.get_current_status(message=message, destination=None, dp=None, memo=memo,
+                                                available=True)
+        items = [(data, dict(template, destination=destination))
+                 for data, (_, destinations) in zip(serialized, pieces) for destination in destinations]
+        self._app.data_outgoing.extend(items)
+        for _, status in items:
+            self._app.tracer.outgoing_enqueued(status, trace_start)
 
     def send_data_to_coordinator(self, data, send_to_self=True, use_smpc=False,
-                                 use_dp=False, memo=None):
+                                 use_dp=False, memo=None, compression: Union[Compression, None] = None,
+                                 sparse: Union[bool, None] = None,
+                                 quantization: Union[Quantization, None] = None,
+                                 stream: Union[str, None] = None):
         """
         Sends data to the coordinator instance. Must be used by all clients
         or all clients except for the coordinator itself when no memo is given,
@@ -854,6 +2622,23 @@ class AppState(abc.ABC):
             communication round. This also ensures that workflows where 
             participants send data to the coordinator without waiting for a 
             response work
+        compression : Compression or None, default=None
+            compression to apply before sending the data (not applied with 
+            use_smpc or use_dp). If None, the compression set with 
+            configure_compression is used. The coordinator decompresses the
+            data automatically.
+        sparse : bool or None, default=None
+            whether to encode the arrays in the data sparsely (not applied 
+            with use_smpc or use_dp), see configure_sparse. If None, the data
+            is encoded if configure_sparse was used.
+        quantization : Quantization or None, default=None
+            precision to send floating point arrays with (not applied with
+            use_smpc or use_dp). If None, the quantization set with 
+            configure_quantization is used. aggregate_data and await_data
+            dequantize the data automatically.
+        stream : str or None, default=None
+            name of the stream of updates the data belongs to, e.g.
+            'gradients', see send_data_to_participant
         """
         # if no memo is given (default), we use the counter from App
         if not memo:
@@ -866,20 +2651,27 @@ class AppState(abc.ABC):
             self._app.log(
                 f"given memo cannot be translated to a string, ERROR: {e}", 
                 LogLevel.Error)
-            
-        if use_smpc or use_dp:
-            data = _serialize_outgoing(data, is_json=True)
-
-        else:
-            data = _serialize_outgoing(data, is_json=False)
 
+        original = data
+        if use_smpc or use_dp:
+            if sparse or quantization not in (None, Quantization.NONE):
+                self._app.log('sparse encoding and quantization cannot be used with SMPC or DP',
+                              level=LogLevel.FATAL)
+        elif send_to_self or not self._app.coordinator:
+            data = self._encode_arrays(data, self._app.coordinatorID, sparse, quantization, stream)
         if self._app.coordinator and not use_smpc and not use_dp:
             # coordinator sending itself data, if that is wanted (send_to_self),
             # and neither dp nor smpc are used, the controller does not have to be used
             # for sending the data
             if send_to_self:
-                self._app.handle_incoming(data, self._app.id, memo)
+                self._send_to_self(data, memo, encoded=data is not original)
         else:
+            trace_start = self._app.tracer.now()
+            if use_smpc or use_dp:
+                data = self._app.serialize_outgoing(data, is_json=True)
+            else:
+                data = self._app.serialize_outgoing(data, is_json=False, joined=not self._app.zero_copy_send)
+
             # for SMPC and DP, the data has to be sent via the controller        
             if use_dp and self._app.coordinator:
                 # give the coordinator as destination,
@@ -888,6 +2680,8 @@ class AppState(abc.ABC):
             else:
                 destination = None 
                 # this is interpreted as to the coordinator
+            if not use_smpc and not use_dp:
+                data = self._app.compress_outgoing(data, compression)
             message = self._app.status_message if self._app.status_message else (self._app.current_state.name if self._app.current_state else None)
             self._app.status_message = message
             smpc = self._app.default_smpc if use_smpc else None
@@ -895,10 +2689,12 @@ class AppState(abc.ABC):
             status = self._app.get_current_status(message=message, 
                         destination=destination, smpc=smpc, dp=dp, memo=memo,
                         available=True)
-            self._app.data_outgoing.append((data, json.dumps(status, sort_keys=True)))
+            self._app.data_outgoing.append(data, status)
+            self._app.tracer.outgoing_enqueued(status, trace_start)
 
-    def broadcast_data(self, data, send_to_self=True, use_dp = False, 
-                       memo = None):
+    def broadcast_data(self, data, send_to_self=True, use_dp=False,
+                       memo=None, compression: Union[Compression, None] = None,
+                       quantization: Union[Quantization, None] = None, delta: Union[str, None] = None):
         """
         Broadcasts data to all participants (only valid for the coordinator instance).
 
@@ -919,6 +2715,22 @@ class AppState(abc.ABC):
             participants and the coordinator can differentiate between this
             data piece broadcast and other data pieces they receive from the
             coordinator.
+        compression : Compression or None, default=None
+            compression to apply before sending the data (not applied with 
+            use_dp). If None, the compression set with configure_compression
+            is used. The participants decompress the data automatically.
+        quantization : Quantization or None, default=None
+            precision to send floating point arrays with (not applied with
+            use_dp). If None, the quantization set with 
+            configure_quantization is used. The participants dequantize the
+            data automatically.
+        delta : str or None, default=None
+            name under which the data is versioned, e.g. 'model'. If all 
+            participants hold the previous version with this name, only the
+            arrays (or their entries) that changed are sent, otherwise the 
+            full data. await_data of the participants returns the full data
+            in both cases. Not applied with use_dp, and the data is not 
+            quantized
         """
         try:
             memo = str(memo)
@@ -934,8 +2746,23 @@ class AppState(abc.ABC):
         if use_dp:
             is_json = True
 
+        original = data
+        if use_dp:
+            if quantization not in (None, Quantization.NONE) or delta is not None:
+                self._app.log('quantization and delta cannot be used with DP', level=LogLevel.FATAL)
+        elif delta is None:
+            # all clients, including this one, receive the same quantized data
+            data = self._encode_arrays(data, None, False, quantization)
+
+        if send_to_self and not use_dp:
+            self._send_to_self(data, memo, encoded=data is not original)
+        if delta is not None and not use_dp:
+            participants = [client for client in self._app.clients if client != self._app.id]
+            data = self._app.encode_delta(delta, data, participants)
+
         # serialize before broadcast
-        data = _serialize_outgoing(data, is_json=use_dp)
+        trace_start = self._app.tracer.now()
+        data = self._app.serialize_outgoing(data, is_json=use_dp, joined=not self._app.zero_copy_send)
 
         message = self._app.status_message if self._app.status_message else (self._app.current_state.name if self._app.current_state else None)
         self._app.status_message = message
@@ -943,9 +2770,14 @@ class AppState(abc.ABC):
         status = self._app.get_current_status(message=message, 
                         destination=None, dp=dp, memo=memo,
                         available=True)
-        if send_to_self:
+        if send_to_self and use_dp:
+            # the coordinator receives the JSON serialization, as the
+            # participants do
             self._app.handle_incoming(data, client=self._app.id, memo=memo)
-        self._app.data_outgoing.append((data, json.dumps(status, sort_keys=True)))
+        if not use_dp:
+            data = self._app.compress_outgoing(data, compression)
+        self._app.data_outgoing.append(data, status)
+        self._app.tracer.outgoing_enqueued(status, trace_start)
 
     def configure_smpc(self, exponent: int = 8, shards: int = 0, operation: SMPCOperation = SMPCOperation.ADD,
                        serialization: SMPCSerialization = SMPCSerialization.JSON):
@@ -1043,6 +2875,314 @@ class AppState(abc.ABC):
         self._app.default_dp['sensitivity'] = sensitivity
         self._app.default_dp['clippingVal'] = clippingVal
 
+    def configure_compression(self, compression: Compression = Compression.AUTO,
+                              level: Union[int, None] = None,
+                              bandwidth: float = DEFAULT_BANDWIDTH,
+                              trials: int = DEFAULT_TRIALS):
+        """
+        Configures the compression of all data sent via the controller without
+        SMPC or DP. Receiving clients decompress the data automatically, no
+        matter which compression was used.
+
+        Parameters
+        ----------
+        compression : Compression, default=Compression.AUTO
+            the codec to use. Compression.AUTO measures all codecs on the first
+            data pieces sent and then uses the one with the shortest estimated
+            time for compression, transfer and decompression.
+        level : int or None, default=None
+            compression level of the codec, if None a fast level is used
+        bandwidth : float, default=12.5e6
+            bandwidth (bytes per second) assumed by Compression.AUTO
+        trials : int, default=3
+            number of data pieces Compression.AUTO measures before it sticks
+            to one codec
+        """
+        self._app.default_compression = compression
+        self._app.compression_level = level
+        self._app.compression_selector = None
+        if compression == Compression.AUTO:
+            self._app.compression_selector = CompressionSelector(bandwidth, trials, level)
+
+    def configure_serialization(self, zero_copy: bool = True):
+        """
+        Configures how data pieces sent via the controller are queued. By
+        default, each data piece is serialized into one contiguous frame,
+        which copies all arrays of the data once, so the data piece needs
+        twice its size in memory while it is serialized.
+
+        Parameters
+        ----------
+        zero_copy : bool, default=True
+            if True, the frame is queued as the list of its parts and GET /data
+            streams the arrays directly from the sent data, without a copy.
+            The sending state must then not modify the arrays of sent data
+            (e.g. update a model in place) until the controller fetched it.
+            Compressed data pieces are always copied
+        """
+        self._app.zero_copy_send = zero_copy
+
+    def configure_deserialization(self, workers: Union[int, None] = None, use_processes=False, lazy=False):
+        """
+        Configures how received data pieces are deserialized by await_data and
+        gather_data.
+
+        Parameters
+        ----------
+        workers : int or None, default=None
+            number of workers deserializing data pieces in parallel, if None, 
+            the number of CPUs is used. Threads mainly speed up decompression
+            and copying of large arrays, as unpickling holds the GIL.
+        use_processes : bool, default=False
+            if True, a process pool is used instead of threads, which only pays
+            off for large structures of Python objects, as the deserialized 
+            data has to be sent back from the worker processes
+        lazy : bool, default=False
+            if True, LazyData handles are returned instead of the data, which
+            deserialize the data on first access
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if self._app._deserialization_pool is not None:
+            self._app._deserialization_pool.shutdown(wait=False)
+            self._app._deserialization_pool = None
+        self._app.deserialization_workers = workers
+        self._app.deserialization_processes = use_processes
+        self._app.lazy_deserialization = lazy
+
+    def configure_shutdown(self, terminal_wait: float = 0, transition_wait: float = 0,
+                           timeout: Union[float, None] = SHUTDOWN_TIMEOUT):
+        """
+        Configures the end of the workflow and the time between states. By
+        default, the next state runs right after a transition and the app
+        terminates as soon as the controller fetched the final status, which
+        is only served after all outgoing data was fetched.
+
+        Parameters
+        ----------
+        terminal_wait : float, default=0
+            seconds to wait additionally after the final status was fetched
+            (the former behaviour used 10 seconds)
+        transition_wait : float, default=0
+            seconds to wait after each transition (the former behaviour used
+            1 second)
+        timeout : float or None, default=SHUTDOWN_TIMEOUT
+            maximum seconds to wait for the controller to fetch the final
+            status, including the data pieces queued before it. None waits
+            until it is fetched, even if the controller stopped polling
+        """
+        self._app.terminal_wait = terminal_wait
+        self._app.transition_wait = transition_wait
+        self._app.shutdown_timeout = timeout
+
+    def configure_incoming(self, budget: Union[int, None] = None, ttl: Union[float, None] = None,
+                           spill_dir: Union[str, None] = None):
+        """
+        Configures how received data is kept until a state takes it.
+
+        Parameters
+        ----------
+        budget : int or None, default=None
+            maximum size (bytes) of the received data kept in memory. Data
+            pieces exceeding it are moved to memory-mapped temporary files and
+            read from there without a copy when they are deserialized. Data of
+            memos nobody waits for yet is moved first. None keeps all data in
+            memory
+        ttl : float or None, default=None
+            seconds after which received data of a memo that no state waits
+            for is discarded, counted from its last data piece. Discarded
+            data is logged and kept as diagnostics in app.incoming_evictions.
+            None keeps the data until it is taken
+        spill_dir : str or None, default=None
+            directory for the temporary files, the default temporary
+            directory if None
+        """
+        self._app.incoming_budget = budget
+        self._app.incoming_ttl = ttl
+        self._app.incoming_spill_dir = spill_dir
+
+    def configure_metrics(self, file: Union[str, None] = METRICS_FILE):
+        """
+        Configures whether the metrics (see app.render_metrics) are written
+        to a file at the end of the workflow. They are always available on
+        /web/metrics while the app runs.
+
+        Parameters
+        ----------
+        file : str or None, default=METRICS_FILE
+            the file to write the metrics to, None to not write them
+        """
+        self._app.metrics_file = file
+
+    def configure_logging(self, level: LogLevel = LogLevel.DEBUG, buffered: bool = True,
+                          request_burst: Union[int, None] = REQUEST_LOG_BURST,
+                          request_interval: float = REQUEST_LOG_INTERVAL):
+        """
+        Configures the log output of the app and of the HTTP handlers.
+
+        Parameters
+        ----------
+        level : LogLevel, default=LogLevel.DEBUG
+            messages below this level are discarded before they are
+            formatted. LogLevel.FATAL always raises an exception
+        buffered : bool, default=True
+            if True, messages are written by a background thread, so logging
+            never blocks the app. If False, each message is written right away
+        request_burst : int or None, default=REQUEST_LOG_BURST
+            number of identical request logs (e.g. '[CTRL] GET /data')
+            written per request_interval, None to log every request
+        request_interval : float, default=REQUEST_LOG_INTERVAL
+            time window (seconds) of the rate limit of request logs
+        """
+        self._app.log_level = level
+        if not buffered:
+            # write what is buffered so far first, to keep the order
+            self._app.log_writer.flush()
+        self._app.log_writer.buffered = buffered
+        self._app.log_writer.request_burst = request_burst
+        self._app.log_writer.request_interval = request_interval
+
+    def configure_tracing(self, file: Union[str, None] = TRACE_FILE):
+        """
+        Enables tracing of the lifecycle of each data piece: its
+        serialization, the time it waited in the outgoing queue, until the
+        controller fetched it after it was announced via /status, and on the
+        receiving side, the time it was buffered until a state took it. The
+        states and the time they waited for data are traced as well. Call it
+        in the initial state to trace the whole workflow.
+        The trace is written in the Chrome trace event format at the end of the
+        workflow. The traces of all clients can be merged with
+        `python -m FeatureCloud.app.engine.tracing merged.json trace1.json ...`
+        and opened with https://ui.perfetto.dev.
+
+        Parameters
+        ----------
+        file : str or None, default=TRACE_FILE
+            the file to write the trace to, None disables tracing
+        """
+        self._app.tracer.enabled = file is not None
+        self._app.trace_file = file
+
+    def configure_loopback(self, mode: LoopbackMode = LoopbackMode.REFERENCE):
+        """
+        Configures how data this client sends to itself (e.g. the coordinator
+        with send_data_to_coordinator or broadcast_data and send_to_self=True)
+        is delivered. Without calling it, LoopbackMode.COPY is used. Data sent
+        with DP or SMPC always goes via the controller.
+
+        Parameters
+        ----------
+        mode : LoopbackMode, default=LoopbackMode.REFERENCE
+            LoopbackMode.REFERENCE delivers the object itself without 
+            serializing it, so changes made to the object after sending it are
+            visible to the receiving state (and vice versa).
+            LoopbackMode.COPY delivers a deep copy taken when sending, which
+            isolates sender and receiver at the cost of one copy.
+            LoopbackMode.SERIALIZE serializes the data as before.
+        """
+        self._app.loopback_mode = mode
+
+    def configure_sparse(self, k: Union[int, None] = None, ratio: Union[float, None] = None,
+                         error_feedback: bool = True, min_size: int = SPARSE_MIN_SIZE,
+                         enabled: bool = True):
+        """
+        Configures the sparse encoding of data sent with 
+        send_data_to_coordinator and send_data_to_participant (without SMPC
+        or DP). Floating point arrays in the data are sent as index/value 
+        pairs (SparseArray) when that is smaller than the dense array.
+        scipy.sparse matrices (e.g. CSR) are always sent as they are.
+        aggregate_data adds sparse data pieces straight into its dense 
+        result, without densifying them first, all other receiving methods
+        return dense arrays.
+
+        Parameters
+        ----------
+        k : int or None, default=None
+            top-k sparsification: only the k entries with the largest 
+            magnitude of each array are sent. If k and ratio are None, all
+            non-zero entries are sent
+        ratio : float or None, default=None
+            share of the entries of each array to send, if k is None, e.g.
+            0.01 for the largest 1%
+        error_feedback : bool, default=True
+            with k or ratio, the entries that were not sent are added to the
+            data sent next to the same client (residuals are kept across
+            rounds), so the sum of all updates is preserved
+        min_size : int, default=SPARSE_MIN_SIZE
+            arrays with fewer elements are sent dense
+        enabled : bool, default=True
+            False disables the sparse encoding again
+        """
+        self._app.sparse_encoder = SparseEncoder(k, ratio, error_feedback, min_size) if enabled else None
+
+    def configure_quantization(self, quantization: Quantization = Quantization.INT8,
+                               block_size: int = QUANTIZATION_BLOCK_SIZE, stochastic: bool = False,
+                               min_size: int = QUANTIZATION_MIN_SIZE):
+        """
+        Configures the precision floating point arrays are sent with by
+        send_data_to_coordinator, send_data_to_participant and 
+        broadcast_data (without SMPC or DP). Receiving clients dequantize 
+        the data automatically to the original dtype, aggregate_data 
+        accumulates it in the original dtype.
+
+        Parameters
+        ----------
+        quantization : Quantization, default=Quantization.INT8
+            Quantization.FLOAT16 and Quantization.BFLOAT16 halve the size of
+            float32 arrays, Quantization.INT8 quarters it. Quantization.NONE
+            sends full precision again
+        block_size : int, default=QUANTIZATION_BLOCK_SIZE
+            number of values sharing one scale and zero point with
+            Quantization.INT8, smaller blocks are more precise
+        stochastic : bool, default=False
+            round up or down at random, so the rounding errors cancel out in
+            expectation, e.g. when many updates are averaged (BFLOAT16 and 
+            INT8 only)
+        min_size : int, default=QUANTIZATION_MIN_SIZE
+            arrays with fewer elements are sent in full precision
+        """
+        self._app.default_quantization = quantization
+        self._app.quantization_block_size = block_size
+        self._app.quantization_stochastic = stochastic
+        self._app.quantization_min_size = min_size
+
+    def configure_checkpoint(self, directory: str = CHECKPOINT_DIR, every: Union[int, None] = 1,
+                             interval: Union[float, None] = None, resume: bool = True, exclude=()):
+        """
+        Enables checkpoints of the workflow, so a restarted container
+        continues where the previous one stopped. A checkpoint contains the
+        state to run next, app.internal (see store), the send and receive
+        counters, the transition log, the versions of delta broadcasts
+        received, the data pieces not yet fetched by the controller and the
+        data pieces received but not yet taken by a state. It is taken
+        between two states, so at most the work of the states since the
+        last checkpoint is repeated after a restart. Data pieces fetched
+        after the last checkpoint are sent again, so they may arrive twice.
+        The checkpoint is removed once the workflow finished. To resume
+        before the first state runs, call this method in register() of a
+        state.
+
+        Parameters
+        ----------
+        directory : str, default=CHECKPOINT_DIR
+            where to write the checkpoint
+        every : int or None, default=1
+            take a checkpoint after this many transitions
+        interval : float or None, default=None
+            take a checkpoint after a transition if this many seconds passed
+            since the last one
+        resume : bool, default=True
+            whether to continue from an existing checkpoint on start
+        exclude : iterable of str, default=()
+            keys of app.internal not to store, e.g. objects that cannot be
+            pickled or are recreated by preload hooks
+        """
+        self._app.checkpoint_dir = directory
+        self._app.checkpoint_every = every
+        self._app.checkpoint_interval = interval
+        self._app.checkpoint_resume = resume
+        self._app.checkpoint_exclude = set(exclude)
+
 
 
     def update(self, message: Union[str, None] = None, progress: Union[float, None] = None,
@@ -1126,6 +3266,38 @@ def app_state(name: str, role: Role = Role.BOTH, app_instance: Union[App, None]
 
     return func
 
+
+def app_preload(app_instance: Union[App, None] = None):
+    """
+    Registers a function as preload hook of the app. Preload hooks run in a
+    background thread at container start, once app.register() is called, so
+    expensive work (importing frameworks, loading data, building models) is
+    done before the controller calls /setup. The workflow starts after all
+    hooks are done. Each hook is called with the app instance, e.g. to keep
+    its results in app.internal.
+
+    Parameters
+    ----------
+    app_instance : App or None, default=None
+        the app to register the hook with, the default app if None
+
+    Example
+    -------
+    @app_preload()
+    def load_model(app):
+        import tensorflow
+        app.internal['model'] = tensorflow.keras.models.load_model('/mnt/input/model')
+    """
+    if app_instance is None:
+        app_instance = app
+
+    def func(hook):
+        app_instance.preload_hooks.append(hook)
+        return hook
+
+    return func
+
+
 class _NumpyArrayEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.integer):
@@ -1138,9 +3310,222 @@ class _NumpyArrayEncoder(json.JSONEncoder):
             # call default Encoder in other cases
             return json.JSONEncoder.default(self, obj)
 
-def _serialize_outgoing(data, is_json=False):
+
+def _orjson_default(obj):
+    # only called by orjson for arrays it cannot encode natively,
+    # e.g. non-contiguous arrays
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
+
+
+def _dumps_json(data):
+    """
+    Serializes data to JSON. Numpy arrays are written as (nested) lists of
+    numbers, as expected by the controller. If orjson is installed, arrays are
+    encoded in bulk without creating a Python object per element. Data orjson
+    cannot represent like json does (NaN and infinity, which orjson writes as
+    null, and integers wider than 64 bits) is serialized with json.
+
+    Parameters
+    ----------
+    data : object
+        data to serialize
+
+    Returns
+    ----------
+    JSON as bytes (orjson) or str
+    """
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(data, default=_orjson_default,
+                                   option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # e.g. integers wider than 64 bits
+            encoded = None
+        if encoded is not None and (b'null' not in encoded or not _has_non_finite(data)):
+            return encoded
+    # we use a custom cls to manage numpy which is quite common
+    return json.dumps(data, cls=_NumpyArrayEncoder)
+
+
+def _has_non_finite(data):
+    # whether data contains NaN or infinite floating point numbers
+    if isinstance(data, dict):
+        return any(_has_non_finite(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return any(_has_non_finite(value) for value in data)
+    if isinstance(data, np.ndarray):
+        if data.dtype.kind in 'fc':
+            return not np.isfinite(data).all()
+        return data.dtype == object and any(_has_non_finite(value) for value in data.flat)
+    if isinstance(data, (float, complex, np.floating, np.complexfloating)):
+        return not np.isfinite(data)
+    return False
+
+
+def _loads_json(data):
+    """
+    Deserializes JSON data, with orjson if it is installed. JSON orjson
+    rejects (NaN and infinity, as written by json) is deserialized with json.
+    Note that orjson reads integers wider than 64 bits as floats.
+
+    Parameters
+    ----------
+    data : bytes-like or str
+        JSON data
+
+    Returns
+    ----------
+    deserialized data
+    """
+    if isinstance(data, mmap.mmap):
+        # e.g. spilled to disk
+        data = memoryview(data) if orjson is not None else bytes(data)
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def _numeric_to_numpy(data):
+    """
+    Converts all homogeneous numerical (nested) lists inside of data to numpy
+    arrays, walking through dicts and lists that cannot be converted.
+
+    Parameters
+    ----------
+    data : object
+        deserialized JSON data
+
+    Returns
+    ----------
+    data with numpy arrays instead of numerical lists
+    """
+    if isinstance(data, dict):
+        return {key: _numeric_to_numpy(value) for key, value in data.items()}
+    if isinstance(data, list):
+        try:
+            array = np.array(data)
+        except ValueError:
+            # ragged, e.g. layers of different shapes
+            array = None
+        if array is not None and array.dtype.kind in 'iuf':
+            return array
+        return [_numeric_to_numpy(value) for value in data]
+    return data
+
+
+def _encode_status(status):
+    """
+    Encodes a status as JSON.
+
+    Parameters
+    ----------
+    status : dict or str
+        the status, strings are assumed to be JSON already
+
+    Returns
+    ----------
+    bytes
+    """
+    if isinstance(status, str):
+        return status.encode()
+    if orjson is not None:
+        return orjson.dumps(status)
+    return json.dumps(status).encode()
+
+
+def _memo_label(memo):
+    # memos are URL-encoded (once or several times), show them as they were given
+    if memo is None:
+        return ''
+    decoded = urllib.parse.unquote(memo)
+    while decoded != memo:
+        memo, decoded = decoded, urllib.parse.unquote(decoded)
+    return memo
+
+
+def _checkpoint_payload(data):
+    # serialized data pieces are stored out-of-band in the checkpoint (see
+    # _frame_parts), so they are written without a copy and memory-mapped
+    # on resume
+    if data is None or isinstance(data, (str, _Loopback)):
+        return data
+    if isinstance(data, _FrameParts):
+        return _FrameParts([pickle.PickleBuffer(part) for part in data.parts])
+    return pickle.PickleBuffer(data)
+
+
+def _memory_size(data):
+    # size of a received data piece that is kept in memory, data pieces in
+    # memory-mapped files and data sent to the client itself are not counted
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    return 0
+
+
+def _spill(data, directory=None):
+    """
+    Writes a received data piece into a temporary file and maps it into
+    memory. The file is deleted right away, its data stays available as long
+    as the mapping is referenced.
+
+    Parameters
+    ----------
+    data : bytes-like
+        the serialized data piece
+    directory : str or None, default=None
+        where to create the file, the default temporary directory if None
+
+    Returns
+    ----------
+    mmap.mmap
+        copy-on-write mapping, so the data stays writable without modifying
+        the file
+    """
+    with tempfile.TemporaryFile(dir=directory) as file:
+        file.write(data)
+        file.flush()
+        return mmap.mmap(file.fileno(), len(data), access=mmap.ACCESS_COPY)
+
+
+def _payload_size(data):
+    """
+    Returns the size of a serialized data piece in bytes.
+
+    Parameters
+    ----------
+    data : bytes, str, _FrameParts or None
+        serialized data
+
+    Returns
+    ----------
+    size in bytes
+    """
+    if data is None or isinstance(data, _Loopback):
+        return 0
+    if isinstance(data, str):
+        return len(data)
+    if isinstance(data, _FrameParts):
+        return data.nbytes
+    return memoryview(data).nbytes
+
+
+def _serialize_outgoing(data, is_json=False, metadata: bytes = b'', joined=True):
     """
     Transforms a Python data object into a byte serialization.
+    Without JSON, the data is pickled with protocol 5 into a frame (see
+    _dumps_frame), so large buffers like numpy arrays are not copied into the
+    pickle stream.
 
     Parameters
     ----------
@@ -1148,43 +3533,209 @@ def _serialize_outgoing(data, is_json=False):
         data to serialize
     is_json : bool, default=False
         indicates whether JSON serialization is required
+    metadata : bytes, default=b''
+        metadata stored in the frame (not with JSON), see _frame_metadata
+    joined : bool, default=True
+        if False, the frame is returned as _FrameParts, its buffers are views
+        on the arrays of the data
 
     Returns
     ----------
-    serialized data as bytes
+    serialized data as bytes (or str for JSON without orjson)
     """
+    if isinstance(data, LazyData):
+        if not data.loaded and data.is_json == is_json and not isinstance(data.raw, _Loopback):
+            # forward the received data without deserializing it
+            return data.raw
+        data = data.get()
 
     if not is_json:
-        return pickle.dumps(data)
+        return _dumps_frame(data, metadata) if joined else _FrameParts(_frame_parts(data, metadata))
 
-    # we use a custom cls to manage numpy which is quite common
-    return json.dumps(data, cls=_NumpyArrayEncoder)
+    return _dumps_json(data)
 
 
-def _deserialize_incoming(data: bytes, is_json=False):
+def _deserialize_incoming(data: bytes, is_json=False, with_metadata=False):
     """
     Transforms serialized data bytes into a Python object.
 
     Parameters
     ----------
     data : bytes
-        data to deserialize
+        data to deserialize, any bytes-like object is accepted
     is_json : bool, default=False
         indicates whether JSON deserialization should be used
+    with_metadata : bool, default=False
+        if True, a tuple (deserialized data, metadata of the frame) is
+        returned, the metadata is b'' if there is none
 
     Returns
     ----------
     deserialized data
     """
-    if not is_json:
-        return pickle.loads(data)
+    metadata = b''
+    if isinstance(data, _Loopback):
+        # sent by this client to itself, never serialized
+        value = data.get()
+    elif is_json:
+        value = _loads_json(data)
+    else:
+        if is_compressed(data):
+            data = decompress(data)
+        if _is_frame(data):
+            value = _loads_frame(data)
+            if with_metadata:
+                metadata = _frame_metadata(data)
+        else:
+            # plain pickle, as sent by older versions
+            value = pickle.loads(data)
+    return (value, metadata) if with_metadata else value
 
-    return json.loads(data)
 
+def _align(offset):
+    return -offset % FRAME_ALIGNMENT
 
-def _aggregate(data, operation: SMPCOperation):
+
+def _dumps_frame(data, metadata: bytes = b''):
     """
-    Aggregates a list of received values.
+    Pickles data with protocol 5 and places all large out-of-band buffers
+    behind the pickle stream. Layout of a frame:
+    header (magic, version, flags, metadata length, number of buffers),
+    the length of the pickle stream and of each buffer (uint64 each),
+    the metadata, the pickle stream and the buffers, each buffer starting at an
+    offset that is a multiple of FRAME_ALIGNMENT.
+    The frame is assembled with a single copy of the buffers.
+
+    Parameters
+    ----------
+    data : object
+        data to serialize
+    metadata : bytes, default=b''
+        additional metadata stored in the frame
+
+    Returns
+    ----------
+    frame as bytes
+    """
+    return b''.join(_frame_parts(data, metadata))
+
+
+def _frame_parts(data, metadata: bytes = b''):
+    """
+    Like _dumps_frame, but returns the parts of the frame without joining
+    them, so they can be written to a file without copying the buffers.
+
+    Returns
+    ----------
+    list of bytes-like objects
+    """
+    buffers = []
+
+    def buffer_callback(buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # not contiguous, serialize in-band
+            return True
+        if raw.nbytes < FRAME_OOB_MIN_SIZE:
+            return True
+        buffers.append(raw)
+        return False
+
+    stream = pickle.dumps(data, protocol=5, buffer_callback=buffer_callback)
+    header = _FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, 0, len(metadata), len(buffers))
+    lengths = b''.join(_FRAME_LENGTH.pack(size) for size in [len(stream)] + [b.nbytes for b in buffers])
+    parts = [header, lengths, metadata, stream]
+    offset = len(header) + len(lengths) + len(metadata) + len(stream)
+    for buffer in buffers:
+        padding = _align(offset)
+        parts.append(bytes(padding))
+        parts.append(buffer)
+        offset += padding + buffer.nbytes
+    return parts
+
+
+def _is_frame(data):
+    """
+    Checks whether data was serialized with _dumps_frame.
+
+    Parameters
+    ----------
+    data : bytes-like
+        serialized data
+
+    Returns
+    ----------
+    bool
+    """
+    return memoryview(data)[:len(FRAME_MAGIC)] == FRAME_MAGIC
+
+
+def _frame_metadata(data) -> bytes:
+    """
+    Returns the metadata stored in a frame created by _dumps_frame.
+
+    Parameters
+    ----------
+    data : bytes-like
+        the frame
+
+    Returns
+    ----------
+    bytes
+    """
+    view = memoryview(data).cast('B')
+    _, _, _, metadata_length, n_buffers = _FRAME_HEADER.unpack_from(view)
+    offset = _FRAME_HEADER.size + (n_buffers + 1) * _FRAME_LENGTH.size
+    return bytes(view[offset:offset + metadata_length])
+
+
+def _loads_frame(data):
+    """
+    Deserializes a frame created by _dumps_frame. Numpy arrays sent out-of-band
+    are created as views on the given data without copying it, if the data is
+    writable (e.g. a bytearray). Otherwise, each buffer is copied once so the
+    arrays stay writable.
+
+    Parameters
+    ----------
+    data : bytes-like
+        the frame
+
+    Returns
+    ----------
+    deserialized data
+    """
+    view = memoryview(data).cast('B')
+    magic, version, _, metadata_length, n_buffers = _FRAME_HEADER.unpack_from(view)
+    if version > FRAME_VERSION:
+        raise ValueError(f'unsupported frame version {version}, please update the FeatureCloud package')
+    offset = _FRAME_HEADER.size
+    lengths = []
+    for _ in range(n_buffers + 1):
+        lengths.append(_FRAME_LENGTH.unpack_from(view, offset)[0])
+        offset += _FRAME_LENGTH.size
+    offset += metadata_length
+    stream = view[offset:offset + lengths[0]]
+    offset += lengths[0]
+    buffers = []
+    for length in lengths[1:]:
+        offset += _align(offset)
+        buffer = view[offset:offset + length]
+        if view.readonly:
+            buffer = bytearray(buffer)
+        buffers.append(buffer)
+        offset += length
+    return pickle.loads(stream, buffers=buffers)
+
+
+def _aggregate(data, operation: SMPCOperation, weights=None, mean=False):
+    """
+    Aggregates a list of received values, e.g. the data pieces returned by
+    gather_data. Each data piece can be a numerical value, a (nested) list or
+    a numpy array, or a nested structure of dicts, lists and tuples
+    containing those, e.g. the layers of a model with different shapes. All
+    data pieces must have the same structure.
 
     Parameters
     ----------
@@ -1192,23 +3743,322 @@ def _aggregate(data, operation: SMPCOperation):
         list of data pieces
     operation : SMPCOperation
         operation to use for aggregation (add or multiply)
+    weights : list of float or None, default=None
+        weight of each data piece for a weighted sum (only with add)
+    mean : bool, default=False
+        if True, the (weighted) mean is returned instead of the sum (only with
+        add)
 
     Returns
     ----------
-    aggregated value
+    aggregated value, with the same structure as each data piece
     """
-    data_np = [np.array(d) for d in data]
+    data = list(data)
+    if not data:
+        raise ValueError('no data pieces were aggregated')
+    aggregator = _Aggregator(operation, mean=mean)
+    if weights is not None and operation == SMPCOperation.MULTIPLY:
+        raise ValueError('weights are only supported for the add operation')
+    flat = [_flatten(piece) for piece in data]
+    treedef = flat[0][1]
+    if any(other != treedef for _, other in flat[1:]):
+        raise ValueError('all data pieces to aggregate must have the same structure')
+    # all data pieces are available, so many small ones are reduced in a
+    # single vectorized call over the stack, larger ones in place one by one
+    n = len(data)
+    stacked = []
+    for i in range(len(flat[0][0])):
+        column = [leaves[i] for leaves, _ in flat]
+        if n > 2 and all(type(leaf) is np.ndarray and leaf.shape == column[0].shape for leaf in column) \
+                and n * column[0].nbytes <= AGGREGATE_STACK_SIZE:
+            stacked.append(_reduce_stacked(column, operation, weights))
+        else:
+            stacked.append(None)
+    for j, (leaves, _) in enumerate(flat):
+        aggregator.add_leaves([leaf if stacked[i] is None else None for i, leaf in enumerate(leaves)], treedef,
+                              weights[j] if weights is not None else None)
+    result = [leaf if stacked_leaf is None else stacked_leaf
+              for leaf, stacked_leaf in zip(aggregator.result_leaves(), stacked)]
+    if mean:
+        result = [_divide(leaf, aggregator.total_weight) for leaf in result]
+    return _unflatten(treedef, result)
+
+
+def _reduce_stacked(leaves, operation: SMPCOperation, weights=None):
+    dtype = np.result_type(*leaves) if weights is None else np.result_type(*leaves, *weights)
+    stack = np.stack(leaves)
+    if operation == SMPCOperation.MULTIPLY:
+        return np.prod(stack, axis=0, dtype=dtype)
+    if weights is not None:
+        return np.tensordot(np.asarray(weights, dtype=dtype), stack, axes=1)
+    return np.sum(stack, axis=0, dtype=dtype)
 
-    aggregate = data_np[0]
 
-    if operation == SMPCOperation.ADD:
-        for d in data_np[1:]:
-            aggregate = aggregate + d
+def _map_leaves(data, function):
+    """
+    Applies function to every value in a nested structure of dicts, lists and
+    tuples. Containers whose values are all returned unchanged are returned
+    themselves, not copied.
 
-    if operation == SMPCOperation.MULTIPLY:
-        for d in data_np[1:]:
-            aggregate = aggregate * d
+    Parameters
+    ----------
+    data : object
+    function : callable
+        maps a value to its replacement
+
+    Returns
+    ----------
+    the data with the replaced values
+    """
+    if isinstance(data, dict):
+        values = {key: _map_leaves(value, function) for key, value in data.items()}
+        changed = any(values[key] is not value for key, value in data.items())
+        return values if changed else data
+    if isinstance(data, (list, tuple)) and not hasattr(data, '_fields'):
+        values = [_map_leaves(value, function) for value in data]
+        changed = any(new is not old for new, old in zip(values, data))
+        return (tuple(values) if isinstance(data, tuple) else values) if changed else data
+    return function(data)
+
+
+def _content_key(data):
+    # hash of the content of data consisting of arrays, numbers and strings
+    # in dicts, lists and tuples, None for any other data
+    digest = hashlib.blake2b(digest_size=16)
+    plain = True
+
+    def update(leaf):
+        nonlocal plain
+        if isinstance(leaf, np.ndarray) and leaf.dtype != object:
+            digest.update(f'{leaf.dtype.str}{leaf.shape}'.encode())
+            digest.update(np.ascontiguousarray(leaf).view(np.uint8).reshape(-1))
+        elif isinstance(leaf, (bool, int, float, complex, str, bytes, np.generic)) or leaf is None:
+            digest.update(f'{type(leaf).__name__}:{leaf!r};'.encode())
+        else:
+            plain = False
+        return leaf
+
+    # the structure is part of the hash, as the leaves are visited in order
+    digest.update(repr(_map_leaves(data, lambda leaf: type(leaf).__name__)).encode())
+    _map_leaves(data, update)
+    return ('content', digest.hexdigest()) if plain else None
+
+
+def _divide(value, total):
+    if value.dtype.kind in 'fc':
+        np.divide(value, total, out=value)
+        return value
+    return value / total
+
+
+class _Aggregator:
+    """ Aggregates data pieces one after another into one preallocated
+        buffer per leaf, using in-place operations. Data pieces can be nested
+        structures of dicts, lists and tuples containing numerical values or
+        arrays (see _flatten).
+
+    Attributes
+    ----------
+    operation: SMPCOperation
+    mean: bool
+    count: int
+        number of data pieces added
+    total_weight: float
+
+    Methods
+    -------
+    add(data, weight=None)
+    result()
+    """
+
+    def __init__(self, operation: SMPCOperation = SMPCOperation.ADD, mean=False):
+        if operation == SMPCOperation.MULTIPLY and mean:
+            raise ValueError('mean is only supported for the add operation')
+        self.operation = operation
+        self.mean = mean
+        self.count = 0
+        self.total_weight = 0.0
+        self._treedef = None
+        self._buffers = None
+        self._scratch = None
+
+    def add(self, data, weight=None):
+        """ Adds a data piece to the aggregate.
+
+        Parameters
+        ----------
+        data: object
+            the data piece
+        weight: float or None, default=None
+            weight of the data piece (only with add)
+
+        """
+        leaves, treedef = _flatten(data)
+        self.add_leaves(leaves, treedef, weight)
+
+    def add_leaves(self, leaves, treedef, weight=None):
+        """ Adds an already flattened data piece to the aggregate. Leaves that
+            are None are skipped.
+
+        Parameters
+        ----------
+        leaves: list of np.ndarray
+        treedef: tuple
+            structure of the data piece, as returned by _flatten
+        weight: float or None, default=None
+
+        """
+        if weight is not None and self.operation == SMPCOperation.MULTIPLY:
+            raise ValueError('weights are only supported for the add operation')
+        if self._buffers is None:
+            self._treedef = treedef
+            self._buffers = [None] * len(leaves)
+            self._scratch = [None] * len(leaves)
+        elif treedef != self._treedef:
+            raise ValueError('all data pieces to aggregate must have the same structure')
+        for i, leaf in enumerate(leaves):
+            if leaf is not None:
+                self._add_leaf(i, leaf, weight)
+        self.count += 1
+        self.total_weight += 1.0 if weight is None else weight
+
+    def _add_leaf(self, i, leaf, weight):
+        if isinstance(leaf, QuantizedArray):
+            # dequantized to the original dtype, the buffer keeps at least that
+            leaf = leaf.to_dense()
+        elif is_sparse(leaf):
+            leaf = to_sparse_array(leaf)
+            if self.operation != SMPCOperation.MULTIPLY:
+                self._add_sparse_leaf(i, leaf, weight)
+                return
+            leaf = leaf.to_dense()
+        buffer = self._buffers[i]
+        if buffer is None:
+            # the first data piece, copy it into a new buffer that is owned by
+            # the aggregator, the data pieces themselves are never modified
+            dtype = leaf.dtype if weight is None else np.result_type(leaf, weight)
+            buffer = np.array(leaf, dtype=dtype, copy=True)
+            if weight is not None:
+                np.multiply(buffer, weight, out=buffer)
+            self._buffers[i] = buffer
+            return
+        dtype = np.result_type(buffer, leaf) if weight is None else np.result_type(buffer, leaf, weight)
+        shape = np.broadcast_shapes(buffer.shape, leaf.shape)
+        if dtype != buffer.dtype or shape != buffer.shape:
+            buffer = np.array(np.broadcast_to(buffer, shape), dtype=dtype)
+            self._buffers[i] = buffer
+            self._scratch[i] = None
+        if self.operation == SMPCOperation.MULTIPLY:
+            np.multiply(buffer, leaf, out=buffer)
+        elif weight is None:
+            np.add(buffer, leaf, out=buffer)
+        else:
+            scratch = self._scratch[i]
+            if scratch is None or scratch.shape != leaf.shape or scratch.dtype != buffer.dtype:
+                scratch = np.empty(leaf.shape, dtype=buffer.dtype)
+                self._scratch[i] = scratch
+            np.multiply(leaf, weight, out=scratch)
+            np.add(buffer, scratch, out=buffer)
+
+    def _add_sparse_leaf(self, i, leaf, weight):
+        # only the entries of the sparse data piece are touched
+        buffer = self._buffers[i]
+        dtype = leaf.dtype if weight is None else np.result_type(leaf.values, weight)
+        if buffer is None:
+            self._buffers[i] = buffer = np.zeros(leaf.shape, dtype=dtype)
+        elif buffer.shape != leaf.shape:
+            raise ValueError(f'cannot add a sparse array of shape {leaf.shape} to shape {buffer.shape}')
+        elif not buffer.flags.c_contiguous or np.result_type(buffer, dtype) != buffer.dtype:
+            self._buffers[i] = buffer = np.array(buffer, dtype=np.result_type(buffer, dtype), order='C')
+            self._scratch[i] = None
+        leaf.add_to(buffer, weight)
+
+    def result_leaves(self):
+        """ Returns the aggregated leaves (without dividing for the mean).
+
+        """
+        return list(self._buffers) if self._buffers is not None else []
+
+    def result(self):
+        """ Returns the aggregate, with the same structure as the data pieces.
+
+        """
+        if self._buffers is None:
+            raise ValueError('no data pieces were aggregated')
+        leaves = self.result_leaves()
+        if self.mean:
+            leaves = [_divide(leaf, self.total_weight) for leaf in leaves]
+        return _unflatten(self._treedef, leaves)
+
+
+def _flatten(data):
+    """
+    Flattens a data piece into a list of numpy arrays (leaves) and a
+    description of its structure. Encoded arrays (SparseArray, QuantizedArray or
+    scipy.sparse matrices) are kept as leaves. Dicts are always traversed, lists and tuples
+    only if they cannot be converted into a single numerical array (e.g. layers
+    of different shapes).
+
+    Parameters
+    ----------
+    data : object
+        the data piece
+
+    Returns
+    ----------
+    tuple (leaves, treedef)
+    """
+    leaves = []
+    treedef = _flatten_into(data, leaves)
+    return leaves, treedef
+
+
+def _flatten_into(data, leaves):
+    if isinstance(data, dict):
+        keys = list(data.keys())
+        return ('dict', tuple(keys), tuple(_flatten_into(data[key], leaves) for key in keys))
+    if isinstance(data, (list, tuple)):
+        try:
+            array = np.asarray(data)
+        except ValueError:
+            # ragged
+            array = None
+        if array is None or array.dtype == object:
+            kind = 'tuple' if isinstance(data, tuple) else 'list'
+            return (kind, len(data), tuple(_flatten_into(value, leaves) for value in data))
+        leaves.append(array)
+        return None
+    leaves.append(data if is_encoded(data) else np.asarray(data))
+    return None
+
+
+def _unflatten(treedef, leaves):
+    """
+    Rebuilds a data piece from its leaves and structure, see _flatten.
+
+    Parameters
+    ----------
+    treedef : tuple or None
+        structure of the data piece
+    leaves : list of np.ndarray
+
+    Returns
+    ----------
+    the data piece
+    """
+    return _unflatten_from(treedef, iter(leaves))
+
+
+def _unflatten_from(treedef, leaves):
+    if treedef is None:
+        leaf = next(leaves)
+        # numerical values are returned as numpy scalars, not 0-d arrays
+        return leaf[()] if isinstance(leaf, np.ndarray) and leaf.ndim == 0 else leaf
+    kind, keys, children = treedef
+    if kind == 'dict':
+        return {key: _unflatten_from(child, leaves) for key, child in zip(keys, children)}
+    values = [_unflatten_from(child, leaves) for child in children]
+    return tuple(values) if kind == 'tuple' else values
 
-    return aggregate
 
 app = App()
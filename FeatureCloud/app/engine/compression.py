@@ -0,0 +1,244 @@
+"""
+Compression of serialized data pieces before they are sent via the controller.
+Compressed data starts with a small header naming the codec, so it is
+decompressed transparently on the receiving side.
+"""
+import bz2
+import lzma
+import struct
+import time
+import zlib
+
+from enum import Enum
+
+COMPRESSION_MAGIC = b'FCZP'  # Marks compressed data
+COMPRESSION_MIN_SIZE = 1024  # Data smaller than this (bytes) is never compressed
+COMPRESSION_CHUNK_SIZE = 1024 * 1024  # Size (bytes) of the chunks data is decompressed in
+COMPRESSION_SAMPLE_SIZE = 1024 * 1024  # Size (bytes) of each sample the automatic codec selection is measured on
+COMPRESSION_SAMPLES = 3  # Number of samples taken from each data piece for the automatic codec selection
+DEFAULT_BANDWIDTH = 12.5e6  # Assumed bandwidth (bytes per second) to the controller/relay, 100 MBit/s
+DEFAULT_TRIALS = 3  # Number of data pieces measured before the automatic codec selection is fixed
+_HEADER = struct.Struct('<4sB3xQ')  # magic, codec id, original length
+
+
+class Compression(Enum):
+    """
+    | Describes the compression applied to data before it is sent out
+    | Can be one of the following values:
+    | Compression.NONE: no compression
+    | Compression.ZLIB: fast, moderate compression ratio
+    | Compression.BZ2: slower, good for repetitive data
+    | Compression.LZMA: slowest, best compression ratio
+    | Compression.AUTO: measures all codecs on the first data pieces and then uses the one with the shortest estimated
+    |   time for compression, transfer and decompression
+    """
+    NONE = 'none'
+    ZLIB = 'zlib'
+    BZ2 = 'bz2'
+    LZMA = 'lzma'
+    AUTO = 'auto'
+
+
+_CODEC_IDS = {Compression.ZLIB: 1, Compression.BZ2: 2, Compression.LZMA: 3}
+_CODECS = {codec_id: codec for codec, codec_id in _CODEC_IDS.items()}
+_DEFAULT_LEVELS = {Compression.ZLIB: 1, Compression.BZ2: 9, Compression.LZMA: 0}
+
+
+def _compress_raw(data, compression: Compression, level=None):
+    if level is None:
+        level = _DEFAULT_LEVELS[compression]
+    if compression == Compression.ZLIB:
+        return zlib.compress(data, level)
+    if compression == Compression.BZ2:
+        return bz2.compress(data, level)
+    return lzma.compress(data, preset=level)
+
+
+def _decompress_raw(data, compression: Compression):
+    if compression == Compression.ZLIB:
+        return zlib.decompress(data)
+    if compression == Compression.BZ2:
+        return bz2.decompress(data)
+    return lzma.decompress(data)
+
+
+def compress(data, compression: Compression, level=None):
+    """
+    Compresses serialized data and prepends the header describing the codec.
+
+    Parameters
+    ----------
+    data : bytes-like or str
+        serialized data
+    compression : Compression
+        the codec to use, Compression.NONE returns the data unchanged
+    level : int or None, default=None
+        compression level, if None a fast level of the codec is used
+
+    Returns
+    ----------
+    compressed data as bytes, or the data itself if it is small or does not
+    compress
+    """
+    if compression == Compression.NONE or compression is None:
+        return data
+    if compression == Compression.AUTO:
+        raise ValueError('Compression.AUTO must be resolved to a codec first, see CompressionSelector')
+    if isinstance(data, str):
+        data = data.encode()
+    view = memoryview(data).cast('B')
+    if view.nbytes < COMPRESSION_MIN_SIZE or is_compressed(view):
+        # small or already compressed (e.g. forwarded) data
+        return data
+    compressed = _compress_raw(view, compression, level)
+    if len(compressed) + _HEADER.size >= view.nbytes:
+        # not compressible, send the data as it is
+        return data
+    return _HEADER.pack(COMPRESSION_MAGIC, _CODEC_IDS[compression], view.nbytes) + compressed
+
+
+def is_compressed(data):
+    """
+    Checks whether data was compressed with compress.
+
+    Parameters
+    ----------
+    data : bytes-like
+        serialized data
+
+    Returns
+    ----------
+    bool
+    """
+    return memoryview(data)[:len(COMPRESSION_MAGIC)] == COMPRESSION_MAGIC
+
+
+def decompress(data):
+    """
+    Decompresses data compressed with compress into a preallocated, writable
+    buffer, chunk by chunk.
+
+    Parameters
+    ----------
+    data : bytes-like
+        compressed data including the header
+
+    Returns
+    ----------
+    decompressed data as bytearray
+    """
+    view = memoryview(data).cast('B')
+    _, codec_id, length = _HEADER.unpack_from(view)
+    codec = _CODECS.get(codec_id)
+    if codec is None:
+        raise ValueError(f'unknown compression codec {codec_id}, please update the FeatureCloud package')
+    compressed = view[_HEADER.size:]
+    out = bytearray(length)
+    target = memoryview(out)
+    offset = 0
+    if codec == Compression.ZLIB:
+        decompressor = zlib.decompressobj()
+        while offset < length:
+            chunk = decompressor.decompress(compressed, COMPRESSION_CHUNK_SIZE)
+            compressed = decompressor.unconsumed_tail
+            if not chunk:
+                break
+            target[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+    else:
+        decompressor = bz2.BZ2Decompressor() if codec == Compression.BZ2 else lzma.LZMADecompressor()
+        while offset < length and not decompressor.eof:
+            chunk = decompressor.decompress(compressed, max_length=COMPRESSION_CHUNK_SIZE)
+            compressed = b''
+            if not chunk and decompressor.needs_input:
+                break
+            target[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+    if offset != length:
+        raise ValueError(f'compressed data is truncated, got {offset} of {length} bytes')
+    return out
+
+
+class CompressionSelector:
+    """ Picks the codec with the shortest estimated end-to-end time, i.e.
+        compression, transfer and decompression time, for Compression.AUTO.
+        For the first data pieces (trials), every codec is measured on a few
+        samples of the data. Afterwards, the best codec is used for all data.
+
+    Attributes
+    ----------
+    bandwidth: float
+        assumed bandwidth in bytes per second
+    trials: int
+        number of data pieces to measure
+    level: int or None
+        compression level passed to the codecs
+    costs: dict
+        Compression => accumulated estimated seconds per byte of data
+    choice: Compression or None
+        the selected codec, once all trials are done
+
+    Methods
+    -------
+    select(data)
+    """
+
+    def __init__(self, bandwidth: float = DEFAULT_BANDWIDTH, trials: int = DEFAULT_TRIALS, level=None):
+        self.bandwidth = bandwidth
+        self.trials = trials
+        self.level = level
+        self.costs = {codec: 0.0 for codec in [Compression.NONE] + list(_CODEC_IDS)}
+        self.trials_done = 0
+        self.choice = None
+
+    def select(self, data):
+        """
+        Returns the codec to compress the given data with. Measures the codecs
+        on the data while trials are left.
+
+        Parameters
+        ----------
+        data : bytes-like or str
+            serialized data
+
+        Returns
+        ----------
+        Compression
+        """
+        if self.choice is not None:
+            return self.choice
+        if isinstance(data, str):
+            data = data.encode()
+        view = memoryview(data).cast('B')
+        if view.nbytes < COMPRESSION_MIN_SIZE:
+            return Compression.NONE
+        samples = self._samples(view)
+        sample_size = sum(sample.nbytes for sample in samples)
+        for codec in self.costs:
+            if codec == Compression.NONE:
+                seconds = sample_size / self.bandwidth
+            else:
+                start = time.perf_counter()
+                compressed = [_compress_raw(sample, codec, self.level) for sample in samples]
+                compress_time = time.perf_counter() - start
+                start = time.perf_counter()
+                for part in compressed:
+                    _decompress_raw(part, codec)
+                decompress_time = time.perf_counter() - start
+                compressed_size = sum(len(part) for part in compressed)
+                seconds = compress_time + decompress_time + compressed_size / self.bandwidth
+            self.costs[codec] += seconds / sample_size
+        self.trials_done += 1
+        best = min(self.costs, key=self.costs.get)
+        if self.trials_done >= self.trials:
+            self.choice = best
+        return best
+
+    @staticmethod
+    def _samples(view):
+        # evenly spaced samples, so data with different sections (e.g. a
+        # sparse and a dense layer) is represented
+        if view.nbytes <= COMPRESSION_SAMPLE_SIZE * COMPRESSION_SAMPLES:
+            return [view]
+        step = (view.nbytes - COMPRESSION_SAMPLE_SIZE) // (COMPRESSION_SAMPLES - 1)
+        return [view[i * step:i * step + COMPRESSION_SAMPLE_SIZE] for i in range(COMPRESSION_SAMPLES)]
@@ -0,0 +1,562 @@
+"""
+Sparse and quantized encoding of data pieces, e.g. gradient or model updates.
+Arrays that are mostly zeros or dominated by a few large entries are sent as
+index/value pairs (SparseArray), optionally reduced to their k largest entries
+(top-k sparsification) with the dropped part carried over to the next round
+(error feedback). scipy.sparse matrices (e.g. CSR) are sent as they are.
+Dense arrays can be sent with reduced precision (QuantizedArray). Versioned
+data is sent as the changes against its previous version (Delta).
+
+Encoded arrays are decoded to dense numpy arrays while they are unpickled,
+unless this happens inside keep_encoded(), which aggregate_data uses to add
+them straight into its dense buffers, see _Aggregator in app.py.
+"""
+import contextvars
+import math
+
+from contextlib import contextmanager
+from enum import Enum
+
+import numpy as np
+
+try:
+    # optional, CSR and other sparse matrices can be sent and aggregated
+    import scipy.sparse as scipy_sparse
+except ImportError:
+    scipy_sparse = None
+
+SPARSE_MIN_SIZE = 1024  # Arrays with fewer elements are always sent dense
+SPARSE_MAX_DENSITY = 0.5  # Arrays with a larger share of non-zero (or kept) entries are sent dense
+QUANTIZATION_MIN_SIZE = 1024  # Arrays with fewer elements are never quantized
+QUANTIZATION_BLOCK_SIZE = 256  # Number of elements sharing one scale and zero point with Quantization.INT8
+
+_decode = contextvars.ContextVar('decode', default=True)
+    # whether unpickled encoded arrays are decoded, see keep_encoded
+
+
+class Quantization(Enum):
+    """
+    | The reduced precision floating point arrays are sent with
+    | Quantization.NONE: full precision
+    | Quantization.FLOAT16: IEEE half precision, values beyond its range are sent in full precision
+    | Quantization.BFLOAT16: the upper 16 bits of float32 (same range as float32, 8 bits of precision)
+    | Quantization.INT8: 8 bits per value, with a scale and zero point per block of values
+    """
+    NONE = 'none'
+    FLOAT16 = 'float16'
+    BFLOAT16 = 'bfloat16'
+    INT8 = 'int8'
+
+
+class SparseArray:
+    """ An array stored as the flat indices and values of its non-zero
+        entries.
+
+    Attributes
+    ----------
+    shape: tuple
+    dtype: np.dtype
+    indices: np.ndarray
+        flat (C order) indices of the entries, unique
+    values: np.ndarray
+        values of the entries
+
+    Methods
+    -------
+    from_dense(array)
+    to_dense()
+    add_to(buffer, weight)
+    """
+    __slots__ = ('shape', 'indices', 'values')
+
+    def __init__(self, shape, indices, values):
+        self.shape = tuple(shape)
+        self.indices = indices
+        self.values = values
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def size(self):
+        return math.prod(self.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes
+
+    @property
+    def density(self):
+        return len(self.values) / max(self.size, 1)
+
+    def __getstate__(self):
+        return self.shape, self.indices, self.values
+
+    def __setstate__(self, state):
+        self.shape, self.indices, self.values = state
+
+    def __reduce__(self):
+        return _rebuild, (SparseArray, self.__getstate__())
+
+    def __repr__(self):
+        return f'SparseArray(shape={self.shape}, dtype={self.dtype}, nnz={len(self.values)})'
+
+    @classmethod
+    def from_dense(cls, array):
+        """ Encodes the non-zero entries of an array.
+
+        """
+        array = np.asarray(array)
+        flat = array.reshape(-1)
+        indices = np.flatnonzero(flat).astype(_index_dtype(flat.size), copy=False)
+        return cls(array.shape, indices, flat[indices])
+
+    def to_dense(self):
+        """ Returns the array as a dense numpy array.
+
+        """
+        dense = np.zeros(self.size, dtype=self.dtype)
+        dense[self.indices] = self.values
+        return dense.reshape(self.shape)
+
+    def add_to(self, buffer, weight=None):
+        """ Adds the (weighted) entries to a dense buffer of the same shape in
+            place.
+
+        Parameters
+        ----------
+        buffer: np.ndarray
+            C-contiguous
+        weight: float or None, default=None
+
+        """
+        values = self.values if weight is None else self.values * weight
+        # the indices are unique, so no np.add.at is needed
+        buffer.reshape(-1)[self.indices] += values
+
+
+class SparseEncoder:
+    """ Encodes the arrays of data pieces as SparseArray. With k or ratio,
+        only the entries with the largest magnitude of each array are kept
+        (top-k sparsification), otherwise all non-zero entries. With error
+        feedback, the entries that were not sent are added to the array sent
+        next with the same key and position, so no part of an update is lost,
+        only delayed.
+
+    Attributes
+    ----------
+    k: int or None
+        number of entries kept per array
+    ratio: float or None
+        share of entries kept per array, if k is None
+    error_feedback: bool
+    min_size: int
+        arrays with fewer elements are sent dense
+    residuals: dict
+        maps (key, position of the array, shape, dtype) to the residual not
+        sent yet
+
+    Methods
+    -------
+    encode(leaves, key)
+    reset()
+    """
+
+    def __init__(self, k=None, ratio=None, error_feedback=True, min_size=SPARSE_MIN_SIZE):
+        if k is not None and k < 1:
+            raise ValueError('k must be at least 1')
+        if ratio is not None and not 0 < ratio <= 1:
+            raise ValueError('ratio must be in (0, 1]')
+        self.k = k
+        self.ratio = ratio
+        self.error_feedback = error_feedback
+        self.min_size = min_size
+        self.residuals = {}
+
+    def encode(self, leaves, key=None):
+        """ Encodes the leaves of a data piece (see _flatten in app.py).
+            Floating point arrays of at least min_size elements are
+            sparsified, all other leaves are returned as they are.
+
+        Parameters
+        ----------
+        leaves: list of np.ndarray
+        key: hashable, default=None
+            identifies the stream of data pieces the residuals belong to,
+            e.g. the destination, the name of the stream and the structure
+            of the data
+
+        Returns
+        -------
+        list of np.ndarray or SparseArray
+        """
+        return [self._encode_leaf((key, i, leaf.shape, leaf.dtype.str), leaf) if _sparsifiable(leaf, self.min_size)
+                else leaf for i, leaf in enumerate(leaves)]
+
+    def reset(self):
+        """ Drops all residuals.
+
+        """
+        self.residuals.clear()
+
+    def _encode_leaf(self, key, leaf):
+        feedback = self.error_feedback and (self.k is not None or self.ratio is not None)
+        residual = self.residuals.get(key) if feedback else None
+        flat = leaf.reshape(-1)
+        if residual is not None:
+            flat = flat + residual
+        if self.k is not None:
+            k = self.k
+        elif self.ratio is not None:
+            k = math.ceil(self.ratio * flat.size)
+        else:
+            k = flat.size
+        if k >= flat.size:
+            indices = np.flatnonzero(flat)
+        else:
+            indices = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k:]
+            indices.sort()
+        indices = indices.astype(_index_dtype(flat.size), copy=False)
+        values = flat[indices]
+        if feedback:
+            residual = np.array(flat, copy=residual is None)
+            residual[indices] = 0
+            self.residuals[key] = residual
+        if len(indices) > SPARSE_MAX_DENSITY * flat.size:
+            # index/value pairs would be larger than the dense array
+            return _put(leaf.shape, leaf.dtype, indices, values)
+        return SparseArray(leaf.shape, indices, values)
+
+
+class QuantizedArray:
+    """ A floating point array stored with reduced precision.
+
+    Attributes
+    ----------
+    shape: tuple
+    dtype: np.dtype
+        dtype of the original array, the array is decoded to
+    quantization: Quantization
+    codes: np.ndarray
+        the quantized values (float16, uint16 or uint8)
+    scale: np.ndarray or None
+        scale of each block (INT8 only)
+    offset: np.ndarray or None
+        zero point of each block, i.e. the value of code 0 (INT8 only)
+
+    Methods
+    -------
+    quantize(array, quantization, block_size, stochastic)
+    to_dense()
+    """
+    __slots__ = ('shape', 'dtype', 'quantization', 'codes', 'scale', 'offset')
+
+    def __init__(self, shape, dtype, quantization, codes, scale=None, offset=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.quantization = quantization
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+
+    @property
+    def size(self):
+        return math.prod(self.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return sum(part.nbytes for part in (self.codes, self.scale, self.offset) if part is not None)
+
+    def __getstate__(self):
+        return self.shape, self.dtype.str, self.quantization.value, self.codes, self.scale, self.offset
+
+    def __setstate__(self, state):
+        shape, dtype, quantization, self.codes, self.scale, self.offset = state
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.quantization = Quantization(quantization)
+
+    def __reduce__(self):
+        return _rebuild, (QuantizedArray, self.__getstate__())
+
+    def __repr__(self):
+        return f'QuantizedArray(shape={self.shape}, dtype={self.dtype}, quantization={self.quantization.value})'
+
+    @classmethod
+    def quantize(cls, array, quantization: Quantization, block_size: int = QUANTIZATION_BLOCK_SIZE,
+                 stochastic: bool = False, rng=None):
+        """ Quantizes a float32 or float64 array. Returns the array itself
+            if it cannot be represented, e.g. with values outside the range
+            of float16 (FLOAT16) or float32 (BFLOAT16), or non-finite values
+            for INT8, and any array of another dtype.
+
+        Parameters
+        ----------
+        array: np.ndarray
+        quantization: Quantization
+        block_size: int, default=QUANTIZATION_BLOCK_SIZE
+            number of values sharing one scale and zero point (INT8 only)
+        stochastic: bool, default=False
+            round up or down at random, with the probability given by the
+            distance to both values, so the rounding error is zero in
+            expectation (BFLOAT16 and INT8 only)
+        rng: np.random.Generator or None, default=None
+            random numbers for stochastic rounding
+
+        Returns
+        -------
+        QuantizedArray or np.ndarray
+        """
+        if array.dtype not in (np.float32, np.float64):
+            # float16 gains nothing, longdouble is not supported by all operations below
+            return array
+        flat = np.ascontiguousarray(array).reshape(-1)
+        if stochastic and rng is None:
+            rng = np.random.default_rng()
+        if quantization == Quantization.FLOAT16:
+            if flat.size and np.abs(flat).max() > np.finfo(np.float16).max:
+                return array
+            return cls(array.shape, array.dtype, quantization, flat.astype(np.float16))
+        if quantization == Quantization.BFLOAT16:
+            with np.errstate(over='ignore'):
+                single = flat.astype(np.float32)
+            if flat.dtype != np.float32 and (np.isinf(single) & np.isfinite(flat)).any():
+                # outside the range of float32
+                return array
+            bits = single.view(np.uint32)
+            if stochastic:
+                rounded = bits + rng.integers(0, 1 << 16, size=bits.size, dtype=np.uint32)
+            else:
+                # round to nearest, ties to even
+                rounded = bits + (np.uint32(0x7fff) + ((bits >> 16) & 1))
+            # rounding must not turn the largest finite values into inf
+            exponent = np.uint32(0x7f800000)
+            overflow = ((rounded & exponent) == exponent) & ((bits & exponent) != exponent)
+            rounded = np.where(overflow, bits, rounded)
+            codes = (rounded >> 16).astype(np.uint16)
+            codes[np.isnan(flat)] = 0x7fc0
+            return cls(array.shape, array.dtype, quantization, codes)
+        if quantization == Quantization.INT8:
+            if not np.isfinite(flat).all():
+                return array
+            blocks = -(-flat.size // block_size)
+            padded = np.empty(blocks * block_size, dtype=flat.dtype)
+            padded[:flat.size] = flat
+            padded[flat.size:] = flat[-1] if flat.size else 0
+            padded = padded.reshape(blocks, block_size)
+            low = padded.min(axis=1, keepdims=True)
+            with np.errstate(over='ignore'):
+                scale = (padded.max(axis=1, keepdims=True) - low) / 255
+                single_scale, single_low = scale.astype(np.float32), low.astype(np.float32)
+            if not (np.isfinite(single_scale).all() and np.isfinite(single_low).all()):
+                # scales and zero points are stored as float32
+                return array
+            codes = (padded - low) / np.where(scale > 0, scale, 1)
+            if stochastic:
+                codes = np.floor(codes + rng.random(codes.shape, dtype=codes.dtype))
+            else:
+                codes = np.rint(codes)
+            codes = np.clip(codes, 0, 255).astype(np.uint8)
+            return cls(array.shape, array.dtype, quantization, codes.reshape(-1),
+                       single_scale.reshape(-1), single_low.reshape(-1))
+        return array
+
+    def to_dense(self):
+        """ Returns the array as a dense numpy array of its original dtype.
+
+        """
+        if self.quantization == Quantization.FLOAT16:
+            flat = self.codes.astype(self.dtype)
+        elif self.quantization == Quantization.BFLOAT16:
+            flat = (self.codes.astype(np.uint32) << 16).view(np.float32).astype(self.dtype, copy=False)
+        else:
+            blocks = self.codes.reshape(len(self.scale), -1)
+            flat = np.multiply(blocks, self.scale[:, None], dtype=self.dtype)
+            flat += self.offset[:, None]
+            flat = flat.reshape(-1)[:self.size]
+        return flat.reshape(self.shape)
+
+
+@contextmanager
+def keep_encoded():
+    """
+    Context manager in which unpickled SparseArrays and QuantizedArrays are
+    kept encoded instead of being decoded to dense numpy arrays.
+    """
+    token = _decode.set(False)
+    try:
+        yield
+    finally:
+        _decode.reset(token)
+
+
+def decoding() -> bool:
+    """
+    Returns whether encoded arrays are decoded, i.e. False inside keep_encoded.
+    """
+    return _decode.get()
+
+
+def decode(value):
+    """
+    Returns a SparseArray or QuantizedArray as dense numpy array, any other
+    value as it is.
+    """
+    return value.to_dense() if isinstance(value, (SparseArray, QuantizedArray)) else value
+
+
+def is_encoded(value) -> bool:
+    """
+    Returns whether value is a SparseArray, a QuantizedArray or a
+    scipy.sparse matrix.
+    """
+    return is_sparse(value) or isinstance(value, QuantizedArray)
+
+
+def is_sparse(value) -> bool:
+    """
+    Returns whether value is a SparseArray or a scipy.sparse matrix.
+    """
+    return isinstance(value, SparseArray) or (scipy_sparse is not None and scipy_sparse.issparse(value))
+
+
+def to_sparse_array(value) -> SparseArray:
+    """
+    Converts a scipy.sparse matrix (e.g. CSR) to a SparseArray, SparseArrays
+    are returned as they are.
+    """
+    if isinstance(value, SparseArray):
+        return value
+    coo = value.tocoo()
+    coo.sum_duplicates()
+    indices = np.ravel_multi_index((coo.row, coo.col), coo.shape).astype(_index_dtype(math.prod(coo.shape)))
+    return SparseArray(coo.shape, indices, coo.data)
+
+
+def _rebuild(cls, state):
+    array = cls.__new__(cls)
+    array.__setstate__(state)
+    return array.to_dense() if _decode.get() else array
+
+
+def _sparsifiable(leaf, min_size):
+    return isinstance(leaf, np.ndarray) and leaf.size >= min_size and leaf.dtype.kind in 'fc'
+
+
+def _put(shape, dtype, indices, values):
+    dense = np.zeros(math.prod(shape), dtype=dtype)
+    dense[indices] = values
+    return dense.reshape(shape)
+
+
+def _index_dtype(size):
+    return np.int32 if size <= np.iinfo(np.int32).max else np.int64
+
+
+class Delta:
+    """ A versioned data piece, see broadcast_data(delta=...). A snapshot
+        (base is None) carries the data itself, otherwise the numpy arrays in
+        the data are replaced by ArrayPatches against version base.
+
+    Attributes
+    ----------
+    key: str
+        name of the versioned data
+    version: int
+    base: int or None
+        the version the patches apply to, None for a snapshot
+    value: object
+    """
+    __slots__ = ('key', 'version', 'base', 'value')
+
+    def __init__(self, key, version, base, value):
+        self.key = key
+        self.version = version
+        self.base = base
+        self.value = value
+
+    def __getstate__(self):
+        return self.key, self.version, self.base, self.value
+
+    def __setstate__(self, state):
+        self.key, self.version, self.base, self.value = state
+
+
+class ArrayPatch:
+    """ The changes of one array against its previous version: nothing
+        (indices and values are None), all values (indices is None) or the
+        values at the given flat indices.
+    """
+    __slots__ = ('indices', 'values')
+
+    def __init__(self, indices=None, values=None):
+        self.indices = indices
+        self.values = values
+
+    def __getstate__(self):
+        return self.indices, self.values
+
+    def __setstate__(self, state):
+        self.indices, self.values = state
+
+
+def diff_arrays(previous, arrays):
+    """
+    Computes the patches turning the previous arrays into the new ones and
+    updates the previous arrays (copies owned by the caller) to the new ones.
+
+    Parameters
+    ----------
+    previous : list of np.ndarray
+        the arrays of the previous version (C-contiguous), modified in place
+    arrays : list of np.ndarray
+        the arrays of the new version, same number as previous
+
+    Returns
+    ----------
+    list of ArrayPatch
+    """
+    patches = []
+    for i, (old, new) in enumerate(zip(previous, arrays)):
+        if old.shape != new.shape or old.dtype != new.dtype or new.dtype.kind not in 'biufc':
+            previous[i] = np.array(new, copy=True, order='C')
+            patches.append(ArrayPatch(None, new))
+            continue
+        indices = np.flatnonzero(old != new).astype(_index_dtype(new.size), copy=False)
+        if not len(indices):
+            patches.append(ArrayPatch())
+        elif len(indices) > SPARSE_MAX_DENSITY * new.size:
+            np.copyto(old, new)
+            patches.append(ArrayPatch(None, new))
+        else:
+            values = np.ascontiguousarray(new).reshape(-1)[indices]
+            old.reshape(-1)[indices] = values
+            patches.append(ArrayPatch(indices, values))
+    return patches
+
+
+def apply_patches(bases, patches):
+    """
+    Applies patches created by diff_arrays to the arrays of the previous
+    version (copies owned by the caller) in place.
+
+    Parameters
+    ----------
+    bases : list of np.ndarray
+        the arrays of the previous version (C-contiguous), modified in place
+    patches : list of ArrayPatch
+    """
+    for i, patch in enumerate(patches):
+        if patch.indices is not None:
+            bases[i].reshape(-1)[patch.indices] = patch.values
+        elif patch.values is not None:
+            bases[i] = np.array(patch.values, copy=True, order='C')
@@ -0,0 +1,174 @@
+"""
+Non-blocking log output for the app engine and the HTTP handlers. Log
+messages are put into a queue and written to stdout/stderr by a background
+thread, so the state thread and the threads answering the controller never
+wait for the output.
+"""
+import atexit
+import datetime
+import queue
+import sys
+import threading
+import time
+
+LOG_QUEUE_SIZE = 10000  # Number of log messages buffered before new ones are dropped
+REQUEST_LOG_INTERVAL = 1.0  # Time window (seconds) for rate limiting request logs
+REQUEST_LOG_BURST = 10  # Number of identical request logs written per time window
+
+
+class LogWriter:
+    """ Writes log messages in a background thread.
+
+    Attributes
+    ----------
+    buffered: bool
+        if False, messages are written right away by the calling thread
+    request_interval: float
+        time window (seconds) of the rate limit of request logs
+    request_burst: int or None
+        number of identical request logs written per time window, None
+        does not limit them
+    dropped: int
+        number of messages dropped because the queue was full
+
+    Methods
+    -------
+    write(msg, level, error)
+    request(line, key)
+    flush()
+    """
+
+    def __init__(self, buffered: bool = True, queue_size: int = LOG_QUEUE_SIZE,
+                 request_interval: float = REQUEST_LOG_INTERVAL, request_burst=REQUEST_LOG_BURST):
+        self.buffered = buffered
+        self.request_interval = request_interval
+        self.request_burst = request_burst
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+            # held while writing, separate from _lock so a blocked output
+            # never blocks the callers
+        self._requests = {}
+            # dictionary mapping key: [window start, lines written, lines suppressed]
+        self._second = None
+        self._stamp = ''
+
+    def write(self, msg: str, level=None, error: bool = False):
+        """ Writes a log message, formatted as
+            [Time: <time>] [Level: <level>] <msg>, or as it is if level is None.
+
+        Parameters
+        ----------
+        msg: str
+            the message
+        level: str or None, default=None
+            the name of the level
+        error: bool, default=False
+            whether to write to stderr instead of stdout
+
+        """
+        record = (time.time(), level, msg, error)
+        if not self.buffered:
+            with self._write_lock:
+                self._emit([record])
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def request(self, line: str, key=None):
+        """ Writes the log line of a request, at most request_burst lines with
+            the same key per request_interval. The number of suppressed lines
+            is appended to the next line written.
+
+        Parameters
+        ----------
+        line: str
+            the log line, e.g. '[CTRL] GET /data'
+        key: str or None, default=None
+            identifies similar requests, the line itself if None
+
+        """
+        if self.request_burst is not None:
+            key = line if key is None else key
+            now = time.monotonic()
+            with self._lock:
+                window = self._requests.get(key)
+                if window is None or now - window[0] >= self.request_interval:
+                    suppressed = window[2] if window is not None else 0
+                    self._requests[key] = [now, 1, 0]
+                elif window[1] < self.request_burst:
+                    window[1] += 1
+                    suppressed = 0
+                else:
+                    window[2] += 1
+                    return
+            if suppressed:
+                line = f'{line} (and {suppressed} more not logged)'
+        self.write(line)
+
+    def flush(self):
+        """ Blocks until all buffered messages are written.
+
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            try:
+                while len(records) < 1000:
+                    records.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                with self._write_lock:
+                    self._emit(records)
+            except Exception:  # never stop writing  # noqa
+                pass
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+    def _emit(self, records):
+        # write consecutive messages of the same stream at once
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            records = [(time.time(), None, f'[{dropped} log messages were dropped]', True)] + records
+        lines = []
+        error = records[0][3]
+        for timestamp, level, msg, is_error in records:
+            if is_error != error:
+                _write(lines, error)
+                lines, error = [], is_error
+            lines.append(msg if level is None else f'[Time: {self._format_time(timestamp)}] [Level: {level}] {msg}')
+        _write(lines, error)
+
+    def _format_time(self, timestamp):
+        second = int(timestamp)
+        if second != self._second:
+            self._second = second
+            self._stamp = datetime.datetime.fromtimestamp(second).strftime("%d.%m.%y %H:%M:%S")
+        return self._stamp
+
+
+def _write(lines, error):
+    stream = sys.stderr if error else sys.stdout
+    stream.write('\n'.join(lines) + '\n')
+    stream.flush()
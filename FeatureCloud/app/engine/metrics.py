@@ -0,0 +1,137 @@
+"""
+Metrics recorded by the app engine, e.g. the time spent in each state or the
+bytes sent per memo. They are exposed in the Prometheus text format on
+/web/metrics and can be written to a file at the end of the workflow.
+"""
+import threading
+import time
+
+from contextlib import contextmanager
+
+METRICS = {
+    # name: (type, help)
+    'fc_state_seconds_total': ('counter', 'Wall time spent running each state'),
+    'fc_state_runs_total': ('counter', 'Number of times each state was run'),
+    'fc_await_seconds_total': ('counter', 'Time states were blocked waiting for data'),
+    'fc_serialize_seconds_total': ('counter', 'Time spent serializing outgoing data'),
+    'fc_serialize_bytes_total': ('counter', 'Bytes of serialized outgoing data'),
+    'fc_deserialize_seconds_total': ('counter', 'Time spent deserializing received data'),
+    'fc_deserialize_bytes_total': ('counter', 'Bytes of deserialized received data'),
+    'fc_sent_bytes_total': ('counter', 'Bytes fetched by the controller, per memo and destination'),
+    'fc_sent_messages_total': ('counter', 'Data pieces fetched by the controller, per memo and destination'),
+    'fc_received_bytes_total': ('counter', 'Bytes received, per memo and sending client'),
+    'fc_received_messages_total': ('counter', 'Data pieces received, per memo and sending client'),
+    'fc_round_wait_seconds': ('gauge', 'Time the last await of each memo was blocked until all data arrived'),
+    'fc_round_spread_seconds': ('gauge', 'Time between the first and the last data piece of each memo'),
+    'fc_outgoing_queue_depth': ('gauge', 'Data pieces waiting to be fetched by the controller'),
+    'fc_outgoing_queue_bytes': ('gauge', 'Bytes waiting to be fetched by the controller'),
+    'fc_incoming_pieces': ('gauge', 'Received data pieces not taken by a state yet'),
+    'fc_incoming_memory_bytes': ('gauge', 'Bytes of received data kept in memory'),
+    'fc_incoming_spilled_bytes_total': ('counter', 'Bytes of received data spilled to disk'),
+    'fc_delta_broadcasts_total': ('counter', 'Versioned broadcasts sent, per key and kind (delta or snapshot)'),
+}
+
+
+class Metrics:
+    """ Thread-safe store of counters and gauges, identified by name and
+        labels.
+
+    Methods
+    -------
+    inc(name, value, **labels)
+    set(name, value, **labels)
+    timer(name, **labels)
+    values()
+    render(extra)
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        """ Increases a counter.
+
+        Parameters
+        ----------
+        name: str
+            name of the metric
+        value: float, default=1.0
+            the amount to add
+        labels: str
+            labels of the metric
+
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """ Sets a gauge.
+
+        Parameters
+        ----------
+        name: str
+            name of the metric
+        value: float
+            the new value
+        labels: str
+            labels of the metric
+
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """ Context manager adding the seconds spent inside it to a counter.
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name, time.perf_counter() - start, **labels)
+
+    def values(self):
+        """ Returns all metrics as dict mapping (name, labels) to the value.
+
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, extra=None) -> str:
+        """ Renders all metrics in the Prometheus text format.
+
+        Parameters
+        ----------
+        extra: dict or None, default=None
+            additional metrics, mapping (name, labels) to the value
+
+        Returns
+        -------
+        str
+        """
+        values = self.values()
+        if extra:
+            values.update(extra)
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(by_name):
+            kind, description = METRICS.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if labels:
+                    label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+                    lines.append(f'{name}{{{label_text}}} {value:.17g}')
+                else:
+                    lines.append(f'{name} {value:.17g}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,293 @@
+"""
+Tracing of the lifecycle of data pieces (serialized, queued, announced via
+/status, fetched via GET /data, received, taken by a state) and of the states,
+exported in the Chrome trace event format. The traces of all clients can be
+merged into one file and opened with Perfetto (https://ui.perfetto.dev) or
+chrome://tracing:
+
+    python -m FeatureCloud.app.engine.tracing merged.json client1.json client2.json
+"""
+import collections
+import json
+import sys
+import threading
+import time
+import zlib
+
+TRACE_MAX_EVENTS = 1000000  # Events recorded at most, later events are dropped
+
+_TRACKS = {'states': 1, 'outgoing': 2, 'incoming': 3}
+
+
+class Tracer:
+    """ Records trace events of one client. All methods do nothing while the
+        tracer is disabled. Timestamps are wall clock times, so traces of
+        different clients can be merged. Memos are passed as given by the
+        sender, i.e. not URL-encoded. Each data piece is linked to its
+        receivers by flow events, whose ids count the data pieces with the
+        same memo between each pair of clients, as the controller delivers
+        the data pieces of a client in order.
+
+    Attributes
+    ----------
+    enabled: bool
+    events: list
+        the recorded trace events
+    dropped: int
+        number of events dropped after TRACE_MAX_EVENTS
+
+    Methods
+    -------
+    now()
+    set_client(client_id, coordinator, clients, coordinator_id)
+    span(track, name, start, end, **args)
+    outgoing_enqueued(status, start)
+    outgoing_advertised(status)
+    outgoing_fetched(status, memo, nbytes)
+    outgoing_retain(statuses)
+    incoming_received(memo, client, nbytes)
+    incoming_consumed(memo, count)
+    dump(path)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.dropped = 0
+        self._pid = 0
+        self._client = None
+        self._coordinator = False
+        self._clients = []
+        self._coordinator_id = None
+        self._lock = threading.Lock()
+        self._outgoing = {}
+            # dictionary mapping id(status): [status, serialize start, enqueued, advertised]
+        self._incoming = collections.defaultdict(collections.deque)
+            # dictionary mapping memo: deque of (received, client, bytes), in arrival order
+        self._sent = collections.Counter()
+            # counter of the data pieces sent per (memo, receiver)
+        self._received = collections.Counter()
+            # counter of the data pieces received per (memo, sender)
+
+    @staticmethod
+    def now() -> float:
+        """ Returns the current time in microseconds, as used in the trace.
+
+        """
+        return time.time() * 1e6
+
+    def set_client(self, client_id, coordinator=False, clients=(), coordinator_id=None):
+        """ Names the process of the trace after the client. The other
+            clients are needed to link data pieces to their receivers.
+
+        """
+        self._client = client_id
+        self._coordinator = coordinator
+        self._clients = list(clients or [])
+        self._coordinator_id = coordinator_id
+        self._pid = zlib.crc32(str(client_id).encode()) & 0x7fffffff
+        role = 'coordinator' if coordinator else 'participant'
+        with self._lock:
+            self.events = [event for event in self.events if event.get('ph') != 'M']
+            self.events.append({'name': 'process_name', 'ph': 'M', 'pid': self._pid,
+                                'args': {'name': f'client {client_id} ({role})'}})
+            for track, tid in _TRACKS.items():
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                                    'args': {'name': track}})
+            # keep recorded events in the process of the client
+            for event in self.events:
+                event['pid'] = self._pid
+
+    def span(self, track, name, start, end, **args):
+        """ Records a span on one of the tracks 'states', 'outgoing' or
+            'incoming'.
+
+        Parameters
+        ----------
+        track: str
+        name: str
+        start: float
+            microseconds, see now()
+        end: float
+            microseconds, see now()
+        args: dict
+            additional information shown with the span
+
+        """
+        if not self.enabled:
+            return
+        self._add({'name': name, 'cat': track, 'ph': 'X', 'ts': start, 'dur': max(end - start, 0),
+                   'pid': self._pid, 'tid': _TRACKS[track], 'args': args})
+
+    def outgoing_enqueued(self, status, start):
+        """ A data piece was serialized (starting at start) and added to the
+            outgoing queue with the given status.
+
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._outgoing[id(status)] = [status, start, self.now(), None]
+
+    def outgoing_advertised(self, status):
+        """ The status of a queued data piece was served on /status.
+
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            record = self._outgoing.get(id(status))
+            if record is not None and record[0] is status and record[3] is None:
+                record[3] = self.now()
+
+    def outgoing_fetched(self, status, memo, nbytes):
+        """ The data piece queued with the given status was fetched via
+            GET /data. Records its serialization, its time in the queue and
+            the time between announcing and fetching it.
+
+        Parameters
+        ----------
+        status: dict
+            the status the data piece was queued with
+        memo: str
+            the memo of the data piece, as given by the sender
+        nbytes: int
+            size of the data piece
+
+        """
+        if not self.enabled:
+            return
+        fetched = self.now()
+        with self._lock:
+            record = self._outgoing.pop(id(status), None)
+        if record is None or record[0] is not status:
+            return
+        _, start, enqueued, advertised = record
+        advertised = advertised if advertised is not None else fetched
+        destination = status.get('destination')
+        args = {'memo': memo, 'destination': destination, 'bytes': nbytes}
+        self.span('outgoing', f'serialize {memo}', start, enqueued, **args)
+        self.span('outgoing', f'queued {memo}', enqueued, advertised, **args)
+        self.span('outgoing', f'fetch {memo}', advertised, fetched, **args)
+        # arrows to the receiving clients, see incoming_received
+        if destination is not None:
+            receivers = [destination]
+        elif self._coordinator:
+            # broadcast
+            receivers = [client for client in self._clients if client != self._client]
+        else:
+            receivers = [self._coordinator_id]
+        for receiver in receivers:
+            with self._lock:
+                self._sent[memo, receiver] += 1
+                sequence = self._sent[memo, receiver]
+            self._add({'name': 'message', 'cat': 'message', 'ph': 's',
+                       'id': _flow_id(self._client, receiver, memo, sequence),
+                       'ts': fetched, 'pid': self._pid, 'tid': _TRACKS['outgoing']})
+
+    def outgoing_retain(self, statuses):
+        """ Forgets the data pieces queued with statuses other than the given
+            ones, e.g. removed from the queue without being fetched.
+
+        Parameters
+        ----------
+        statuses: list
+            the statuses of the data pieces still in the queue
+
+        """
+        if not self.enabled:
+            return
+        queued = {id(status) for status in statuses}
+        with self._lock:
+            for key in [key for key in self._outgoing if key not in queued]:
+                del self._outgoing[key]
+
+    def incoming_received(self, memo, client, nbytes):
+        """ A data piece with the given memo arrived from client.
+
+        """
+        if not self.enabled:
+            return
+        received = self.now()
+        with self._lock:
+            self._incoming[memo].append((received, client, nbytes))
+            if client == self._client:
+                # sent to itself without the controller, no arrow
+                return
+            self._received[memo, client] += 1
+            sequence = self._received[memo, client]
+        self._add({'name': 'message', 'cat': 'message', 'ph': 'f', 'bp': 'e',
+                   'id': _flow_id(client, self._client, memo, sequence),
+                   'ts': received, 'pid': self._pid, 'tid': _TRACKS['incoming']})
+
+    def incoming_consumed(self, memo, count):
+        """ The first count data pieces with the given memo were taken by a
+            state (or evicted). Records the time each of them was buffered.
+
+        """
+        if not self.enabled:
+            return
+        consumed = self.now()
+        with self._lock:
+            pieces = self._incoming.get(memo)
+            taken = [pieces.popleft() for _ in range(min(count, len(pieces)))] if pieces else []
+            if pieces is not None and not pieces:
+                del self._incoming[memo]
+        for received, client, nbytes in taken:
+            self.span('incoming', f'buffered {memo}', received, consumed, memo=memo, client=client, bytes=nbytes)
+
+    def dump(self, path):
+        """ Writes the trace in the Chrome trace event format.
+
+        Parameters
+        ----------
+        path: str
+
+        """
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'client': self._client, 'dropped': self.dropped}}, file)
+
+    def _add(self, event):
+        with self._lock:
+            if len(self.events) >= TRACE_MAX_EVENTS:
+                self.dropped += 1
+                return
+            self.events.append(event)
+
+
+def _flow_id(sender, receiver, memo, sequence):
+    # the same on both clients: the sequence-th data piece with the memo
+    # from sender to receiver
+    return f'{sender}>{receiver}/{memo}#{sequence}'
+
+
+def merge_traces(paths, output):
+    """
+    Merges the traces of several clients into one trace file.
+
+    Parameters
+    ----------
+    paths : list of str
+        trace files written by Tracer.dump
+    output : str
+        the merged trace file
+    """
+    events = []
+    clients = []
+    for path in paths:
+        with open(path) as file:
+            trace = json.load(file)
+        events.extend(trace['traceEvents'])
+        clients.append(trace.get('otherData', {}).get('client'))
+    with open(output, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'clients': clients}}, file)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python -m FeatureCloud.app.engine.tracing OUTPUT TRACE [TRACE ...]', file=sys.stderr)
+        sys.exit(1)
+    merge_traces(sys.argv[2:], sys.argv[1])
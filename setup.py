@@ -19,13 +19,14 @@ setuptools.setup(name="FeatureCloud",
                      "Operating System :: OS Independent",
                  ],
                  packages=setuptools.find_packages(include=['FeatureCloud', 'FeatureCloud.*']),
-                 python_requires=">=3.7",
+                 python_requires=">=3.8",
                  entry_points={'console_scripts': ['FeatureCloud = FeatureCloud.api.cli.__main__:fc_cli',
                                                    'featurecloud = FeatureCloud.api.cli.__main__:fc_cli',
                                                    ]
                                },
                  install_requires=['bottle', 'jsonpickle', 'joblib', 'numpy', 'pydot', 'pyyaml', 'flake8~=3.9.2',
                                    'pycodestyle~=2.7.0', 'Click~=8.0.1', 'requests', 'urllib3~=1.26.6',
-                                   'pandas>=2.0', 'pyinstaller', 'docker==7.1.0', 'gitpython', 'tqdm']
+                                   'pandas>=2.0', 'pyinstaller', 'docker==7.1.0', 'gitpython', 'tqdm'],
+                 extras_require={'speedups': ['orjson']}
 
                  )
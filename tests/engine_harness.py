@@ -0,0 +1,109 @@
+"""
+In-process stand-in for the FeatureCloud controller, used by the engine
+tests: several App instances run their workflows in the same process, and
+the data each of them queues is routed to the handle_incoming of the
+receiving apps, as the controller does via GET /status, GET /data and
+POST /data.
+"""
+import json
+import time
+import urllib.parse
+
+from FeatureCloud.app.engine.app import App, AppState, LogLevel, Role, State, _FrameParts, app_state
+
+
+def make_app(client_id='c0', coordinator=True, clients=None, coordinator_id=None):
+    """
+    Creates an app with a single state that never runs, whose methods can
+    be called from the test directly.
+
+    Returns
+    ----------
+    tuple (App, AppState)
+    """
+    app = App()
+    app.log_level = LogLevel.ERROR
+
+    @app_state('initial', Role.BOTH, app)
+    class InitialState(AppState):
+        def register(self):
+            self.register_transition('terminal')
+
+        def run(self):
+            return 'terminal'
+
+    app.register(preload=False)
+    app.id = client_id
+    app.coordinator = coordinator
+    app.clients = list(clients) if clients is not None else [client_id]
+    app.coordinatorID = coordinator_id if coordinator_id is not None else client_id
+    app.current_state = app.states['initial']
+    return app, app.states['initial']
+
+
+def run_workflow(n, build, timeout=30, apps=None):
+    """
+    Runs the workflow of n clients until all of them finished. Client c0 is
+    the coordinator.
+
+    Parameters
+    ----------
+    n : int
+        number of clients
+    build : callable
+        called with each App to register its states, e.g. with app_state
+    timeout : float, default=30
+        seconds after which the test fails
+    apps : dict or None, default=None
+        apps (client ID: App) that were set up already, build is not called
+
+    Returns
+    ----------
+    dict mapping client ID: App
+    """
+    ids = [f'c{i}' for i in range(n)]
+    if apps is None:
+        apps = {}
+        for client_id in ids:
+            app = App()
+            app.log_level = LogLevel.ERROR
+            build(app)
+            app.register()
+            apps[client_id] = app
+    for client_id in ids:
+        apps[client_id].handle_setup(client_id, client_id == ids[0], ids, ids[0])
+    finished = set()
+    deadline = time.monotonic() + timeout
+    while len(finished) < n:
+        if time.monotonic() > deadline:
+            raise AssertionError(f'workflow did not finish within {timeout} seconds, finished: {sorted(finished)}')
+        idle = True
+        for client_id in ids:
+            status = json.loads(apps[client_id].handle_status_encoded()[1])
+            if status['state'] == State.ERROR.value:
+                raise AssertionError(f'client {client_id} failed with {status["message"]}')
+            if status['finished']:
+                finished.add(client_id)
+            if not status['available']:
+                continue
+            idle = False
+            data = apps[client_id].handle_outgoing()
+            if isinstance(data, _FrameParts):
+                # GET /data streams the parts one after another
+                data = data.join()
+            if status['destination'] is not None:
+                receivers = [status['destination']]
+            elif client_id == ids[0]:
+                receivers = [other for other in ids if other != client_id]
+            else:
+                receivers = [ids[0]]
+            memo = urllib.parse.quote(status['memo']) if status['memo'] else None
+            for receiver in receivers:
+                # received as writable buffer, like POST /data does
+                received = bytearray(data) if isinstance(data, (bytes, bytearray)) else data
+                apps[receiver].handle_incoming(received, client_id, memo=memo)
+        if idle:
+            time.sleep(0.001)
+    for app in apps.values():
+        app.thread.join(timeout)
+    return apps
@@ -0,0 +1,243 @@
+import http.client
+import json
+import mmap
+import socket
+import threading
+import time
+from unittest import TestCase, mock
+
+from FeatureCloud.app.api import http_ctrl
+from FeatureCloud.app.api import server as server_module
+from FeatureCloud.app.api.server import ServerBackend, ThreadedWSGIServer, create_server
+from FeatureCloud.app.engine.app import app
+from engine_harness import make_app
+
+
+def start_server(**kwargs):
+    """ Serves the controller API of the default app on a free port. """
+    server = ThreadedWSGIServer(('localhost', 0), **kwargs)
+    server.set_app(create_server())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+class ServerTestCase(TestCase):
+    keepalive = 5
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_server(keepalive=cls.keepalive)
+        cls.port = cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server)
+
+    def tearDown(self):
+        with app._incoming_lock:
+            for memo in list(app.data_incoming):
+                app._take_incoming(memo, len(app.data_incoming[memo]))
+
+    def connect(self, port=None):
+        return http.client.HTTPConnection('localhost', port or self.port, timeout=10)
+
+    def request(self, method, path, body=None, headers=None, connection=None):
+        connection = connection or self.connect()
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+
+class DataTransferTestCase(ServerTestCase):
+
+    def test_get_data_in_chunks(self):
+        payload = bytes(range(256)) * (3 * http_ctrl.DATA_CHUNK_SIZE // 256 + 7)
+        app.data_outgoing.append(payload, app.get_current_status(available=True, memo='get'))
+        response, status = self.request('GET', '/api/status')
+        assert json.loads(status)['available']
+        response, body = self.request('GET', '/api/data')
+        assert response.status == 200
+        assert int(response.getheader('Content-Length')) == len(payload)
+        assert body == payload
+        assert len(app.data_outgoing) == 0
+
+    def test_post_data(self):
+        payload = bytes(range(256)) * (2 * http_ctrl.DATA_CHUNK_SIZE // 256 + 3)
+        response, _ = self.request('POST', '/api/data?client=c1&memo=post', body=payload)
+        assert response.status == 200
+        [(data, client)] = app.data_incoming['post']
+        assert client == 'c1'
+        # writable, so deserialized arrays can be views on it
+        assert isinstance(data, bytearray) and data == payload
+
+    def test_post_data_chunked(self):
+        payload = b'x' * 100000
+        chunks = (payload[i:i + 30000] for i in range(0, len(payload), 30000))
+        connection = self.connect()
+        connection.request('POST', '/api/data?client=c1&memo=chunked', body=chunks, encode_chunked=True)
+        assert connection.getresponse().status == 200
+        assert app.data_incoming['chunked'][0][0] == payload
+
+    def test_post_data_spooled(self):
+        payload = b'y' * 50000
+        with mock.patch.object(http_ctrl, 'DATA_SPOOL_SIZE', 10000):
+            response, _ = self.request('POST', '/api/data?client=c1&memo=spooled', body=payload)
+        assert response.status == 200
+        data = app.data_incoming['spooled'][0][0]
+        assert isinstance(data, mmap.mmap) and data[:] == payload
+
+    def test_iter_chunks(self):
+        text = 'abc' * 1000
+        with mock.patch.object(http_ctrl, 'DATA_CHUNK_SIZE', 1024):
+            chunks = list(http_ctrl._iter_chunks(text))
+            assert [len(chunk) for chunk in chunks] == [1024, 1024, 952]
+            assert b''.join(chunks) == text.encode()
+            assert b''.join(http_ctrl._iter_chunks(bytearray(3000))) == bytes(3000)
+
+
+class ConcurrentServingTestCase(ServerTestCase):
+
+    def test_idle_connections(self):
+        idle = [self.connect() for _ in range(8)]
+        for connection in idle:
+            assert self.request('GET', '/api/status', connection=connection)[0].status == 200
+        start = time.perf_counter()
+        response, _ = self.request('GET', '/api/status')
+        assert response.status == 200 and time.perf_counter() - start < 1
+        # the idle connections are still usable
+        for connection in idle:
+            assert self.request('GET', '/api/status', connection=connection)[0].status == 200
+            connection.close()
+
+    def test_keep_alive(self):
+        connection = self.connect()
+        self.request('GET', '/api/status', connection=connection)
+        sock = connection.sock
+        for _ in range(5):
+            response, _ = self.request('GET', '/api/status', connection=connection)
+            assert response.status == 200 and response.getheader('Connection') != 'close'
+        assert connection.sock is sock
+        connection.close()
+
+    def test_status_during_slow_upload(self):
+        uploads = []
+        for i in range(2):
+            upload = socket.create_connection(('localhost', self.port))
+            upload.sendall(f'POST /api/data?client=c1&memo=slow{i} HTTP/1.1\r\nHost: localhost\r\n'
+                           f'Content-Length: 10\r\n\r\n12345'.encode())
+            uploads.append(upload)
+        time.sleep(0.1)
+        # status polls are answered while the request bodies are still arriving
+        start = time.perf_counter()
+        assert self.request('GET', '/api/status')[0].status == 200
+        assert time.perf_counter() - start < 1
+        for upload in uploads:
+            upload.sendall(b'67890')
+        for i, upload in enumerate(uploads):
+            assert upload.recv(100).startswith(b'HTTP/1.1 200')
+            upload.close()
+            assert app.data_incoming[f'slow{i}'][0][0] == b'1234567890'
+
+
+class ServerLimitsTestCase(TestCase):
+
+    def test_request_size(self):
+        server = start_server(max_request_size=1000)
+        try:
+            connection = http.client.HTTPConnection('localhost', server.server_address[1], timeout=10)
+            connection.request('POST', '/api/data?client=c1&memo=large', body=b'x' * 1001)
+            response = connection.getresponse()
+            assert response.status == 413
+            assert 'large' not in app.data_incoming
+        finally:
+            stop_server(server)
+
+    def test_idle_connections_expire(self):
+        server = start_server(keepalive=0.2)
+        try:
+            connection = http.client.HTTPConnection('localhost', server.server_address[1], timeout=10)
+            connection.request('GET', '/api/status')
+            connection.getresponse().read()
+            time.sleep(1.0)
+            # closed by the server
+            assert connection.sock.recv(1) == b''
+        finally:
+            stop_server(server)
+
+    def test_close_idle_connections(self):
+        server = start_server(keepalive=60)
+        connection = http.client.HTTPConnection('localhost', server.server_address[1], timeout=10)
+        connection.request('GET', '/api/status')
+        connection.getresponse().read()
+        start = time.perf_counter()
+        stop_server(server)
+        assert time.perf_counter() - start < 2
+        assert connection.sock.recv(1) == b''
+        time.sleep(0.1)
+        assert not server._connections
+
+    def test_installed_backend(self):
+        with mock.patch.dict('sys.modules', {'waitress': None, 'cheroot': None}):
+            assert server_module._installed_backend() == ServerBackend.THREADED
+        with mock.patch.dict('sys.modules', {'waitress': None, 'cheroot': mock.Mock()}):
+            assert server_module._installed_backend() == ServerBackend.CHEROOT
+
+
+class StatusTestCase(ServerTestCase):
+
+    def test_cache(self):
+        engine, _ = make_app()
+        version, status = engine.handle_status_encoded()
+        assert engine.handle_status_encoded()[1] is status
+        assert json.loads(status)['available'] is False
+        engine.data_outgoing.append(b'data', engine.get_current_status(available=True, memo='m'))
+        new_version, status = engine.handle_status_encoded()
+        assert new_version > version and json.loads(status)['memo'] == 'm'
+        engine.status_message = 'changed'
+        assert engine.status_version > new_version
+
+    def test_wait_status(self):
+        engine, _ = make_app()
+        version = engine.status_version
+        assert not engine.wait_status(0.05)
+        assert not engine.wait_status(0.05, version)
+        timer = threading.Timer(0.1, engine.data_outgoing.append, (b'data', {'available': True}))
+        timer.start()
+        start = time.perf_counter()
+        assert engine.wait_status(5)
+        assert time.perf_counter() - start < 1
+        assert engine.wait_status(0, version)
+
+    def test_etag(self):
+        response, _ = self.request('GET', '/api/status')
+        etag = response.getheader('ETag')
+        response, body = self.request('GET', '/api/status', headers={'If-None-Match': etag})
+        assert response.status == 304 and body == b''
+        response, _ = self.request('GET', '/api/status', headers={'If-None-Match': '"-1"'})
+        assert response.status == 200
+
+    def test_long_poll(self):
+        status = app.get_current_status(available=True, memo='poll')
+        timer = threading.Timer(0.2, app.data_outgoing.append, (b'data', status))
+        timer.start()
+        start = time.perf_counter()
+        response, body = self.request('GET', '/api/status?wait=5')
+        assert 0.1 < time.perf_counter() - start < 2
+        assert json.loads(body)['memo'] == 'poll'
+        assert self.request('GET', '/api/data')[1] == b'data'
+        assert self.request('GET', '/api/status?wait=abc')[0].status == 400
+
+
+class MetricsEndpointTestCase(ServerTestCase):
+
+    def test_metrics(self):
+        app.metrics.inc('fc_state_runs_total', state='initial')
+        response, body = self.request('GET', '/web/metrics')
+        assert response.status == 200
+        assert response.getheader('Content-Type').startswith('text/plain; version=0.0.4')
+        assert b'# TYPE fc_state_runs_total counter' in body and b'fc_outgoing_queue_depth' in body
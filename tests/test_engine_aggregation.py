@@ -0,0 +1,329 @@
+from unittest import TestCase, mock
+
+import numpy as np
+
+from FeatureCloud.app.engine import app as app_module
+from FeatureCloud.app.engine.app import AppState, Role, SMPCOperation, _aggregate, _Aggregator, _flatten, \
+    _unflatten, app_state
+from FeatureCloud.app.engine.encoding import Quantization
+from engine_harness import make_app, run_workflow
+
+
+def pieces(n, seed=0):
+    """ n data pieces of a model with layers of different shapes and dtypes. """
+    rng = np.random.default_rng(seed)
+    return [{'layers': [rng.random((4, 3)), rng.random(5).astype(np.float32)],
+             'counts': rng.integers(0, 10, 6),
+             'n': int(rng.integers(1, 100))} for _ in range(n)]
+
+
+class AggregatorTestCase(TestCase):
+
+    def test_sum(self):
+        data = pieces(4)
+        aggregator = _Aggregator()
+        for piece in data:
+            aggregator.add(piece)
+        result = aggregator.result()
+        for i in range(2):
+            np.testing.assert_allclose(result['layers'][i], sum(piece['layers'][i] for piece in data), rtol=1e-6)
+        assert result['layers'][1].dtype == np.float32
+        np.testing.assert_array_equal(result['counts'], sum(piece['counts'] for piece in data))
+        assert result['n'] == sum(piece['n'] for piece in data)
+        # the data pieces are not modified
+        np.testing.assert_array_equal(data[0]['layers'][0], pieces(4)[0]['layers'][0])
+        np.testing.assert_array_equal(data[0]['counts'], pieces(4)[0]['counts'])
+
+    def test_weighted_mean(self):
+        data = pieces(3)
+        weights = [1.0, 2.0, 5.0]
+        aggregator = _Aggregator(mean=True)
+        for piece, weight in zip(data, weights):
+            aggregator.add(piece, weight)
+        result = aggregator.result()
+        expected = sum(w * piece['layers'][0] for piece, w in zip(data, weights)) / sum(weights)
+        np.testing.assert_allclose(result['layers'][0], expected)
+        # integer data is promoted instead of truncated
+        expected = sum(w * piece['counts'] for piece, w in zip(data, weights)) / sum(weights)
+        np.testing.assert_allclose(result['counts'], expected)
+
+    def test_multiply(self):
+        aggregator = _Aggregator(SMPCOperation.MULTIPLY)
+        for value in ([1, 2], [3, 4], [0.5, 0.5]):
+            aggregator.add(value)
+        np.testing.assert_allclose(aggregator.result(), [1.5, 4.0])
+        with self.assertRaises(ValueError):
+            aggregator.add([1, 1], weight=2.0)
+        with self.assertRaises(ValueError):
+            _Aggregator(SMPCOperation.MULTIPLY, mean=True)
+
+    def test_promotion(self):
+        aggregator = _Aggregator()
+        aggregator.add(np.array([1, 2], dtype=np.int32))
+        aggregator.add(np.array([0.5, 0.25]))
+        result = aggregator.result()
+        assert result.dtype == np.float64
+        np.testing.assert_array_equal(result, [1.5, 2.25])
+
+    def test_structure_mismatch(self):
+        aggregator = _Aggregator()
+        aggregator.add({'a': [1.0, 2.0]})
+        with self.assertRaises(ValueError):
+            aggregator.add({'b': [1.0, 2.0]})
+        with self.assertRaises(ValueError):
+            _Aggregator().result()
+
+    def test_aggregate(self):
+        # as called by apps on the result of gather_data
+        np.testing.assert_array_equal(_aggregate([[1, 2], [3, 4], [5, 6]], SMPCOperation.ADD), [9, 12])
+        np.testing.assert_array_equal(_aggregate([[1, 2], [3, 4]], SMPCOperation.MULTIPLY), [3, 8])
+        data = pieces(5, seed=6)
+        weights = [1.0, 2.0, 3.0, 4.0, 5.0]
+        result = _aggregate(data, SMPCOperation.ADD, weights=weights, mean=True)
+        for i in range(2):
+            expected = sum(w * piece['layers'][i] for piece, w in zip(data, weights)) / sum(weights)
+            np.testing.assert_allclose(result['layers'][i], expected, rtol=1e-6)
+        np.testing.assert_allclose(result['counts'],
+                                   sum(w * piece['counts'] for piece, w in zip(data, weights)) / sum(weights))
+
+    def test_aggregate_stacked(self):
+        data = pieces(6, seed=7)
+        weights = [float(i + 1) for i in range(6)]
+        with mock.patch.object(app_module, '_reduce_stacked', wraps=app_module._reduce_stacked) as reduce:
+            stacked = _aggregate(data, SMPCOperation.ADD, weights=weights, mean=True)
+            # all four leaves are small
+            assert reduce.call_count == 4
+        with mock.patch.object(app_module, 'AGGREGATE_STACK_SIZE', 0):
+            in_place = _aggregate(data, SMPCOperation.ADD, weights=weights, mean=True)
+        for i in range(2):
+            np.testing.assert_allclose(stacked['layers'][i], in_place['layers'][i], rtol=1e-6)
+            assert stacked['layers'][i].dtype == in_place['layers'][i].dtype
+        np.testing.assert_allclose(stacked['counts'], in_place['counts'])
+        np.testing.assert_allclose(stacked['n'], in_place['n'])
+        np.testing.assert_allclose(_aggregate([np.full(3, 2.0)] * 4, SMPCOperation.MULTIPLY), np.full(3, 16.0))
+        with self.assertRaises(ValueError):
+            _aggregate([[1.0], [2.0], [3.0]], SMPCOperation.MULTIPLY, weights=[1.0, 1.0, 1.0])
+
+    def test_flatten(self):
+        data = {'layers': [np.ones((2, 2)), np.ones(3)], 'scalars': (1, 2.5), 'n': 3}
+        leaves, treedef = _flatten(data)
+        # the ragged layers stay a list, the homogeneous tuple becomes one leaf
+        assert len(leaves) == 4
+        rebuilt = _unflatten(treedef, leaves)
+        assert isinstance(rebuilt['layers'], list)
+        np.testing.assert_array_equal(rebuilt['scalars'], [1, 2.5])
+        assert rebuilt['n'] == 3 and isinstance(rebuilt['n'], np.integer)
+
+
+class StreamingAggregationTestCase(TestCase):
+
+    def test_iter_data_in_arrival_order(self):
+        app, state = make_app()
+        for client in ('c2', 'c1'):
+            app.handle_incoming(app.serialize_outgoing(client.upper()), client, memo='round')
+        received = state.iter_data(n=3, memo='round', with_client=True)
+        assert next(received) == ('C2', 'c2')
+        assert next(received) == ('C1', 'c1')
+        assert not app.data_incoming
+        app.handle_incoming(app.serialize_outgoing('C0'), 'c0', memo='round')
+        assert next(received) == ('C0', 'c0')
+        assert list(received) == []
+
+    def test_aggregate_data(self):
+        data = pieces(4, seed=1)
+        weights = {f'c{i}': float(i + 1) for i in range(4)}
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    piece = data[int(self.id[1:])]
+                    self.send_data_to_coordinator(piece, memo='sum')
+                    self.send_data_to_coordinator(piece, memo='mean')
+                    if self.is_coordinator:
+                        self.store('sum', self.aggregate_data(memo='sum'))
+                        self.store('mean', self.aggregate_data(memo='mean', weights=weights, mean=True))
+                    return 'terminal'
+
+        apps = run_workflow(4, build)
+        result = apps['c0'].internal['sum']
+        np.testing.assert_allclose(result['layers'][0], sum(piece['layers'][0] for piece in data))
+        np.testing.assert_array_equal(result['counts'], sum(piece['counts'] for piece in data))
+        assert result['n'] == sum(piece['n'] for piece in data)
+        result = apps['c0'].internal['mean']
+        total = sum(weights.values())
+        for i in range(2):
+            expected = sum(weights[f'c{j}'] * piece['layers'][i] for j, piece in enumerate(data)) / total
+            np.testing.assert_allclose(result['layers'][i], expected, rtol=1e-6)
+        assert result['n'] == sum(weights[f'c{j}'] * piece['n'] for j, piece in enumerate(data)) / total
+
+
+class TreeAggregationTestCase(TestCase):
+
+    def test_aggregate_tree(self):
+        data = pieces(6, seed=2)
+        weights = [float(i + 1) for i in range(6)]
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    i = int(self.id[1:])
+                    self.store('sum', self.aggregate_tree(data[i], memo='sum', fan_in=2))
+                    self.store('mean', self.aggregate_tree(data[i], memo='mean', weight=weights[i], mean=True,
+                                                           fan_in=2))
+                    self.store('flat', self.aggregate_tree(data[i], fan_in=5))
+                    return 'terminal'
+
+        apps = run_workflow(6, build)
+        for client in ('c1', 'c5'):
+            assert apps[client].internal['sum'] is None
+        for result in (apps['c0'].internal['sum'], apps['c0'].internal['flat']):
+            np.testing.assert_allclose(result['layers'][0], sum(piece['layers'][0] for piece in data))
+            np.testing.assert_array_equal(result['counts'], sum(piece['counts'] for piece in data))
+            assert result['n'] == sum(piece['n'] for piece in data)
+        result = apps['c0'].internal['mean']
+        for i in range(2):
+            expected = sum(w * piece['layers'][i] for piece, w in zip(data, weights)) / sum(weights)
+            np.testing.assert_allclose(result['layers'][i], expected, rtol=1e-6)
+        expected = sum(w * piece['counts'] for piece, w in zip(data, weights)) / sum(weights)
+        np.testing.assert_allclose(result['counts'], expected)
+        # the coordinator only receives from its fan_in children
+        received = [key for key in apps['c0'].metrics.values()
+                    if key[0] == 'fc_received_messages_total' and ('memo', 'sum') in key[1]]
+        assert sorted(dict(labels)['client'] for _, labels in received) == ['c1', 'c2']
+
+    def test_partial_aggregates_not_quantized(self):
+        rng = np.random.default_rng(4)
+        data = {f'c{i}': rng.random(2000).astype(np.float32) for i in range(3)}
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    self.configure_quantization(Quantization.INT8)
+                    # the leaves c3, c4 and c5 send zeros, which quantization keeps exact
+                    piece = data.get(self.id, np.zeros(2000, dtype=np.float32))
+                    self.store('sum', self.aggregate_tree(piece, memo='sum', fan_in=2))
+                    return 'terminal'
+
+        result = run_workflow(6, build)['c0'].internal['sum']
+        np.testing.assert_allclose(result, sum(data.values()), rtol=1e-6)
+
+    def test_coordinator_id_required(self):
+        app, state = make_app()
+        app.coordinatorID = None
+        with self.assertRaises(RuntimeError):
+            state.aggregate_tree(np.ones(3))
+
+
+class AllReduceTestCase(TestCase):
+
+    def test_all_reduce(self):
+        data = pieces(4, seed=3)
+        weights = [1.0, 3.0, 0.5, 2.0]
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    i = int(self.id[1:])
+                    self.store('sum', self.all_reduce(data[i], memo='sum'))
+                    self.store('mean', self.all_reduce(data[i], memo='mean', weight=weights[i], mean=True))
+                    # fewer elements than clients, so some chunks are empty
+                    self.store('product', self.all_reduce(np.array([i + 1, 2.0]), SMPCOperation.MULTIPLY))
+                    return 'terminal'
+
+        apps = run_workflow(4, build)
+        for app in apps.values():
+            result = app.internal['sum']
+            for i in range(2):
+                np.testing.assert_allclose(result['layers'][i], sum(piece['layers'][i] for piece in data), rtol=1e-6)
+            assert result['layers'][1].dtype == np.float32
+            np.testing.assert_array_equal(result['counts'], sum(piece['counts'] for piece in data))
+            assert result['n'] == sum(piece['n'] for piece in data)
+            result = app.internal['mean']
+            for key in ('counts', 'n'):
+                expected = sum(w * piece[key] for piece, w in zip(data, weights)) / sum(weights)
+                np.testing.assert_allclose(result[key], expected)
+            expected = sum(w * piece['layers'][0] for piece, w in zip(data, weights)) / sum(weights)
+            np.testing.assert_allclose(result['layers'][0], expected)
+            np.testing.assert_allclose(app.internal['product'], [24.0, 16.0])
+
+    def test_not_quantized(self):
+        rng = np.random.default_rng(5)
+        data = [rng.random(8000).astype(np.float32) for _ in range(4)]
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    self.configure_quantization(Quantization.INT8)
+                    self.store('sum', self.all_reduce(data[int(self.id[1:])]))
+                    return 'terminal'
+
+        apps = run_workflow(4, build)
+        for app in apps.values():
+            np.testing.assert_allclose(app.internal['sum'], sum(data), rtol=1e-6)
+
+
+class ScatterTestCase(TestCase):
+
+    def drain(self, app):
+        """ The data pieces queued by app, by destination. """
+        sent = {}
+        while app.handle_status()['available']:
+            destination = app.handle_status()['destination']
+            sent[destination] = app.deserialize_incoming(app.handle_outgoing())
+        return sent
+
+    def test_shared_serialization(self):
+        app, state = make_app(clients=['c0', 'c1', 'c2', 'c3', 'c4'])
+        shared = {'w': np.arange(10.0)}
+        mapping = {'c0': shared, 'c1': shared, 'c2': shared, 'c3': {'w': np.arange(10.0)}, 'c4': 'own'}
+        with mock.patch.object(app, 'serialize_outgoing', wraps=app.serialize_outgoing) as serialize:
+            state.scatter(mapping, memo='scatter')
+            # the shared object once, the equal copy and the string separately
+            assert serialize.call_count == 3
+            sent = self.drain(app)
+            state.scatter(mapping, memo='hashed', hash_content=True)
+            assert serialize.call_count == 5
+            assert self.drain(app).keys() == {'c1', 'c2', 'c3', 'c4'}
+        assert sent.keys() == {'c1', 'c2', 'c3', 'c4'} and sent['c4'] == 'own'
+        for client in ('c1', 'c2', 'c3'):
+            np.testing.assert_array_equal(sent[client]['w'], np.arange(10.0))
+        # the data for this client is delivered without serialization
+        np.testing.assert_array_equal(state.await_data(memo='scatter')['w'], shared['w'])
+
+    def test_workflow(self):
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    if self.is_coordinator:
+                        self.scatter({client: np.full(100, int(client[1:])) for client in self.clients},
+                                     memo='partition', workers=2)
+                    self.store('partition', self.await_data(memo='partition'))
+                    return 'terminal'
+
+        apps = run_workflow(4, build)
+        for client, app in apps.items():
+            np.testing.assert_array_equal(app.internal['partition'], np.full(100, int(client[1:])))
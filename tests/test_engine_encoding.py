@@ -0,0 +1,271 @@
+from unittest import TestCase
+
+import numpy as np
+
+from FeatureCloud.app.engine.app import AppState, Role, _dumps_frame, _loads_frame, app_state
+from FeatureCloud.app.engine.encoding import ArrayPatch, Delta, QuantizedArray, Quantization, SparseArray, \
+    SparseEncoder, apply_patches, diff_arrays, keep_encoded
+from engine_harness import make_app, run_workflow
+
+
+class SparseTestCase(TestCase):
+
+    def test_sparse_array(self):
+        dense = np.zeros((30, 40))
+        dense[3, 5], dense[29, 39] = 1.5, -2.0
+        sparse = SparseArray.from_dense(dense)
+        assert len(sparse.values) == 2 and sparse.indices.dtype == np.int32
+        np.testing.assert_array_equal(sparse.to_dense(), dense)
+        buffer = np.ones((30, 40))
+        sparse.add_to(buffer, weight=2.0)
+        np.testing.assert_array_equal(buffer, 1 + 2 * dense)
+        frame = _dumps_frame({'w': sparse})
+        # decoded on receipt, unless kept encoded for aggregate_data
+        np.testing.assert_array_equal(_loads_frame(frame)['w'], dense)
+        with keep_encoded():
+            assert isinstance(_loads_frame(frame)['w'], SparseArray)
+
+    def test_error_feedback(self):
+        rng = np.random.default_rng(0)
+        encoder = SparseEncoder(k=50)
+        updates = [rng.normal(size=(100, 20)) for _ in range(10)]
+        sent = np.zeros((100, 20))
+        for update in updates:
+            [encoded] = encoder.encode([update], key='stream')
+            assert isinstance(encoded, SparseArray) and len(encoded.values) == 50
+            sent += encoded.to_dense()
+        [residual] = encoder.residuals.values()
+        # nothing is lost, only delayed
+        np.testing.assert_allclose(sent + residual.reshape(100, 20), sum(updates))
+
+    def test_without_top_k(self):
+        encoder = SparseEncoder(min_size=10)
+        sparse = np.zeros(100)
+        sparse[[1, 50]] = 3.0
+        dense = np.arange(100.0)
+        small = np.zeros(5)
+        integers = np.zeros(100, dtype=np.int64)
+        encoded = encoder.encode([sparse, dense, small, integers])
+        np.testing.assert_array_equal(encoded[0].to_dense(), sparse)
+        # more than half of the entries, or arrays that are small or not floating point, stay dense
+        assert isinstance(encoded[1], np.ndarray)
+        np.testing.assert_array_equal(encoded[1], dense)
+        assert encoded[2] is small and encoded[3] is integers
+        assert encoder.residuals == {}
+
+    def test_streams(self):
+        app, state = make_app(client_id='c1', coordinator=False, clients=['c0', 'c1'], coordinator_id='c0')
+        state.configure_sparse(ratio=0.1)
+        state.send_data_to_coordinator(np.ones(2000), memo='g', stream='gradients')
+        state.send_data_to_coordinator(np.ones(2000), memo='v', stream='velocity')
+        state.send_data_to_coordinator({'w': np.ones(2000)}, memo='w', stream='gradients')
+        streams = sorted((key[0][1], key[0][2]) for key in app.sparse_encoder.residuals)
+        assert streams == [('gradients', '0'), ('gradients', "{'w': 0}"), ('velocity', '0')]
+
+    def test_workflow(self):
+        updates = {f'c{i}': [np.random.default_rng(i * 10 + r).normal(size=5000) for r in range(5)] for i in range(3)}
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    self.configure_sparse(ratio=0.1)
+                    aggregates = []
+                    for r, update in enumerate(updates[self.id]):
+                        self.send_data_to_coordinator(update, memo=f'round{r}', stream='gradients')
+                        if self.is_coordinator:
+                            aggregates.append(self.aggregate_data(memo=f'round{r}'))
+                    self.store('aggregates', aggregates)
+                    # partial aggregates are sent dense, so the result is exact
+                    self.store('tree', self.aggregate_tree(updates[self.id][0], fan_in=1))
+                    return 'terminal'
+
+        apps = run_workflow(3, build)
+        residuals = sum(residual for app in apps.values() for residual in app.sparse_encoder.residuals.values())
+        total = sum(sum(client_updates) for client_updates in updates.values())
+        np.testing.assert_allclose(sum(apps['c0'].internal['aggregates']) + residuals, total)
+        np.testing.assert_allclose(apps['c0'].internal['tree'], sum(updates[client][0] for client in updates))
+
+
+class QuantizationTestCase(TestCase):
+
+    def test_error_bounds(self):
+        array = np.random.default_rng(0).normal(size=(50, 30)).astype(np.float32)
+        for quantization, bound in ((Quantization.FLOAT16, 2 ** -11), (Quantization.BFLOAT16, 2 ** -8)):
+            quantized = QuantizedArray.quantize(array, quantization)
+            assert quantized.nbytes == array.nbytes // 2
+            decoded = quantized.to_dense()
+            assert decoded.dtype == np.float32 and decoded.shape == array.shape
+            # relative error of half a unit in the last place
+            assert np.all(np.abs(decoded - array) <= bound * np.abs(array) + 1e-7)
+        quantized = QuantizedArray.quantize(array, Quantization.INT8, block_size=100)
+        decoded = quantized.to_dense()
+        blocks = array.reshape(-1, 100)
+        bound = (blocks.max(axis=1) - blocks.min(axis=1)) / 255 / 2
+        assert np.all(np.abs(decoded - array).reshape(-1, 100) <= bound[:, None] * 1.001)
+
+    def test_not_representable(self):
+        large = np.array([1.0, 1e6] * 600)
+        assert QuantizedArray.quantize(large, Quantization.FLOAT16) is large
+        assert isinstance(QuantizedArray.quantize(large, Quantization.BFLOAT16), QuantizedArray)
+        huge = np.array([1.0, 1e300])
+        assert QuantizedArray.quantize(huge, Quantization.BFLOAT16) is huge
+        assert QuantizedArray.quantize(huge, Quantization.INT8) is huge
+        infinite = np.array([1.0, np.inf])
+        assert QuantizedArray.quantize(infinite, Quantization.INT8) is infinite
+        for dtype in (np.float16, np.longdouble, np.int64):
+            array = np.ones(10, dtype=dtype)
+            assert QuantizedArray.quantize(array, Quantization.INT8) is array
+
+    def test_bfloat16_special_values(self):
+        array = np.array([np.nan, np.inf, -np.inf, np.finfo(np.float32).max, 0.0], dtype=np.float32)
+        decoded = QuantizedArray.quantize(array, Quantization.BFLOAT16).to_dense()
+        assert np.isnan(decoded[0]) and decoded[1] == np.inf and decoded[2] == -np.inf
+        assert np.isfinite(decoded[3]) and decoded[4] == 0
+
+    def test_stochastic_rounding(self):
+        # a value halfway between two codes is rounded up in about half of the cases
+        array = np.tile(np.array([0.0, 1.0, 0.5 / 255], dtype=np.float32), 10000)
+        rng = np.random.default_rng(0)
+        quantized = QuantizedArray.quantize(array, Quantization.INT8, block_size=3, stochastic=True, rng=rng)
+        decoded = quantized.to_dense()[2::3]
+        assert set(np.unique(decoded)) <= {0.0, np.float32(1 / 255)}
+        np.testing.assert_allclose(decoded.mean(), 0.5 / 255, rtol=0.05)
+        # deterministic rounding always rounds the same way
+        decoded = QuantizedArray.quantize(array, Quantization.INT8, block_size=3).to_dense()[2::3]
+        assert len(np.unique(decoded)) == 1
+
+    def test_frames(self):
+        array = np.linspace(-1, 1, 2000)
+        frame = _dumps_frame({'w': QuantizedArray.quantize(array, Quantization.INT8)})
+        decoded = _loads_frame(frame)['w']
+        assert isinstance(decoded, np.ndarray) and decoded.dtype == np.float64
+        np.testing.assert_allclose(decoded, array, atol=2 / 255)
+        with keep_encoded():
+            assert isinstance(_loads_frame(frame)['w'], QuantizedArray)
+
+    def test_workflow(self):
+        updates = {f'c{i}': np.random.default_rng(i).normal(size=3000).astype(np.float32) for i in range(3)}
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    self.configure_quantization(Quantization.BFLOAT16)
+                    self.send_data_to_coordinator({'w': updates[self.id], 'small': np.ones(3)}, memo='round')
+                    if self.is_coordinator:
+                        self.store('result', self.aggregate_data(memo='round'))
+                    return 'terminal'
+
+        result = run_workflow(3, build)['c0'].internal['result']
+        assert result['w'].dtype == np.float32
+        np.testing.assert_allclose(result['w'], sum(updates.values()), atol=0.05)
+        np.testing.assert_array_equal(result['small'], 3 * np.ones(3))
+
+
+class DeltaTestCase(TestCase):
+
+    def test_diff_and_apply(self):
+        rng = np.random.default_rng(0)
+        arrays = [rng.random(1000), np.arange(100), np.array(['a', 'b'], dtype=object)]
+        sent = [np.array(a, copy=True) for a in arrays]
+        received = [np.array(a, copy=True) for a in arrays]
+        for r in range(5):
+            arrays = [a.copy() for a in arrays]
+            arrays[0][rng.choice(1000, 10, replace=False)] += 1.0
+            if r == 2:
+                arrays[1] = np.arange(50)
+            patches = diff_arrays(sent, arrays)
+            assert len(patches[0].indices) == 10
+            if r == 2:
+                # a new shape is sent in full
+                assert patches[1].indices is None and patches[1].values is arrays[1]
+            else:
+                assert patches[1].indices is None and patches[1].values is None
+            # arrays of other dtypes are always sent as they are
+            assert patches[2].indices is None and patches[2].values is arrays[2]
+            apply_patches(received, patches)
+            for new, old, base in zip(arrays, sent, received):
+                np.testing.assert_array_equal(old, new)
+                np.testing.assert_array_equal(base, new)
+        # mostly changed arrays are sent in full
+        [patch] = diff_arrays([np.zeros(10)], [np.ones(10)])
+        assert patch.indices is None
+
+    def test_encode_delta(self):
+        sender, _ = make_app('c0', clients=['c0', 'c1', 'c2'])
+        receivers = [make_app(client, coordinator=False, clients=['c0', 'c1', 'c2'], coordinator_id='c0')[0]
+                     for client in ('c1', 'c2')]
+        model = {'w': np.zeros(1000), 'name': 'model'}
+        delta = sender.encode_delta('model', model, ['c1', 'c2'])
+        assert delta.version == 1 and delta.base is None
+        receivers[0].resolve_incoming(_loads_frame(_dumps_frame(delta)))
+        sender.resolve_incoming('ack', receivers[0]._delta_metadata(), 'c1')
+        # the data is sent in full again until all clients acknowledged the last version
+        delta = sender.encode_delta('model', model, ['c1', 'c2'])
+        assert delta.version == 2 and delta.base is None
+        for receiver in receivers:
+            assert receiver.resolve_incoming(_loads_frame(_dumps_frame(delta)))['name'] == 'model'
+            sender.resolve_incoming('ack', receiver._delta_metadata(), receiver.id)
+        for version in range(3, 6):
+            model = {'w': model['w'].copy(), 'name': 'model'}
+            model['w'][version] = version
+            delta = sender.encode_delta('model', model, ['c1', 'c2'])
+            assert (delta.version, delta.base) == (version, version - 1)
+            assert isinstance(delta.value['w'], ArrayPatch) and len(delta.value['w'].indices) == 1
+            for receiver in receivers:
+                result = receiver.resolve_incoming(_loads_frame(_dumps_frame(delta)))
+                np.testing.assert_array_equal(result['w'], model['w'])
+                sender.resolve_incoming('ack', receiver._delta_metadata(), receiver.id)
+
+    def test_forwarded_metadata(self):
+        sender, _ = make_app('c0', clients=['c0', 'c1', 'c2'])
+        receiver, _ = make_app('c1', coordinator=False, clients=['c0', 'c1', 'c2'], coordinator_id='c0')
+        receiver.resolve_incoming(sender.encode_delta('model', np.zeros(10), ['c1']))
+        metadata = receiver._delta_metadata()
+        # data of c1 forwarded by c2 does not acknowledge anything for either
+        sender.resolve_incoming('forwarded', metadata, 'c2')
+        sender.resolve_incoming('forwarded', metadata, None)
+        assert sender.delta_acks == {}
+        sender.resolve_incoming('own', metadata, 'c1')
+        assert sender.delta_acks == {'c1': {'model': 1}}
+
+    def test_workflow(self):
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    model = np.zeros(2000)
+                    received = []
+                    for r in range(4):
+                        if self.is_coordinator:
+                            model = model.copy()
+                            model[r * 10:r * 10 + 5] = r
+                            self.broadcast_data({'w': model, 'round': r}, memo=f'model{r}', delta='model')
+                        received.append(self.await_data(memo=f'model{r}'))
+                        # the versions held travel back with the next data sent
+                        self.send_data_to_coordinator(r, memo=f'ack{r}')
+                        if self.is_coordinator:
+                            self.gather_data(memo=f'ack{r}')
+                    self.store('received', received)
+                    self.store('model', model)
+                    return 'terminal'
+
+        apps = run_workflow(3, build)
+        model = apps['c0'].internal['model']
+        for app in apps.values():
+            received = app.internal['received']
+            assert [piece['round'] for piece in received] == [0, 1, 2, 3]
+            np.testing.assert_array_equal(received[-1]['w'], model)
+        values = apps['c0'].metrics.values()
+        assert values['fc_delta_broadcasts_total', (('key', 'model'), ('kind', 'snapshot'))] == 1
+        assert values['fc_delta_broadcasts_total', (('key', 'model'), ('kind', 'delta'))] == 3
@@ -0,0 +1,446 @@
+import collections
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+import numpy as np
+
+from FeatureCloud.app.engine.app import CHECKPOINT_FETCHED_FILE, CHECKPOINT_FILE, App, AppState, LogLevel, Role, \
+    SHUTDOWN_TIMEOUT, State, _Loopback, _deserialize_incoming, app_preload, app_state
+from FeatureCloud.app.engine.logbuffer import LogWriter
+from FeatureCloud.app.engine.metrics import Metrics
+from FeatureCloud.app.engine.tracing import Tracer, merge_traces
+from engine_harness import make_app, run_workflow
+
+
+def broadcasting_app(rounds=2, **shutdown):
+    """ An app whose coordinator broadcasts rounds data pieces and terminates. """
+    app = App()
+    app.log_level = LogLevel.ERROR
+
+    @app_state('initial', Role.BOTH, app)
+    class InitialState(AppState):
+        def register(self):
+            self.register_transition('terminal')
+            self.configure_shutdown(**shutdown)
+
+        def run(self):
+            for i in range(rounds):
+                self.broadcast_data(i, send_to_self=False, memo=f'round{i}')
+            return 'terminal'
+
+    app.register()
+    return app
+
+
+class ShutdownTestCase(TestCase):
+
+    def test_final_status_after_all_data(self):
+        app = broadcasting_app()
+        app.handle_setup('c0', True, ['c0', 'c1'], 'c0')
+        fetched = []
+        finished = False
+        deadline = time.monotonic() + 10
+        while app.thread.is_alive() and time.monotonic() < deadline:
+            status = json.loads(app.handle_status_encoded()[1])
+            if status['finished']:
+                # only served once nothing is left to send
+                assert len(fetched) == 2 and len(app.data_outgoing) == 1
+                finished = True
+            elif status['available']:
+                fetched.append((status['memo'], app.handle_outgoing()))
+        app.thread.join(1)
+        assert finished and not app.thread.is_alive()
+        assert [memo for memo, _ in fetched] == ['round0', 'round1']
+
+    def test_no_waiting(self):
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('second')
+
+                def run(self):
+                    self.send_data_to_coordinator(self.id, memo='first')
+                    if self.is_coordinator:
+                        self.gather_data(memo='first')
+                    return 'second'
+
+            @app_state('second', Role.BOTH, app)
+            class SecondState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    return 'terminal'
+
+        start = time.perf_counter()
+        apps = run_workflow(3, build)
+        # formerly at least 1 second per transition and 10 seconds at the end
+        assert time.perf_counter() - start < 1
+        assert [name for _, name in apps['c1'].transition_log] == ['initial_second', 'second_terminal']
+
+    def test_timeout(self):
+        app = broadcasting_app(timeout=0.1)
+        app.handle_setup('c0', True, ['c0', 'c1'], 'c0')
+        # nobody fetches the data, the app gives up after the timeout
+        app.thread.join(5)
+        assert not app.thread.is_alive()
+        assert len(app.data_outgoing) == 3
+
+    def test_default_timeout(self):
+        app = broadcasting_app()
+        assert app.shutdown_timeout == SHUTDOWN_TIMEOUT
+
+    def test_terminal_wait(self):
+        app = broadcasting_app(timeout=0.1, terminal_wait=5)
+        with mock.patch('FeatureCloud.app.engine.app.sleep') as sleep:
+            app.handle_setup('c0', True, ['c0', 'c1'], 'c0')
+            app.thread.join(5)
+        # only once, after the final status
+        sleep.assert_called_once_with(5)
+
+
+class PreloadTestCase(TestCase):
+
+    def setUp(self):
+        self.app = App()
+        self.app.log_level = LogLevel.ERROR
+        self.release = release = threading.Event()
+        self.events = events = []
+
+        @app_preload(self.app)
+        def load_model(app):
+            release.wait(5)
+            events.append('preload')
+            app.internal['model'] = 'model'
+
+        @app_state('initial', Role.BOTH, self.app)
+        class InitialState(AppState):
+            def register(self):
+                self.register_transition('terminal')
+
+            def run(self):
+                events.append(f'run {self.load("model")}')
+                return 'terminal'
+
+    def test_setup_does_not_wait(self):
+        self.app.register()
+        assert not self.app.ready and not self.app.wait_preload(0.01)
+        start = time.perf_counter()
+        self.app.handle_setup('c0', True, ['c0'])
+        assert time.perf_counter() - start < 0.5
+        time.sleep(0.05)
+        # the workflow waits for the preload hooks
+        assert self.events == []
+        self.release.set()
+        assert self.app.wait_preload(5) and self.app.ready
+        deadline = time.monotonic() + 5
+        while self.app.thread.is_alive() and time.monotonic() < deadline:
+            self.app.handle_status()
+        assert self.events == ['preload', 'run model']
+
+    def test_failing_hook(self):
+        @app_preload(self.app)
+        def fail(app):
+            raise ValueError('no model')
+
+        self.release.set()
+        self.app.register()
+        self.app.handle_setup('c0', True, ['c0'])
+        self.app.thread.join(5)
+        status = self.app.handle_status()
+        assert status['state'] == State.ERROR.value and status['message'] == 'ValueError'
+        assert status['finished'] and self.events == ['preload']
+
+
+class CheckpointTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoint_dir = os.path.join(self.directory.name, 'checkpoint')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def counting_app(self, crash_at=None):
+        """ An app counting rounds in a loop state, crashing in round crash_at. """
+        app = App()
+        app.log_level = LogLevel.ERROR
+        checkpoint_dir = self.checkpoint_dir
+
+        @app_state('initial', Role.BOTH, app)
+        class InitialState(AppState):
+            def register(self):
+                self.register_transition('loop')
+                self.configure_checkpoint(checkpoint_dir)
+
+            def run(self):
+                self.store('weights', np.zeros(100000))
+                self.store('round', 0)
+                return 'loop'
+
+        @app_state('loop', Role.BOTH, app)
+        class LoopState(AppState):
+            def register(self):
+                self.register_transition('loop')
+                self.register_transition('terminal')
+
+            def run(self):
+                self.store('round', self.load('round') + 1)
+                self.load('weights')[:] += 1
+                if self.load('round') == crash_at:
+                    raise RuntimeError('crash')
+                return 'terminal' if self.load('round') == 5 else 'loop'
+
+        app.register()
+        return app
+
+    def run_app(self, app):
+        app.handle_setup('c0', True, ['c0'])
+        deadline = time.monotonic() + 10
+        while app.thread.is_alive() and time.monotonic() < deadline:
+            app.handle_status()
+            time.sleep(0.001)
+        app.thread.join(1)
+
+    def test_resume(self):
+        crashed = self.counting_app(crash_at=3)
+        self.run_app(crashed)
+        assert crashed.handle_status()['state'] == State.ERROR.value
+        assert os.path.isfile(os.path.join(self.checkpoint_dir, CHECKPOINT_FILE))
+        resumed = self.counting_app()
+        self.run_app(resumed)
+        assert resumed.internal['round'] == 5
+        # round 3 is repeated, its changes before the crash are not restored
+        assert resumed.internal['weights'][0] == 5
+        assert len(resumed.transition_log) == 6
+        # removed once the workflow finished
+        assert not os.path.exists(self.checkpoint_dir)
+
+    def test_queued_data(self):
+        app, state = make_app()
+        state.configure_checkpoint(self.checkpoint_dir)
+        large = app.serialize_outgoing(np.arange(100000.0))
+        app.data_outgoing.append(large, {'available': True, 'memo': 'large'})
+        app.data_outgoing.append(b'small', {'available': True, 'memo': 'small'})
+        app.handle_incoming(bytearray(large), 'c1', memo='received')
+        app.handle_incoming(_Loopback({'k': 1}), 'c0', memo='loopback')
+        assert app.checkpoint()
+
+        resumed, state = make_app()
+        state.configure_checkpoint(self.checkpoint_dir)
+        resumed.data_outgoing.append(b'new', {'available': True, 'memo': 'new'})
+        assert resumed.resume()
+        # queued in front of data sent after the restart
+        assert [status['memo'] for _, status in resumed.data_outgoing.items()] == ['large', 'small', 'new']
+        assert bytes(resumed.data_outgoing.items()[0][0]) == large
+        np.testing.assert_array_equal(_deserialize_incoming(resumed.data_incoming['received'][0][0]),
+                                      np.arange(100000.0))
+        assert resumed.data_incoming['loopback'][0][0].get() == {'k': 1}
+
+    def test_fetched_data_not_queued_again(self):
+        app, state = make_app()
+        state.configure_checkpoint(self.checkpoint_dir)
+        for memo in ('a', 'b', 'c'):
+            app.data_outgoing.append(memo.encode(), {'available': True, 'memo': memo})
+        assert app.checkpoint()
+        # fetched by the controller after the checkpoint was written
+        for memo in ('a', 'b'):
+            assert app.handle_status()['memo'] == memo
+            assert app.handle_outgoing() == memo.encode()
+
+        resumed, state = make_app()
+        state.configure_checkpoint(self.checkpoint_dir)
+        assert resumed.resume()
+        assert [status['memo'] for _, status in resumed.data_outgoing.items()] == ['c']
+        # fetched after resuming, before the next checkpoint
+        resumed.handle_status()
+        resumed.handle_outgoing()
+        again, state = make_app()
+        state.configure_checkpoint(self.checkpoint_dir)
+        assert again.resume() and len(again.data_outgoing) == 0
+        # a new checkpoint drops the records of the previous one
+        again.data_outgoing.append(b'd', {'available': True, 'memo': 'd'})
+        assert again.checkpoint()
+        assert not os.path.exists(os.path.join(self.checkpoint_dir, CHECKPOINT_FETCHED_FILE))
+        resumed.remove_checkpoint()
+        assert not os.path.exists(self.checkpoint_dir)
+
+    def test_other_client(self):
+        app, state = make_app(client_id='c0')
+        state.configure_checkpoint(self.checkpoint_dir)
+        assert app.checkpoint()
+        other, state = make_app(client_id='c1')
+        state.configure_checkpoint(self.checkpoint_dir)
+        assert not other.resume()
+
+
+class MetricsTestCase(TestCase):
+
+    def test_metrics(self):
+        metrics = Metrics()
+        metrics.inc('fc_sent_messages_total', memo='a', destination='c1')
+        metrics.inc('fc_sent_messages_total', 2, memo='a', destination='c1')
+        metrics.set('fc_round_wait_seconds', 0.5, memo='say "hi"')
+        with metrics.timer('fc_state_seconds_total', state='initial'):
+            time.sleep(0.01)
+        values = metrics.values()
+        assert values['fc_sent_messages_total', (('destination', 'c1'), ('memo', 'a'))] == 3
+        assert values['fc_state_seconds_total', (('state', 'initial'),)] >= 0.01
+        text = metrics.render({('fc_outgoing_queue_depth', ()): 2})
+        assert '# TYPE fc_sent_messages_total counter' in text
+        assert 'fc_sent_messages_total{destination="c1",memo="a"} 3' in text
+        assert 'fc_round_wait_seconds{memo="say \\"hi\\""} 0.5' in text
+        assert 'fc_outgoing_queue_depth 2' in text
+
+    def test_workflow_metrics(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    self.configure_metrics(os.path.join(directory.name, f'{self.id}.prom'))
+                    self.send_data_to_coordinator(np.zeros(1000), memo='round')
+                    if self.is_coordinator:
+                        self.gather_data(memo='round')
+                    return 'terminal'
+
+        apps = run_workflow(3, build)
+        values = apps['c0'].metrics.values()
+        assert values['fc_state_runs_total', (('state', 'initial'),)] == 1
+        assert values['fc_state_seconds_total', (('state', 'initial'),)] > 0
+        assert values['fc_received_messages_total', (('client', 'c1'), ('memo', 'round'))] == 1
+        assert values['fc_deserialize_seconds_total', ()] > 0
+        values = apps['c1'].metrics.values()
+        assert values['fc_sent_messages_total', (('destination', 'coordinator'), ('memo', 'round'))] == 1
+        assert values['fc_serialize_bytes_total', ()] > 8000
+        # the final status is left in the queue
+        assert 'fc_outgoing_queue_depth 1' in apps['c1'].render_metrics()
+        assert sorted(os.listdir(directory.name)) == ['c0.prom', 'c1.prom', 'c2.prom']
+
+
+class LoggingTestCase(TestCase):
+
+    def capture(self, writer, write):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            write()
+            writer.flush()
+        return stdout.getvalue().splitlines(), stderr.getvalue().splitlines()
+
+    def test_buffered(self):
+        writer = LogWriter()
+
+        def write():
+            for i in range(100):
+                writer.write(f'message {i}', 'info')
+            writer.write('failed', 'error', error=True)
+            writer.write('plain')
+
+        stdout, stderr = self.capture(writer, write)
+        assert [line.split('] ')[-1] for line in stdout] == [f'message {i}' for i in range(100)] + ['plain']
+        assert stdout[0].startswith('[Time: ') and '[Level: info] message 0' in stdout[0]
+        assert stdout[-1] == 'plain'
+        assert len(stderr) == 1 and stderr[0].endswith('[Level: error] failed')
+
+    def test_unbuffered(self):
+        writer = LogWriter(buffered=False)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            writer.write('now')
+        assert stdout.getvalue() == 'now\n'
+        assert writer._thread is None
+
+    def test_request_rate_limit(self):
+        writer = LogWriter(request_interval=0.1, request_burst=2)
+
+        def write():
+            for _ in range(5):
+                writer.request('[CTRL] GET /status')
+            writer.request('[CTRL] GET /data')
+            time.sleep(0.15)
+            writer.request('[CTRL] GET /status')
+
+        stdout, _ = self.capture(writer, write)
+        assert stdout == ['[CTRL] GET /status', '[CTRL] GET /status', '[CTRL] GET /data',
+                          '[CTRL] GET /status (and 3 more not logged)']
+
+    def test_log_level(self):
+        app, state = make_app()
+        state.configure_logging(LogLevel.ERROR, buffered=False)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            app.log('hidden')
+            app.log('shown', LogLevel.ERROR)
+        assert stdout.getvalue() == '' and stderr.getvalue().endswith('[Level: error] shown\n')
+        with self.assertRaises(RuntimeError):
+            app.log('fatal', LogLevel.FATAL)
+
+
+class TracingTestCase(TestCase):
+
+    def test_flows_are_matched(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    self.configure_tracing(os.path.join(directory.name, f'{self.id}.json'))
+                    for i in range(2):
+                        # the same memo twice in a row
+                        self.send_data_to_coordinator(i, memo='update')
+                        self.send_data_to_coordinator(i, memo='update')
+                        if self.is_coordinator:
+                            self.gather_data(memo='update')
+                            self.gather_data(memo='update')
+                            self.broadcast_data(i, memo=f'model{i}')
+                        self.await_data(memo=f'model{i}')
+                    return 'terminal'
+
+        run_workflow(3, build)
+        paths = [os.path.join(directory.name, f'c{i}.json') for i in range(3)]
+        merged = os.path.join(directory.name, 'merged.json')
+        merge_traces(paths, merged)
+        with open(merged) as file:
+            trace = json.load(file)
+        assert trace['otherData']['clients'] == ['c0', 'c1', 'c2']
+        flows = collections.Counter((event['ph'], event['id']) for event in trace['traceEvents']
+                                    if event.get('cat') == 'message')
+        starts = {flow_id for phase, flow_id in flows if phase == 's'}
+        finishes = {flow_id for phase, flow_id in flows if phase == 'f'}
+        # 2 participants * 2 rounds * (2 updates + 1 model)
+        assert len(starts) == 12 and starts == finishes
+        assert all(count == 1 for count in flows.values())
+        names = {event['name'] for event in trace['traceEvents']}
+        assert {'initial', 'serialize update', 'queued update', 'buffered update', 'await update'} <= names
+
+    def test_disabled(self):
+        tracer = Tracer()
+        tracer.outgoing_enqueued({}, tracer.now())
+        tracer.span('states', 'initial', 0, 1)
+        assert tracer.events == [] and tracer._outgoing == {}
+
+    def test_unfetched_data_is_forgotten(self):
+        tracer = Tracer()
+        tracer.enabled = True
+        kept, dropped = {'memo': 'kept'}, {'memo': 'dropped'}
+        tracer.outgoing_enqueued(kept, tracer.now())
+        tracer.outgoing_enqueued(dropped, tracer.now())
+        tracer.outgoing_retain([kept])
+        assert [record[0] for record in tracer._outgoing.values()] == [kept]
@@ -0,0 +1,450 @@
+import json
+import math
+import mmap
+import pickle
+import threading
+import time
+from unittest import TestCase
+
+import numpy as np
+
+from FeatureCloud.app.engine.app import AppState, FRAME_ALIGNMENT, FRAME_VERSION, INCOMING_SPILL_MIN_SIZE, \
+    LazyData, LoopbackMode, OutgoingQueue, Role, _FRAME_HEADER, _FrameParts, _checkpoint_payload, _deserialize_incoming, \
+    _dumps_frame, _dumps_json, _frame_metadata, _is_frame, _loads_frame, _loads_json, _numeric_to_numpy, _payload_size, \
+    _serialize_outgoing, app_state
+from FeatureCloud.app.engine.compression import COMPRESSION_MIN_SIZE, Compression, CompressionSelector, compress, \
+    decompress, is_compressed
+from FeatureCloud.app.api.http_ctrl import _iter_chunks
+from engine_harness import make_app, run_workflow
+
+
+class AwaitDataTestCase(TestCase):
+
+    def test_wakes_up_on_arrival(self):
+        app, state = make_app()
+        result = {}
+
+        def wait():
+            result['data'] = state.await_data(n=2, memo='round1')
+            result['time'] = time.perf_counter()
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.05)
+        assert thread.is_alive()
+        app.handle_incoming(app.serialize_outgoing(1), 'c1', memo='round1')
+        app.handle_incoming(app.serialize_outgoing(2), 'c2', memo='other')
+        time.sleep(0.05)
+        assert thread.is_alive()
+        sent = time.perf_counter()
+        app.handle_incoming(app.serialize_outgoing(3), 'c2', memo='round1')
+        thread.join(5)
+        assert result['data'] == [1, 3]
+        # woken up by handle_incoming instead of polling every 100 ms
+        assert result['time'] - sent < 0.05
+        assert app.data_incoming == {'other': [(app.serialize_outgoing(2), 'c2')]}
+        assert app._incoming_conditions == {}
+
+    def test_data_arrived_before(self):
+        app, state = make_app()
+        app.handle_incoming(app.serialize_outgoing('a'), 'c1', memo='round1')
+        assert state.await_data(n=1, memo='round1') == 'a'
+
+    def test_gather_workflow(self):
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    for i in range(3):
+                        self.send_data_to_coordinator([self.id, i])
+                        if self.is_coordinator:
+                            self.store(f'round{i}', sorted(self.gather_data()))
+                    return 'terminal'
+
+        apps = run_workflow(3, build)
+        for i in range(3):
+            assert apps['c0'].internal[f'round{i}'] == [['c0', i], ['c1', i], ['c2', i]]
+        assert not apps['c0'].data_incoming
+
+
+class OutgoingQueueTestCase(TestCase):
+
+    def test_fifo_and_matching(self):
+        changes = []
+        queue = OutgoingQueue(on_change=lambda: changes.append(len(queue)))
+        first, second = {'memo': 'a'}, {'memo': 'b'}
+        queue.append(b'12345', first)
+        queue.append(None, second)
+        assert len(queue) == 2
+        assert queue.peek_status() is first
+        # the status announced last does not match, nothing is removed
+        assert queue.pop_matching(second) == (b'12345', first)
+        assert len(queue) == 2
+        assert queue.pop_matching(first) == (b'12345', first)
+        assert queue.pop_matching(second) == (None, second)
+        assert queue.pop_matching(second) is None
+        assert queue.peek_status() is None
+        assert changes == [1, 2, 1, 0]
+        assert queue.stats() == {'depth': 0, 'bytes': 0, 'enqueued': 2, 'dequeued': 2, 'bytes_dequeued': 5}
+
+    def test_extend_and_appendleft(self):
+        changes = []
+        queue = OutgoingQueue(on_change=lambda: changes.append(len(queue)))
+        queue.extend([(b'a', {'i': 1}), (b'bc', {'i': 2})])
+        queue.extend([])
+        queue.appendleft('def', {'i': 0})
+        assert changes == [2, 3]
+        assert queue.items() == [('def', {'i': 0}), (b'a', {'i': 1}), (b'bc', {'i': 2})]
+        assert queue.bytes == 6
+
+    def test_concurrent_producers(self):
+        queue = OutgoingQueue()
+
+        def produce(producer):
+            for i in range(1000):
+                queue.append(b'x', {'producer': producer, 'i': i})
+
+        threads = [threading.Thread(target=produce, args=(producer,)) for producer in range(4)]
+        for thread in threads:
+            thread.start()
+        popped = []
+        while len(popped) < 4000:
+            status = queue.peek_status()
+            if status is not None:
+                popped.append(queue.pop_matching(status)[1])
+        for thread in threads:
+            thread.join()
+        for producer in range(4):
+            assert [status['i'] for status in popped if status['producer'] == producer] == list(range(1000))
+        assert queue.stats()['bytes'] == 0
+
+
+class FrameTestCase(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.data = {'weights': [rng.random((100, 50)), rng.random(3).astype(np.float32)],
+                     'columns': np.arange(10000)[::2],
+                     'bias': np.float64(0.5),
+                     'name': 'model',
+                     'rounds': (1, None)}
+
+    def assert_equal(self, value, expected):
+        assert value.keys() == expected.keys()
+        for actual, wanted in zip(value['weights'] + [value['columns']], expected['weights'] + [expected['columns']]):
+            np.testing.assert_array_equal(actual, wanted)
+            assert actual.dtype == wanted.dtype
+        assert value['bias'] == expected['bias'] and value['name'] == expected['name']
+        assert value['rounds'] == expected['rounds']
+
+    def test_round_trip(self):
+        frame = _dumps_frame(self.data, metadata=b'{"client": "c1"}')
+        assert _is_frame(frame)
+        assert _frame_metadata(frame) == b'{"client": "c1"}'
+        self.assert_equal(_loads_frame(frame), self.data)
+        self.assert_equal(_loads_frame(bytearray(frame)), self.data)
+        self.assert_equal(_deserialize_incoming(memoryview(frame)), self.data)
+
+    def test_out_of_band_buffers_are_views(self):
+        frame = bytearray(_dumps_frame(self.data))
+        n_buffers = _FRAME_HEADER.unpack_from(frame)[4]
+        # the large contiguous array only, the small and strided ones are pickled in-band
+        assert n_buffers == 1
+        start = np.frombuffer(frame, dtype=np.uint8).ctypes.data
+        weights = _loads_frame(frame)['weights'][0]
+        offset = weights.ctypes.data - start
+        assert 0 < offset < len(frame) and offset % FRAME_ALIGNMENT == 0
+        weights[0, 0] = -1.0
+        assert _loads_frame(frame)['weights'][0][0, 0] == -1.0
+
+    def test_read_only_data_gives_writable_arrays(self):
+        weights = _loads_frame(_dumps_frame(self.data))['weights'][0]
+        assert weights.flags.writeable
+        weights += 1
+
+    def test_plain_pickle(self):
+        # data sent by older versions of the package
+        self.assert_equal(_deserialize_incoming(pickle.dumps(self.data)), self.data)
+
+    def test_parts_not_joined(self):
+        frame = _dumps_frame(self.data, metadata=b'{"client": "c1"}')
+        parts = _serialize_outgoing(self.data, metadata=b'{"client": "c1"}', joined=False)
+        assert isinstance(parts, _FrameParts)
+        assert parts.nbytes == _payload_size(parts) == len(frame)
+        assert parts.join() == frame
+        # the large array is queued as a view, not as a copy
+        assert any(np.shares_memory(np.asarray(part), self.data['weights'][0]) for part in parts.parts)
+        assert b''.join(_iter_chunks(parts)) == b''.join(_iter_chunks(frame)) == frame
+        restored = pickle.loads(pickle.dumps(_checkpoint_payload(parts), protocol=5))
+        assert restored.join() == frame
+
+    def test_zero_copy_workflow(self):
+        def build(app):
+            @app_state('initial', Role.BOTH, app)
+            class InitialState(AppState):
+                def register(self):
+                    self.register_transition('terminal')
+
+                def run(self):
+                    self.configure_serialization()
+                    self.send_data_to_coordinator(np.full(100000, len(self.id), dtype=np.float64))
+                    if self.is_coordinator:
+                        self.broadcast_data(self.aggregate_data())
+                    self.store('result', self.await_data())
+                    return 'terminal'
+
+        apps = run_workflow(3, build)
+        for app in apps.values():
+            np.testing.assert_array_equal(app.internal['result'], np.full(100000, 6.0))
+
+    def test_zero_copy_compressed(self):
+        app, state = make_app()
+        state.configure_serialization()
+        data = np.zeros(100000)
+        parts = app.serialize_outgoing(data, joined=False)
+        compressed = app.compress_outgoing(parts, Compression.ZLIB)
+        assert is_compressed(compressed)
+        np.testing.assert_array_equal(_deserialize_incoming(decompress(compressed)), data)
+        assert app.compress_outgoing(parts, Compression.NONE) is parts
+
+    def test_newer_version(self):
+        frame = bytearray(_dumps_frame(self.data))
+        header = list(_FRAME_HEADER.unpack_from(frame))
+        header[1] = FRAME_VERSION + 1
+        _FRAME_HEADER.pack_into(frame, 0, *header)
+        with self.assertRaises(ValueError):
+            _loads_frame(frame)
+
+
+class JsonTestCase(TestCase):
+
+    def test_same_as_json(self):
+        data = {'sum': np.arange(6, dtype=np.int64).reshape(2, 3), 'mean': np.linspace(0, 1, 5),
+                'strided': np.arange(10.0)[::3], 'count': np.int32(7), 'scale': np.float32(0.5),
+                'labels': ['a', 'b'], 'nested': [[1, 2], [3.5]]}
+        expected = json.loads(json.dumps({key: value.tolist() if isinstance(value, np.ndarray) else value
+                                          for key, value in data.items()}, default=float))
+        assert json.loads(_dumps_json(data)) == expected
+        assert _loads_json(_dumps_json(data)) == expected
+        # as received via POST /data
+        received = _serialize_outgoing(data, is_json=True)
+        received = bytearray(received.encode() if isinstance(received, str) else received)
+        assert _loads_json(received) == expected
+
+    def test_non_finite(self):
+        data = {'values': np.array([1.0, np.nan, np.inf]), 'loss': -math.inf}
+        decoded = _loads_json(_dumps_json(data))
+        assert decoded['values'][0] == 1.0 and math.isnan(decoded['values'][1]) and decoded['values'][2] == math.inf
+        assert decoded['loss'] == -math.inf
+        # a string containing null stays as it is
+        assert _loads_json(_dumps_json({'text': 'null', 'x': [1.5]})) == {'text': 'null', 'x': [1.5]}
+
+    def test_wide_integers(self):
+        assert json.loads(_dumps_json({'n': 2 ** 70, 'm': -2 ** 65})) == {'n': 2 ** 70, 'm': -2 ** 65}
+
+    def test_numeric_to_numpy(self):
+        data = _numeric_to_numpy({'w': [[1, 2], [3, 4]], 'layers': [[1.0, 2.0], [3.0]], 'name': ['a', 'b'], 'n': 3})
+        assert isinstance(data['w'], np.ndarray) and data['w'].dtype.kind == 'i'
+        np.testing.assert_array_equal(data['w'], [[1, 2], [3, 4]])
+        assert isinstance(data['layers'], list)
+        np.testing.assert_array_equal(data['layers'][1], [3.0])
+        assert data['name'] == ['a', 'b'] and data['n'] == 3
+
+    def test_smpc_aggregate(self):
+        app, state = make_app(clients=['c0', 'c1'])
+        aggregate = {'w': [2.0, 4.0], 'n': 2}
+        for i in range(3):
+            app.handle_incoming(_serialize_outgoing(aggregate, is_json=True), 'c0', memo=f'round{i}')
+        assert state.aggregate_data(use_smpc=True, memo='round0') == aggregate
+        data = state.aggregate_data(use_smpc=True, memo='round1', as_numpy=True)
+        np.testing.assert_array_equal(data['w'], [2.0, 4.0])
+        data = state.aggregate_data(use_smpc=True, memo='round2', mean=True)
+        np.testing.assert_array_equal(data['w'], [1.0, 2.0])
+        assert data['n'] == 1.0
+
+
+class CompressionTestCase(TestCase):
+
+    def setUp(self):
+        self.data = np.repeat(np.arange(1000, dtype=np.float64), 100).tobytes()
+
+    def test_round_trip(self):
+        for codec in (Compression.ZLIB, Compression.BZ2, Compression.LZMA):
+            compressed = compress(self.data, codec)
+            assert is_compressed(compressed) and len(compressed) < len(self.data) / 10
+            decompressed = decompress(compressed)
+            assert isinstance(decompressed, bytearray) and decompressed == self.data
+            # forwarded data is not compressed twice
+            assert compress(compressed, codec) is compressed
+
+    def test_not_compressed(self):
+        assert compress(self.data, Compression.NONE) is self.data
+        small = bytes(COMPRESSION_MIN_SIZE - 1)
+        assert compress(small, Compression.ZLIB) is small
+        random = np.random.default_rng(0).bytes(100000)
+        assert compress(random, Compression.ZLIB) is random
+        with self.assertRaises(ValueError):
+            compress(self.data, Compression.AUTO)
+
+    def test_truncated(self):
+        compressed = compress(self.data, Compression.ZLIB)
+        with self.assertRaises(ValueError):
+            decompress(compressed[:len(compressed) // 2])
+
+    def test_selector(self):
+        selector = CompressionSelector(bandwidth=1e3, trials=2)
+        assert selector.select(bytes(10)) == Compression.NONE
+        assert selector.select(self.data) != Compression.NONE
+        selector.select(self.data)
+        assert selector.choice is not None and selector.choice != Compression.NONE
+        # fast links are not worth compressing incompressible data for
+        selector = CompressionSelector(bandwidth=1e12, trials=1)
+        assert selector.select(np.random.default_rng(0).bytes(100000)) == Compression.NONE
+
+    def test_sent_and_received(self):
+        app, state = make_app()
+        state.configure_compression(Compression.AUTO, bandwidth=1e3)
+        data = {'w': np.zeros((500, 100))}
+        serialized = app.compress_outgoing(app.serialize_outgoing(data))
+        assert is_compressed(serialized)
+        np.testing.assert_array_equal(app.deserialize_incoming(bytearray(serialized))['w'], data['w'])
+
+
+class DeserializationTestCase(TestCase):
+
+    def setUp(self):
+        self.app, self.state = make_app(clients=['c0', 'c1', 'c2', 'c3'])
+        self.data = [{'client': i, 'w': np.full((200, 100), float(i))} for i in range(4)]
+        self.pieces = [(self.app.serialize_outgoing(data), f'c{i}') for i, data in enumerate(self.data)]
+
+    def assert_data(self, results):
+        assert [result['client'] for result in results] == [0, 1, 2, 3]
+        for result, data in zip(results, self.data):
+            np.testing.assert_array_equal(result['w'], data['w'])
+
+    def test_parallel(self):
+        self.state.configure_deserialization(workers=4)
+        self.assert_data(self.app.deserialize_pieces(self.pieces))
+        self.state.configure_deserialization(workers=2, use_processes=True)
+        self.assert_data(self.app.deserialize_pieces([(bytes(data), client) for data, client in self.pieces]))
+        self.state.configure_deserialization(workers=1)
+
+    def test_parallel_with_loopback(self):
+        self.state.configure_deserialization(workers=4)
+        self.state.configure_loopback()
+        self.state.send_data_to_coordinator(self.data[0], memo='round')
+        for data, client in self.pieces[1:]:
+            self.app.handle_incoming(data, client, memo='round')
+        results = self.state.gather_data(memo='round')
+        # the coordinator's own data piece is delivered without serialization
+        assert results[0] is self.data[0]
+        self.assert_data(results)
+
+    def test_lazy(self):
+        for data, client in self.pieces:
+            self.app.handle_incoming(data, client, memo='round')
+        results = self.state.gather_data(memo='round', lazy=True)
+        assert all(isinstance(result, LazyData) and not result.loaded for result in results)
+        assert [result.client for result in results] == ['c0', 'c1', 'c2', 'c3']
+        # forwarded without deserializing and serializing it again
+        assert _serialize_outgoing(results[1]) is self.pieces[1][0]
+        assert results[1].nbytes == len(self.pieces[1][0])
+        self.assert_data([result.value for result in results])
+        assert results[0].loaded and results[0].raw is None
+
+
+class LoopbackTestCase(TestCase):
+
+    def send_to_self(self, mode):
+        app, state = make_app()
+        state.configure_loopback(mode)
+        data = {'w': np.arange(5.0), 'labels': ['a']}
+        state.send_data_to_participant(data, destination='c0', memo='round')
+        assert len(app.data_outgoing) == 0
+        return data, state.await_data(memo='round')
+
+    def test_default(self):
+        app, state = make_app()
+        data = {'w': np.arange(5.0)}
+        state.send_data_to_participant(data, destination='c0', memo='round')
+        data['w'][0] = -1.0
+        # changes after sending do not reach the own data piece
+        np.testing.assert_array_equal(state.await_data(memo='round')['w'], np.arange(5.0))
+
+    def test_reference(self):
+        data, received = self.send_to_self(LoopbackMode.REFERENCE)
+        assert received is data
+
+    def test_copy(self):
+        data, received = self.send_to_self(LoopbackMode.COPY)
+        assert received is not data and received['w'] is not data['w']
+        data['w'][0] = -1.0
+        np.testing.assert_array_equal(received['w'], np.arange(5.0))
+        assert received['labels'] == ['a']
+
+    def test_serialize(self):
+        data, received = self.send_to_self(LoopbackMode.SERIALIZE)
+        assert received is not data and not np.shares_memory(received['w'], data['w'])
+        np.testing.assert_array_equal(received['w'], data['w'])
+
+
+class IncomingBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.app, self.state = make_app()
+        self.arrays = [np.full(10000, float(i)) for i in range(3)]
+
+    def receive(self, memo, i):
+        self.app.handle_incoming(bytearray(self.app.serialize_outgoing(self.arrays[i])), f'c{i}', memo=memo)
+
+    def test_spill(self):
+        self.state.configure_incoming(budget=200000)
+        self.receive('round', 0)
+        self.receive('round', 1)
+        assert self.app.incoming_spilled == 0
+        self.receive('round', 2)
+        stats = self.app.incoming_stats()
+        assert stats['spilled'] == 1 and stats['bytes_in_memory'] <= 200000
+        assert isinstance(self.app.data_incoming['round'][0][0], mmap.mmap)
+        for received, array in zip(self.state.await_data(n=3, memo='round'), self.arrays):
+            np.testing.assert_array_equal(received, array)
+        assert self.app.incoming_stats()['bytes_in_memory'] == 0
+
+    def test_awaited_data_is_spilled_last(self):
+        self.state.configure_incoming(budget=200000)
+        received = []
+        thread = threading.Thread(target=lambda: received.append(self.state.await_data(n=2, memo='awaited')))
+        thread.start()
+        time.sleep(0.05)
+        self.receive('awaited', 0)
+        self.receive('later', 1)
+        self.receive('later', 2)
+        assert isinstance(self.app.data_incoming['later'][0][0], mmap.mmap)
+        assert isinstance(self.app.data_incoming['awaited'][0][0], bytearray)
+        self.receive('awaited', 1)
+        thread.join(5)
+        np.testing.assert_array_equal(received[0][1], self.arrays[1])
+
+    def test_small_data_is_kept(self):
+        self.state.configure_incoming(budget=0)
+        small = bytearray(self.app.serialize_outgoing(b'x' * (INCOMING_SPILL_MIN_SIZE // 2)))
+        self.app.handle_incoming(small, 'c1', memo='small')
+        assert self.app.data_incoming['small'][0][0] is small
+
+    def test_eviction(self):
+        self.state.configure_incoming(ttl=0.05)
+        self.receive('stale', 0)
+        thread = threading.Thread(target=lambda: self.state.await_data(memo='awaited'))
+        thread.start()
+        time.sleep(0.1)
+        self.receive('awaited', 1)
+        thread.join(5)
+        # evicted when the next data piece arrived
+        assert 'stale' not in self.app.data_incoming
+        [eviction] = self.app.incoming_evictions
+        assert eviction['memo'] == 'stale' and eviction['clients'] == ['c0'] and eviction['pieces'] == 1
+        self.receive('fresh', 2)
+        assert self.app.evict_stale_incoming() == [] and 'fresh' in self.app.data_incoming